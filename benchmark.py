@@ -0,0 +1,426 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer
+
+import requests
+
+# Usage: benchmark.py [--series N] [--points N] [--out-of-order RATIO] [--suites lsm,store,...]
+#                     [--output results.json] [--baseline baseline.json] [--threshold 0.15]
+# Runs deterministic synthetic workloads against each storage backend and
+# prints the results. With --baseline the results are compared against an
+# earlier --output file and the exit status is 1 if any metric regressed by
+# more than --threshold.
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+SUITES = ('lsm', 'store', 'cluster', 'vm-storage', 'sql')
+START = 1700000000 * 10**9  # First timestamp of every workload
+INTERVAL = 10 * 10**9  # Time between the points of one series
+# Delayed ACKs are sent after about 40 ms. If every HTTP query's median lands
+# in this band (in seconds), a keep-alive connection is stalling on them and
+# the run measured that rather than the queries.
+DELAYED_ACK_FLOOR = (0.035, 0.050)
+
+LOADED = {}
+
+def load_script(name):
+    # The service scripts have hyphenated names, so they are loaded by path.
+    if name not in LOADED:
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(REPO, f'{name}.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        LOADED[name] = module
+    return LOADED[name]
+
+class Workload:
+    # Points of `series` series with `points` points each, INTERVAL apart,
+    # in arrival order. Points arrive a time step at a time; a fraction
+    # out_of_order of them arrive up to ten steps late. The same arguments
+    # always give the same points.
+    def __init__(self, series=100, points=1000, out_of_order=0.0, seed=42):
+        rng = random.Random(seed)
+        self.series = series
+        self.points_per_series = points
+        self.tags = [{'host': f'host{i}', 'region': f'r{i % 4}'} for i in range(series)]
+        points_in_order = []
+        for step in range(points):
+            for i in range(series):
+                points_in_order.append((i, START + step * INTERVAL, round(rng.gauss(50, 15), 3), rng.randrange(1000)))
+        arrival = [position + (rng.randint(1, 10 * series) if rng.random() < out_of_order else 0)
+                   for position in range(len(points_in_order))]
+        self.points = [point for _, point in sorted(zip(arrival, points_in_order), key=lambda pair: pair[0])]
+        self.end = START + points * INTERVAL
+
+    def __len__(self):
+        return len(self.points)
+
+    def line(self, point):
+        i, timestamp, value, count = point
+        return f"cpu,host=host{i},region=r{i % 4} value={value},count={count}i {timestamp}"
+
+    def bodies(self, batch_size):
+        for i in range(0, len(self.points), batch_size):
+            yield '\n'.join(self.line(point) for point in self.points[i:i + batch_size])
+
+def iso(timestamp):
+    return datetime.fromtimestamp(timestamp / 1e9, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def queries(workload):
+    # (name, query) pairs run by the store and cluster suites.
+    middle = START + (workload.end - START) // 2
+    return [
+        ('range', f"SELECT * FROM cpu WHERE host=host{workload.series // 2} "
+                  f"TIME RANGE {iso(middle)} TO {iso(middle + 3600 * 10**9)}"),
+        ('filter', "SELECT value FROM cpu WHERE value > 95"),
+        ('aggregate', "SELECT MEAN(value), MAX(value), COUNT(count) FROM cpu"),
+        ('group_by_time', "SELECT MEAN(value) FROM cpu GROUP BY time(1h), region"),
+    ]
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+class Results:
+    def __init__(self):
+        self.metrics = {}  # name -> {'value', 'unit', 'better', 'gate'}
+        self.skipped = {}  # suite -> reason
+
+    def add(self, name, value, unit, better, gate=True):
+        # Only metrics with gate set can fail a baseline comparison.
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better, 'gate': gate}
+        print(f"  {name:42} {value:14.3f} {unit}")
+
+    def rate(self, name, count, seconds, unit='points/s'):
+        self.add(name, count / seconds, unit, 'higher')
+
+    def latencies(self, name, samples, unit='ms'):
+        # Tail percentiles of a few samples are too noisy to gate on.
+        scale = {'ms': 1e3, 'us': 1e6}[unit]
+        for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            self.add(f"{name}.{label}", percentile(samples, fraction) * scale, unit, 'lower', gate=label == 'p50')
+
+def check_latency_floor(prefix, medians):
+    low, high = DELAYED_ACK_FLOOR
+    if len(medians) > 1 and all(low <= median <= high for median in medians.values()):
+        raise RuntimeError(f"every {prefix} query took {low * 1e3:.0f}-{high * 1e3:.0f} ms "
+                           f"({', '.join(f'{name} {median * 1e3:.1f} ms' for name, median in medians.items())}); "
+                           f"the connection is waiting for delayed ACKs")
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def serve(handler, **attributes):
+    # Starts handler on a free local port without access logging.
+    quiet = type(handler.__name__, (handler,), {'log_message': lambda self, *args: None})
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), quiet)
+    for name, value in attributes.items():
+        setattr(httpd, name, value)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+def stop(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+def settle(tree):
+    # Flushes the memtables and waits for compaction to catch up.
+    tree.flush()
+    with tree.work_cond:
+        while tree.compaction_policy.pick(tree.levels) is not None:
+            tree.work_cond.wait(0.1)
+
+def start_storage(storage, directory, args):
+    block_cache = storage.BlockCache()
+    store = storage.TimeSeriesStore(directory=directory, block_cache=block_cache, memtable_size=args.memtable_size)
+    # A query cache that stores nothing, so repeated queries are measured.
+    query_cache = storage.QueryCache(max_bytes=0)
+    sql_tables = storage.MeasurementTables(store) if storage.MeasurementTables is not None else None
+
+    def on_change(measurement, low, high):
+        query_cache.invalidate(measurement, low, high)
+        if sql_tables is not None:
+            sql_tables.invalidate(measurement, low, high)
+
+    store.on_change = on_change
+    httpd, url = serve(storage.LSMDataHandler, store=store, query_cache=query_cache, block_cache=block_cache,
+                       sql_tables=sql_tables)
+    return store, httpd, url
+
+def run_queries(prefix, url, workload, args, results):
+    session = requests.Session()
+    medians = {}
+    for name, query in queries(workload):
+        def run():
+            response = session.get(url, params={'query': query})
+            response.raise_for_status()
+        run()  # Warm-up
+        samples = timed(run, args.repeat)
+        results.latencies(f"{prefix}.query.{name}", samples)
+        medians[name] = percentile(samples, 0.5)
+    session.close()
+    check_latency_floor(prefix, medians)
+
+def bench_lsm(workload, args, results, directory):
+    # LSMTree alone: batched writes, point lookups and a full scan.
+    storage = load_script('vm-storage-lsm')
+    tree = storage.LSMTree(directory=directory, memtable_size=args.memtable_size)
+    keys = [storage.encode_key('cpu', storage.series_key(workload.tags[i]), timestamp)
+            for i, timestamp, _, _ in workload.points]
+    items = [(key, storage.FLOAT.pack(value)) for key, (_, _, value, _) in zip(keys, workload.points)]
+    started = time.perf_counter()
+    for i in range(0, len(items), args.batch_size):
+        tree.write_batch(items[i:i + args.batch_size])
+    results.rate('lsm.ingest', len(items), time.perf_counter() - started)
+    started = time.perf_counter()
+    settle(tree)
+    results.add('lsm.flush_and_compact', time.perf_counter() - started, 's', 'lower')
+
+    rng = random.Random(args.seed)
+    hits = rng.sample(keys, min(args.lookups, len(keys)))
+    misses = [storage.encode_key('cpu', storage.series_key(workload.tags[0]), workload.end + i)
+              for i in range(len(hits))]
+    for name, lookups in (('hit', hits), ('miss', misses)):
+        samples = []
+        for key in lookups:
+            started = time.perf_counter()
+            tree.get(key)
+            samples.append(time.perf_counter() - started)
+        results.latencies(f"lsm.get.{name}", samples, 'us')
+
+    started = time.perf_counter()
+    count = sum(1 for _ in tree.scan())
+    results.rate('lsm.scan', count, time.perf_counter() - started, 'entries/s')
+    tree.close()
+
+def bench_store(workload, args, results, directory):
+    # TimeSeriesStore: parsing and writing batches in process, then queries
+    # through the storage node's HTTP handler.
+    storage = load_script('vm-storage-lsm')
+    store, httpd, url = start_storage(storage, directory, args)
+    try:
+        started = time.perf_counter()
+        for body in workload.bodies(args.batch_size):
+            points, _ = storage.parse_line_protocol(body, 0)
+            store.write(points)
+        results.rate('store.ingest', len(workload), time.perf_counter() - started)
+        for tree in store.open_partitions().values():
+            settle(tree)
+        run_queries('store', url, workload, args, results)
+        if httpd.sql_tables is not None:
+            run_sql_queries(storage, store, url, workload, args, results)
+    finally:
+        stop(httpd)
+        store.close()
+
+def run_sql_queries(storage, store, url, workload, args, results):
+    # /sql on the measurement table: materializing it from the chunks,
+    # queries, and a write to one chunk window followed by a query, which
+    # refreshes that window only.
+    session = requests.Session()
+
+    def sql(query):
+        session.get(f"{url}/sql", params={'query': query}).raise_for_status()
+
+    results.add('store.sql.materialize', timed(lambda: sql("SELECT host FROM cpu LIMIT 1"), 1)[0] * 1e3, 'ms', 'lower')
+    medians = {}
+    for name, query in (('filter', "SELECT host, time, value FROM cpu WHERE value > 95 AND region = 'r1'"),
+                        ('group_by', "SELECT region, AVG(value), MAX(count) FROM cpu GROUP BY region"),
+                        ('order_limit', "SELECT host, value FROM cpu ORDER BY time DESC LIMIT 10")):
+        samples = timed(lambda: sql(query), args.repeat)
+        results.latencies(f"store.sql.query.{name}", samples)
+        medians[name] = percentile(samples, 0.5)
+    check_latency_floor('store.sql', medians)
+    points, _ = storage.parse_line_protocol(workload.line(workload.points[-1]), 0)
+
+    def refresh():
+        store.write(points)
+        sql("SELECT host FROM cpu LIMIT 1")
+
+    results.latencies('store.sql.refresh', timed(refresh, args.repeat))
+    session.close()
+
+def bench_cluster(workload, args, results, directory):
+    # End to end over HTTP: writes through vm-insert until the storage node
+    # has them all, queries through vm-select.
+    storage = load_script('vm-storage-lsm')
+    insert = load_script('vm-insert')
+    select = load_script('vm-select')
+    store, storage_httpd, storage_url = start_storage(storage, directory, args)
+    cluster = insert.Cluster([storage_url], replication_factor=1)
+    insert_httpd, insert_url = serve(insert.InfluxDataHandler, cluster=cluster)
+    select_httpd, select_url = serve(select.QueryHandler, storage_nodes=[storage_url])
+    session = requests.Session()
+    try:
+        started = time.perf_counter()
+        for body in workload.bodies(args.batch_size):
+            while session.post(insert_url, data=body.encode()).status_code == 429:
+                time.sleep(0.01)
+        while True:
+            node = cluster.info()['nodes'][storage_url]
+            if node['lines_sent'] + node['dropped_lines'] >= len(workload):
+                break
+            time.sleep(0.001)
+        results.rate('cluster.ingest', node['lines_sent'], time.perf_counter() - started)
+        for tree in store.open_partitions().values():
+            settle(tree)
+        run_queries('cluster', select_url, workload, args, results)
+    finally:
+        session.close()
+        stop(select_httpd)
+        stop(insert_httpd)
+        cluster.close()
+        stop(storage_httpd)
+        store.close()
+
+def bench_vm_storage(workload, args, results, directory):
+    # The original storage node, backed by the lsm library. It opens its
+    # database in the working directory when loaded.
+    if importlib.util.find_spec('lsm') is None:
+        results.skipped['vm-storage'] = "the lsm library is not installed"
+        print("  skipped: the lsm library is not installed")
+        return
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        storage = load_script('vm-storage')
+        httpd, url = serve(storage.LSMDataHandler)
+        session = requests.Session()
+        started = time.perf_counter()
+        for body in workload.bodies(args.batch_size):
+            session.post(url, data=body.encode())
+        results.rate('vm-storage.ingest', len(workload), time.perf_counter() - started)
+        query = f"SELECT * FROM cpu WHERE host=host{workload.series // 2}"
+        results.latencies('vm-storage.query.filter', timed(lambda: session.get(url, params={'query': query}), args.repeat))
+        session.close()
+        stop(httpd)
+    finally:
+        os.chdir(cwd)
+
+def bench_sql(workload, args, results, directory):
+    # SQLLayer over a DataFrame holding the workload.
+    import pandas as pd
+    from sql_layer import SQLLayer
+    df = pd.DataFrame({
+        'host': [f'host{i}' for i, _, _, _ in workload.points],
+        'region': [f'r{i % 4}' for i, _, _, _ in workload.points],
+        'time': [timestamp for _, timestamp, _, _ in workload.points],
+        'value': [value for _, _, value, _ in workload.points],
+        'count': [count for _, _, _, count in workload.points],
+    })
+    columns = list(df.columns)
+    rows = list(df.itertuples(index=False, name=None))
+    sql_layer = SQLLayer(df.iloc[0:0], table_name='cpu')
+    started = time.perf_counter()
+    for i in range(0, len(rows), args.batch_size):
+        sql_layer.insert_many(rows[i:i + args.batch_size], columns)
+    len(sql_layer.df)  # Merges the append buffer
+    results.rate('sql.insert_many', len(rows), time.perf_counter() - started, 'rows/s')
+    started = time.perf_counter()
+    for row in rows[:1000]:
+        sql_layer.execute(f"INSERT INTO cpu (host, region, time, value, count) VALUES ('{row[0]}', '{row[1]}', {row[2]}, {row[3]}, {row[4]})")
+    results.rate('sql.insert', min(len(rows), 1000), time.perf_counter() - started, 'rows/s')
+
+    sql_layer = SQLLayer(df, table_name='cpu')
+    for name, query in (('filter', "SELECT host, value FROM cpu WHERE value > 95 AND region = 'r1'"),
+                        ('group_by', "SELECT region, AVG(value) FROM cpu GROUP BY region"),
+                        ('order_limit', "SELECT host, value FROM cpu ORDER BY value DESC LIMIT 10")):
+        results.latencies(f"sql.query.{name}", timed(lambda: sql_layer.execute(query), args.repeat))
+
+BENCHMARKS = {'lsm': bench_lsm, 'store': bench_store, 'cluster': bench_cluster,
+              'vm-storage': bench_vm_storage, 'sql': bench_sql}
+
+def compare(results, baseline, threshold):
+    # Prints the change of every metric in both runs; returns the names of
+    # those that got worse by more than threshold.
+    if baseline.get('config', {}).get('workload') != results['config']['workload']:
+        print("Warning: the baseline was run with a different workload")
+    regressions = []
+    print(f"\n{'metric':42} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, metric in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if old is None or not old['value']:
+            continue
+        change = (metric['value'] - old['value']) / old['value']
+        worse = -change if metric['better'] == 'higher' else change
+        status = ''
+        if worse > threshold and metric['gate']:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif worse > threshold:
+            status = 'slower'
+        elif -worse > threshold:
+            status = 'improved'
+        print(f"{name:42} {old['value']:14.3f} {metric['value']:14.3f} {change:+8.1%} {status}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the storage backends.")
+    parser.add_argument('--series', type=int, default=100, help="series cardinality")
+    parser.add_argument('--points', type=int, default=500, help="points per series")
+    parser.add_argument('--out-of-order', type=float, default=0.05, help="fraction of points that arrive late")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=5000, help="points per write")
+    parser.add_argument('--memtable-size', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=2000, help="point lookups per LSMTree.get measurement")
+    parser.add_argument('--repeat', type=int, default=20, help="runs per query")
+    parser.add_argument('--suites', default=','.join(SUITES), help=f"comma-separated, from {', '.join(SUITES)}")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.15, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    suites = args.suites.split(',')
+    for suite in suites:
+        if suite not in BENCHMARKS:
+            parser.error(f"unknown suite {suite!r}")
+    workload = Workload(args.series, args.points, args.out_of_order, args.seed)
+    results = Results()
+    for suite in suites:
+        print(f"{suite}:")
+        directory = tempfile.mkdtemp(prefix=f'vm-benchmark-{suite}-')
+        try:
+            BENCHMARKS[suite](workload, args, results, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'config': {
+            'workload': {'series': args.series, 'points': args.points, 'out_of_order': args.out_of_order,
+                         'seed': args.seed},
+            'batch_size': args.batch_size,
+            'memtable_size': args.memtable_size,
+            'repeat': args.repeat,
+            'suites': suites,
+        },
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'results': results.metrics,
+        'skipped': results.skipped,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# VM_LOG_LEVEL=debug turns on the per-request prints and database dumps.
+DEBUG = os.environ.get('VM_LOG_LEVEL', 'info').lower() == 'debug'
+
+def debug(message):
+    if DEBUG:
+        print(message)
+
+class Metrics:
+    # Counters and latency histograms for one process, rendered in the
+    # Prometheus text format for /metrics. A series is a metric name plus a
+    # sorted tuple of label pairs.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, descriptions=None):
+        self.descriptions = descriptions or {}  # name -> HELP text
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, count, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self, samples=()):
+        # samples are extra (name, type, labels, value) read at scrape time,
+        # such as queue depths and cache sizes kept elsewhere.
+        families = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                families.setdefault((name, 'counter'), []).append((name, labels, value))
+            for (name, labels), (buckets, count, total) in self.histograms.items():
+                series = families.setdefault((name, 'histogram'), [])
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS + ('+Inf',), buckets):
+                    cumulative += bucket
+                    series.append((f"{name}_bucket", labels + (('le', bound),), cumulative))
+                series.append((f"{name}_sum", labels, total))
+                series.append((f"{name}_count", labels, count))
+        for name, kind, labels, value in samples:
+            if value is not None:
+                families.setdefault((name, kind), []).append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for (name, kind), series in sorted(families.items()):
+            if name in self.descriptions:
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in series:
+                if labels:
+                    sample += '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+                lines.append(f"{sample} {float(value)!r}" if isinstance(value, float) else f"{sample} {int(value)}")
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class QueryProfile:
+    # Wall time per stage of one query. Lazy stages are charged only for the
+    # time spent pulling results through them, so a streamed query is split
+    # between execution, encoding and sending.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def timed(self, name, results):
+        results = iter(results)
+        while True:
+            started = time.perf_counter()
+            try:
+                result = next(results)
+            except StopIteration:
+                self.add(name, time.perf_counter() - started)
+                return
+            self.add(name, time.perf_counter() - started)
+            yield result
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def record(self, metrics, name):
+        for stage, seconds in self.stages.items():
+            metrics.observe(name, seconds, stage=stage)
+
+    def server_timing(self):
+        # Server-Timing header value, durations in milliseconds.
+        return ', '.join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items())
+
+def cprofile_call(function, limit=40):
+    # Runs function under cProfile; returns its result and the statistics of
+    # the limit most expensive calls by cumulative time.
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+    return result, output.getvalue()
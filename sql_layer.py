@@ -4,16 +4,472 @@ import re
 import numpy as np
 
 import pandas as pd
+import math
 import numpy as np
+import operator
 import re
+import threading
 import time
 import random
 
 
-class SQLLayer:
-    def __init__(self, df, table_name='table'):
+WHERE_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)(?![A-Za-z_])
+    |(?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+    |(?P<op>>=|<=|!=|<>|=|>|<|\(|\)|,)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_.-]*)
+)""", re.VERBOSE)
+WHERE_KEYWORDS = {'AND', 'OR', 'NOT', 'IN', 'BETWEEN', 'IS', 'NULL', 'LIKE'}
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+# Guessed fraction of rows a predicate keeps when the column's values are
+# not known, used to order the operands of AND and OR.
+COMPARISON_SELECTIVITY = {'=': 0.05, '!=': 0.95, '<': 0.3, '<=': 0.3, '>': 0.3, '>=': 0.3}
+
+def tokenize_where(text):
+    # (kind, value) pairs; kind is number, string, op, word or keyword.
+    tokens = []
+    text = text.strip()
+    pos = 0
+    while pos < len(text):
+        match = WHERE_TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f"Unexpected text in WHERE clause: {text[pos:pos + 20]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if any(c in value for c in '.eE') else int(value)
+        elif kind == 'string':
+            value = value[1:-1].replace(value[0] * 2, value[0])
+        elif kind == 'op' and value == '<>':
+            value = '!='
+        elif kind == 'word' and value.upper() in WHERE_KEYWORDS:
+            kind, value = 'keyword', value.upper()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+def like_pattern(pattern):
+    # SQL LIKE: % matches any run of characters, _ any single character.
+    return re.compile(''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in pattern), re.DOTALL)
+
+class WhereParser:
+    # Recursive descent over the WHERE tokens. OR binds looser than AND, and
+    # AND looser than NOT. The tree is made of tuples:
+    #   ('or', [nodes]), ('and', [nodes]), ('not', node),
+    #   ('compare', column, op, value), ('in', column, values),
+    #   ('between', column, low, high), ('null', column), ('like', column, pattern)
+    # A bare word where a value is expected is a string, as in host=server01.
+    def __init__(self, text):
+        self.tokens = tokenize_where(text)
+        self.pos = 0
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.pos][1]!r} in WHERE clause")
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, kind, value):
+        if self.peek() == (kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value):
+        if not self.accept(kind, value):
+            found = self.peek()[1]
+            raise ValueError(f"Expected {value} in WHERE clause, found {'end of clause' if found is None else repr(found)}")
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.accept('keyword', 'OR'):
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.accept('keyword', 'AND'):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not(self):
+        if self.accept('keyword', 'NOT'):
+            return ('not', self.parse_not())
+        if self.accept('op', '('):
+            node = self.parse_or()
+            self.expect('op', ')')
+            return node
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        kind, column = self.peek()
+        if kind != 'word':
+            raise ValueError(f"Expected a column name in WHERE clause, found {'end of clause' if column is None else repr(column)}")
+        self.pos += 1
+        if self.accept('keyword', 'IS'):
+            negated = self.accept('keyword', 'NOT')
+            self.expect('keyword', 'NULL')
+            return ('not', ('null', column)) if negated else ('null', column)
+        negated = self.accept('keyword', 'NOT')
+        if self.accept('keyword', 'IN'):
+            self.expect('op', '(')
+            values = [self.parse_value()]
+            while self.accept('op', ','):
+                values.append(self.parse_value())
+            self.expect('op', ')')
+            node = ('in', column, values)
+        elif self.accept('keyword', 'BETWEEN'):
+            low = self.parse_value()
+            self.expect('keyword', 'AND')
+            node = ('between', column, low, self.parse_value())
+        elif self.accept('keyword', 'LIKE'):
+            node = ('like', column, str(self.parse_value()))
+        elif not negated and self.peek()[0] == 'op' and self.peek()[1] in COMPARISONS:
+            op = self.tokens[self.pos][1]
+            self.pos += 1
+            node = ('compare', column, op, self.parse_value())
+        else:
+            raise ValueError(f"Expected an operator after {column!r} in WHERE clause")
+        return ('not', node) if negated else node
+
+    def parse_value(self):
+        kind, value = self.peek()
+        if kind not in ('number', 'string', 'word'):
+            raise ValueError(f"Expected a value in WHERE clause, found {'end of clause' if value is None else repr(value)}")
+        self.pos += 1
+        return value
+
+class WhereEvaluator:
+    # Evaluates a WHERE tree against one frame into a boolean array. AND and
+    # OR evaluate their operands in order of selectivity (most selective
+    # first for AND, least for OR), each only on the rows whose outcome is
+    # still open, and stop once none are. String columns go through
+    # categorical codes: a predicate is evaluated once per distinct value and
+    # the result is gathered by code, which also gives exact selectivities.
+    # NULLs never satisfy a comparison, IN, BETWEEN or LIKE, nor their NOT.
+    def __init__(self, df, categoricals):
         self.df = df
+        self.categoricals = categoricals  # column -> (frame, codes, categories, counts), shared by queries
+
+    def evaluate(self, node, rows=None):
+        # rows: positions to evaluate, or None for every row.
+        kind = node[0]
+        if kind in ('and', 'or'):
+            return self.combine(node[1], rows, kind == 'and')
+        if kind == 'not':
+            mask = ~self.evaluate(node[1], rows)
+            if node[1][0] in ('compare', 'in', 'between', 'like'):
+                # NOT of a predicate on a NULL is still not true.
+                mask &= self.present(node[1][1], rows)
+            return mask
+        return self.predicate(node, rows)
+
+    def combine(self, nodes, rows, all_of):
+        size = len(self.df) if rows is None else len(rows)
+        nodes = sorted(nodes, key=self.selectivity, reverse=not all_of)
+        result = np.full(size, all_of)
+        for node in nodes:
+            undecided = result if all_of else ~result
+            count = np.count_nonzero(undecided)
+            if count == 0:
+                break
+            if count * 2 > size:
+                # Most rows are still open; gathering them would cost more
+                # than evaluating every row.
+                mask = self.evaluate(node, rows)
+                result = result & mask if all_of else result | mask
+            else:
+                positions = np.flatnonzero(undecided)
+                result[positions] = self.evaluate(node, positions if rows is None else rows[positions])
+        return result
+
+    def selectivity(self, node):
+        kind = node[0]
+        if kind == 'and':
+            return float(np.prod([self.selectivity(child) for child in node[1]]))
+        if kind == 'or':
+            return min(1.0, sum(self.selectivity(child) for child in node[1]))
+        if kind == 'not':
+            return 1.0 - self.selectivity(node[1])
+        self.column(node[1])
+        if self.is_categorical(node[1]):
+            _, _, categories, counts = self.categorical(node[1])
+            matches = self.test(node, categories, categories)
+            return float(counts[:-1][matches].sum() + (counts[-1] if kind == 'null' else 0)) / max(len(self.df), 1)
+        if kind == 'compare':
+            return COMPARISON_SELECTIVITY[node[2]]
+        if kind == 'in':
+            return min(1.0, 0.05 * len(node[2]))
+        if kind == 'between':
+            return 0.25
+        if kind == 'null':
+            return 0.05
+        return 0.1 if not node[2].startswith('%') else 0.25
+
+    def column(self, name):
+        if name in self.df.columns:
+            return self.df[name]
+        if name == self.df.index.name:
+            return pd.Series(self.df.index.to_numpy(), name=name)
+        raise ValueError(f"Unknown column {name!r} in WHERE clause")
+
+    def is_categorical(self, name):
+        dtype = self.column(name).dtype
+        return isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(dtype) \
+            or pd.api.types.is_string_dtype(dtype)
+
+    def categorical(self, name):
+        # Codes are computed once per frame and column; code -1 is NULL and
+        # counts[-1] the number of NULLs.
+        cached = self.categoricals.get(name)
+        if cached is not None and cached[0] is self.df:
+            return cached
+        series = self.column(name)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.cat.codes.to_numpy()
+            categories = np.asarray(series.cat.categories, dtype=object)
+        else:
+            codes, categories = pd.factorize(series)
+            categories = np.asarray(categories, dtype=object)
+        counts = np.bincount(codes + 1, minlength=len(categories) + 1)
+        counts = np.append(counts[1:], counts[0])
+        self.categoricals[name] = cached = (self.df, codes, categories, counts)
+        return cached
+
+    def present(self, name, rows):
+        if self.is_categorical(name):
+            codes = self.categorical(name)[1]
+            return (codes if rows is None else codes[rows]) >= 0
+        values = self.column(name).to_numpy()
+        return ~np.asarray(pd.isna(values if rows is None else values[rows]), dtype=bool)
+
+    def predicate(self, node, rows):
+        name = node[1]
+        series = self.column(name)
+        if self.is_categorical(name):
+            _, codes, categories, _ = self.categorical(name)
+            matches = np.append(self.test(node, categories, categories), node[0] == 'null')
+            return matches[codes if rows is None else codes[rows]]
+        values = series.to_numpy()
+        if rows is not None:
+            values = values[rows]
+        return self.test(node, values, values)
+
+    def test(self, node, values, sample):
+        # sample decides how literals are coerced: strings for string
+        # values, numbers (or timestamps) for numeric ones.
+        kind = node[0]
+        if kind == 'null':
+            return np.asarray(pd.isna(values), dtype=bool)
+        present = ~np.asarray(pd.isna(values), dtype=bool)
+        if kind == 'like':
+            pattern = like_pattern(node[2])
+            return np.fromiter((isinstance(value, str) and pattern.fullmatch(value) is not None for value in values),
+                               dtype=bool, count=len(values))
+        if kind == 'compare':
+            result = COMPARISONS[node[2]](values, self.coerce(node[3], sample))
+        elif kind == 'in':
+            result = np.isin(values, [self.coerce(value, sample) for value in node[2]])
+        else:
+            low, high = self.coerce(node[2], sample), self.coerce(node[3], sample)
+            result = (values >= low) & (values <= high)
+        return np.asarray(result, dtype=bool) & present
+
+    @staticmethod
+    def coerce(value, sample):
+        dtype = sample.dtype
+        if dtype.kind == 'M':
+            return pd.Timestamp(value).to_datetime64()
+        if dtype.kind == 'b' and isinstance(value, str):
+            return value.lower() in ('true', 't', '1')
+        if dtype.kind in 'iuf':
+            if isinstance(value, str):
+                try:
+                    return float(value)
+                except ValueError:
+                    raise ValueError(f"Cannot compare a numeric column with {value!r}")
+            return value
+        inferred = pd.api.types.infer_dtype(sample, skipna=True)
+        if inferred in ('string', 'empty') and not isinstance(value, str):
+            return str(value)
+        if inferred in ('integer', 'floating', 'mixed-integer-float') and isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                return value
+        return value
+
+
+def parse_insert_values(text):
+    # Rows of an INSERT VALUES list: (1, 'a', NULL), (2, 'b', 3.5)
+    tokens = tokenize_where(text)
+    rows = []
+    pos = 0
+    while True:
+        if tokens[pos:pos + 1] != [('op', '(')]:
+            raise ValueError("Expected ( to start a row of VALUES")
+        pos += 1
+        row = []
+        while True:
+            if pos >= len(tokens):
+                raise ValueError("Unterminated row in VALUES")
+            kind, value = tokens[pos]
+            if kind in ('number', 'string', 'word'):
+                row.append(value)
+            elif (kind, value) == ('keyword', 'NULL'):
+                row.append(None)
+            else:
+                raise ValueError(f"Expected a value in VALUES, found {value!r}")
+            pos += 1
+            if tokens[pos:pos + 1] == [('op', ',')]:
+                pos += 1
+            elif tokens[pos:pos + 1] == [('op', ')')]:
+                pos += 1
+                break
+            else:
+                raise ValueError("Expected , or ) in VALUES")
+        rows.append(row)
+        if pos == len(tokens):
+            return rows
+        if tokens[pos] != ('op', ','):
+            raise ValueError(f"Unexpected {tokens[pos][1]!r} after a row of VALUES")
+        pos += 1
+
+
+class SQLLayer:
+    # Inserted rows are typed to the table's columns and collected in an
+    # append buffer of per-column lists, merged into the frame with a single
+    # concat once it holds append_buffer_rows rows or before the next query.
+    # DELETE only marks rows in a tombstone mask; they are dropped from the
+    # frame once they make up compact_ratio of it, or when df is read.
+    def __init__(self, df, table_name='table', append_buffer_rows=100000, compact_ratio=0.25):
         self.table_name = table_name
+        self.append_buffer_rows = append_buffer_rows
+        self.compact_ratio = compact_ratio
+        self._where_trees = {}  # WHERE clause -> parsed tree
+        self._categoricals = {}  # column -> categorical codes of the current frame
+        self.df = df
+
+    @property
+    def df(self):
+        # The table with buffered inserts merged and deleted rows dropped.
+        self._merge_appends()
+        self._compact(force=True)
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+        self._append_buffer = {}  # column -> values of the buffered rows
+        self._buffered_rows = 0
+        self._deleted = None  # Tombstone mask over the rows of _df
+
+    def insert_many(self, rows, columns=None):
+        # rows are dicts, or sequences of values for columns. Columns left
+        # out are NULL. Returns the number of rows inserted.
+        table_columns = list(self._df.columns)
+        dtypes = self._df.dtypes.to_dict()
+        if columns is not None:
+            unknown = [column for column in columns if column not in dtypes]
+            if unknown:
+                raise ValueError(f"Unknown columns for {self.table_name}: {', '.join(unknown)}")
+        typed_rows = []
+        for row in rows:
+            if columns is not None:
+                if len(row) != len(columns):
+                    raise ValueError("Number of columns doesn't match number of values")
+                row = dict(zip(columns, row))
+            elif not isinstance(row, dict):
+                row = dict(zip(table_columns, row))
+            for column in row:
+                if column not in dtypes:
+                    raise ValueError(f"Unknown column for {self.table_name}: {column}")
+            typed_rows.append([self._coerce(column, dtypes[column], row.get(column)) for column in table_columns])
+        # Rows are only buffered once all of them are valid.
+        if not self._append_buffer:
+            self._append_buffer = {column: [] for column in table_columns}
+        for values in typed_rows:
+            for column, value in zip(table_columns, values):
+                self._append_buffer[column].append(value)
+        self._buffered_rows += len(typed_rows)
+        if self._buffered_rows >= self.append_buffer_rows:
+            self._merge_appends()
+        return len(typed_rows)
+
+    @staticmethod
+    def _coerce(column, dtype, value):
+        if value is None:
+            return None
+        try:
+            if isinstance(dtype, pd.CategoricalDtype):
+                categories = dtype.categories
+                return str(value) if categories.empty or pd.api.types.is_string_dtype(categories) else value
+            if dtype.kind in 'iu':
+                if isinstance(value, str):
+                    value = float(value) if any(c in value for c in '.eE') else int(value)
+                if isinstance(value, float):
+                    if not value.is_integer():
+                        raise ValueError("not an integer")
+                    value = int(value)
+                return int(value)
+            if dtype.kind == 'f':
+                return float(value)
+            if dtype.kind == 'b':
+                if isinstance(value, str):
+                    if value.lower() not in ('true', 'false', 't', 'f', '1', '0'):
+                        raise ValueError("not a boolean")
+                    return value.lower() in ('true', 't', '1')
+                return bool(value)
+            if dtype.kind == 'M':
+                return pd.Timestamp(value)
+            if pd.api.types.is_string_dtype(dtype) and not pd.api.types.is_object_dtype(dtype):
+                return str(value)
+            return value
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"Invalid value {value!r} for column {column} ({dtype})")
+
+    def _merge_appends(self):
+        if not self._buffered_rows:
+            return
+        new_rows = {}
+        frame = self._df
+        for column, values in self._append_buffer.items():
+            dtype = frame[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                # Adding categories keeps the existing codes, so the column
+                # stays categorical through the concat.
+                added = pd.Index(pd.unique(pd.Series([value for value in values if value is not None], dtype=object)))
+                added = added.difference(dtype.categories)
+                if len(added):
+                    frame = frame.assign(**{column: frame[column].cat.add_categories(added)})
+                new_rows[column] = pd.Categorical(values, categories=frame[column].cat.categories)
+                continue
+            if dtype.kind in 'iu' and any(value is None for value in values):
+                dtype = np.float64
+            elif dtype.kind == 'b' and any(value is None for value in values):
+                dtype = object
+            new_rows[column] = pd.Series(values, dtype=dtype)
+        merged = pd.concat([frame, pd.DataFrame(new_rows)], ignore_index=True)
+        if self._deleted is not None:
+            self._deleted = np.concatenate([self._deleted, np.zeros(self._buffered_rows, dtype=bool)])
+        self._df = merged
+        self._append_buffer = {}
+        self._buffered_rows = 0
+
+    def _compact(self, force=False):
+        # Drops the tombstoned rows from the frame.
+        if self._deleted is None:
+            return
+        deleted = int(np.count_nonzero(self._deleted))
+        if deleted and (force or deleted >= self.compact_ratio * len(self._df)):
+            self._df = self._df[~self._deleted]
+            self._deleted = None
+        elif not deleted:
+            self._deleted = None
 
     def execute(self, query):
         query_type = query.split()[0].upper()
@@ -41,11 +497,31 @@ class SQLLayer:
         if table_name.lower() != self.table_name.lower():
             raise ValueError(f"Invalid table name. Expected '{self.table_name}', got '{table_name}'")
 
-        result = self.df
+        self._merge_appends()
+        result = self._df
+
+        # Process WHERE clause using vectorized operations; deleted rows are
+        # dropped with the same mask.
+        mask = self._vectorized_where(where_clause, result) if where_clause else None
+        if self._deleted is not None:
+            mask = ~self._deleted if mask is None else mask & ~self._deleted
+        if mask is not None:
+            result = result[mask]
+        if result.index.name is not None:
+            # A named index (such as the time of a measurement table) is
+            # selected, grouped and ordered like any other column.
+            result = result.reset_index()
 
-        # Process WHERE clause using vectorized operations
-        if where_clause:
-            result = result[self._vectorized_where(where_clause)]
+        select_cols = [col.strip() for col in select_clause.split(',')]
+        if order_by_clause:
+            order_cols = [col.strip() for col in order_by_clause.split(',')]
+            ascending = [not col.endswith(' DESC') for col in order_cols]
+            order_cols = [col.replace(' ASC', '').replace(' DESC', '') for col in order_cols]
+            # Without GROUP BY, rows can be ordered by columns that are not
+            # selected, such as ORDER BY time.
+            if not group_by_clause and not set(order_cols) <= set(select_cols):
+                result = result.sort_values(order_cols, ascending=ascending)
+                order_by_clause = None
 
         # Process GROUP BY clause
         if group_by_clause:
@@ -53,14 +529,10 @@ class SQLLayer:
             result = self._vectorized_group_by(result, group_cols, select_clause)
         
         # Process SELECT clause
-        select_cols = [col.strip() for col in select_clause.split(',')]
         result = self._vectorized_select(result, select_cols)
 
         # Process ORDER BY clause
         if order_by_clause:
-            order_cols = [col.strip() for col in order_by_clause.split(',')]
-            ascending = [not col.endswith(' DESC') for col in order_cols]
-            order_cols = [col.replace(' ASC', '').replace(' DESC', '') for col in order_cols]
             result = result.sort_values(order_cols, ascending=ascending)
 
         # Process LIMIT clause
@@ -69,79 +541,62 @@ class SQLLayer:
 
         return result
 
-    def _vectorized_where(self, condition):
-        def parse_condition(cond):
-            parts = re.split(r'(=|!=|>|<|>=|<=|AND|OR)', cond)
-            parts = [part.strip() for part in parts if part.strip()]
-            return parts
-
-        def apply_condition(left, op, right):
-            if op == '=':
-                return self.df[left] == right
-            elif op == '!=':
-                return self.df[left] != right
-            elif op == '>':
-                return self.df[left] > float(right)
-            elif op == '<':
-                return self.df[left] < float(right)
-            elif op == '>=':
-                return self.df[left] >= float(right)
-            elif op == '<=':
-                return self.df[left] <= float(right)
-
-        parts = parse_condition(condition)
-        result = None
-        i = 0
-        while i < len(parts):
-            if parts[i] in self.df.columns:
-                left, op, right = parts[i:i+3]
-                if right.startswith("'") and right.endswith("'"):
-                    right = right[1:-1]  # Remove quotes for string values
-                condition_result = apply_condition(left, op, right)
-                if result is None:
-                    result = condition_result
-                else:
-                    if parts[i-1] == 'AND':
-                        result = result & condition_result
-                    elif parts[i-1] == 'OR':
-                        result = result | condition_result
-                i += 3
-            else:
-                i += 1
-
-        return result
+    def _vectorized_where(self, condition, df=None):
+        # Boolean mask of the rows of df (the table by default) matching the
+        # WHERE clause. Parsed clauses are kept for repeated queries.
+        tree = self._where_trees.get(condition)
+        if tree is None:
+            if len(self._where_trees) >= 1000:
+                self._where_trees.clear()
+            tree = self._where_trees[condition] = WhereParser(condition).parse()
+        return WhereEvaluator(self._df if df is None else df, self._categoricals).evaluate(tree)
 
     def _vectorized_group_by(self, df, group_cols, select_clause):
         agg_funcs = {'SUM': 'sum', 'AVG': 'mean', 'MIN': 'min', 'MAX': 'max', 'COUNT': 'count'}
-        agg_dict = {}
+        agg_dict = {}  # Output column, named as selected -> (column, function)
 
         for col in select_clause.split(','):
             col = col.strip()
             for func in agg_funcs:
-                if col.upper().startswith(func):
+                if col.upper().startswith(func + '('):
                     col_name = col[len(func)+1:-1]  # Remove function name and parentheses
-                    agg_dict[col_name] = agg_funcs[func]
+                    agg_dict[col] = (col_name, agg_funcs[func])
                     break
             else:
                 if col not in group_cols:
-                    agg_dict[col] = 'first'
+                    agg_dict[col] = (col, 'first')
 
-        return df.groupby(group_cols).agg(agg_dict).reset_index()
+        # observed=True leaves out combinations of categories with no rows.
+        grouped = df.groupby(group_cols, observed=True)
+        if not agg_dict:
+            return grouped.size().reset_index()[group_cols]
+        return grouped.agg(**agg_dict).reset_index()
 
     def _vectorized_select(self, df, select_cols):
-        agg_funcs = {'SUM': np.sum, 'AVG': np.mean, 'MIN': np.min, 'MAX': np.max, 'COUNT': np.count_nonzero}
-        
-        result = pd.DataFrame()
+        agg_funcs = {'SUM': 'sum', 'AVG': 'mean', 'MIN': 'min', 'MAX': 'max', 'COUNT': 'count'}
+
+        columns = {}
         for col in select_cols:
+            if col == '*':
+                for name in df.columns:
+                    columns[name] = df[name]
+                continue
+            if col in df.columns:
+                # Plain columns, and aggregates already computed by GROUP BY
+                columns[col] = df[col]
+                continue
             for func in agg_funcs:
-                if col.upper().startswith(func):
+                if col.upper().startswith(func + '('):
                     col_name = col[len(func)+1:-1]  # Remove function name and parentheses
-                    result[col] = agg_funcs[func](df[col_name])
+                    columns[col] = df[col_name].agg(agg_funcs[func])
                     break
             else:
-                result[col] = df[col]
-        
-        return result
+                columns[col] = df[col]
+
+        if columns and not any(isinstance(values, pd.Series) for values in columns.values()):
+            # Aggregates without GROUP BY give a single row.
+            return pd.DataFrame({col: [value] for col, value in columns.items()})
+        return pd.DataFrame(columns)
 
     def _execute_delete(self, query):
         match = re.match(r'DELETE FROM (.*?)(?: WHERE (.*))?$', query, re.IGNORECASE)
@@ -154,18 +609,23 @@ class SQLLayer:
         if from_clause.strip().lower() != self.table_name.lower():
             raise ValueError(f"Only '{self.table_name}' is supported in the FROM clause")
 
+        self._merge_appends()
         if where_clause:
             mask = self._vectorized_where(where_clause)
-            rows_deleted = (~mask).sum()
-            self.df = self.df[mask]
+            if self._deleted is not None:
+                mask &= ~self._deleted
+            rows_deleted = int(np.count_nonzero(mask))
+            self._deleted = mask if self._deleted is None else self._deleted | mask
+            self._compact()
         else:
-            rows_deleted = len(self.df)
-            self.df = self.df.iloc[0:0]
+            rows_deleted = len(self._df) - (int(np.count_nonzero(self._deleted)) if self._deleted is not None else 0)
+            self._df = self._df.iloc[0:0]
+            self._deleted = None
 
         return f"Deleted {rows_deleted} rows from {self.table_name}"
 
     def _execute_insert(self, query):
-        match = re.match(r'INSERT INTO (.*?) \((.*?)\) VALUES \((.*?)\)$', query, re.IGNORECASE)
+        match = re.match(r'INSERT INTO (.*?) \((.*?)\) VALUES\s*(\(.*\))\s*$', query, re.IGNORECASE | re.DOTALL)
         
         if not match:
             raise ValueError("Invalid INSERT query format")
@@ -176,22 +636,188 @@ class SQLLayer:
             raise ValueError(f"Only '{self.table_name}' is supported in the INTO clause")
 
         columns = [col.strip() for col in columns.split(',')]
-        values = [val.strip() for val in values.split(',')]
-
-        if len(columns) != len(values):
-            raise ValueError("Number of columns doesn't match number of values")
-
-        new_row = pd.DataFrame([dict(zip(columns, values))])
-        self.df = pd.concat([self.df, new_row], ignore_index=True)
+        count = self.insert_many(parse_insert_values(values), columns)
+
+        return f"Inserted {count} row{'s' if count != 1 else ''} into {self.table_name}"
+
+def series_tags(series):
+    # Tags of a series key as written by vm-storage-lsm.py: k1=v1,k2=v2.
+    return dict(tag.split('=', 1) for tag in series.split(',') if '=' in tag)
+
+def measurement_frame(chunks):
+    # One row per point of the (series, Chunk) pairs, indexed by the int64
+    # timestamp. Tags become categorical columns. Fields that are integers
+    # in every chunk stay int64 (float64 once a point lacks them), floats
+    # are float64, booleans bool (object with NULLs) and anything else is
+    # an object column of strings.
+    series_keys = []
+    lengths = []
+    times = []
+    fields = {}  # field -> chunk number -> (kind, values)
+    for number, (series, chunk) in enumerate(chunks):
+        series_keys.append(series)
+        lengths.append(len(chunk))
+        times.append(np.frombuffer(chunk.timestamps, dtype=np.int64))
+        for name, column in chunk.fields.items():
+            fields.setdefault(name, {})[number] = column
+    index = pd.Index(np.concatenate(times) if times else np.empty(0, dtype=np.int64), name='time')
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    total = int(offsets[-1])
+
+    columns = {}
+    chunk_tags = [series_tags(series) for series in series_keys]
+    for key in sorted({key for tags in chunk_tags for key in tags}):
+        categories = sorted({tags[key] for tags in chunk_tags if key in tags})
+        code = {value: i for i, value in enumerate(categories)}
+        codes = np.array([code.get(tags.get(key), -1) for tags in chunk_tags], dtype=np.int32)
+        columns[key] = pd.Categorical.from_codes(np.repeat(codes, lengths), categories=categories)
+
+    for name, by_chunk in fields.items():
+        if name in columns:
+            continue  # A tag of the same name wins
+        kinds = {kind for kind, _ in by_chunk.values()}
+        if kinds == {'i'} and len(by_chunk) == len(lengths) \
+                and not any(None in chunk_values for _, chunk_values in by_chunk.values()):
+            values = np.empty(total, dtype=np.int64)
+            for number, (_, chunk_values) in by_chunk.items():
+                values[offsets[number]:offsets[number + 1]] = np.asarray(chunk_values, dtype=np.int64)
+        elif kinds <= {'f', 'i'}:
+            values = np.full(total, np.nan)
+            for number, (kind, chunk_values) in by_chunk.items():
+                if kind == 'i':
+                    chunk_values = [np.nan if value is None else value for value in chunk_values]
+                values[offsets[number]:offsets[number + 1]] = np.asarray(chunk_values, dtype=np.float64)
+        else:
+            values = np.full(total, None, dtype=object)
+            for number, (kind, chunk_values) in by_chunk.items():
+                if kind == 'f':
+                    chunk_values = [None if math.isnan(value) else value for value in chunk_values]
+                if kinds != {'b'}:
+                    chunk_values = [None if value is None else str(value) for value in chunk_values]
+                values[offsets[number]:offsets[number + 1]] = chunk_values
+            if kinds == {'b'} and len(by_chunk) == len(lengths) and not pd.isna(values).any():
+                values = values.astype(bool)
+        columns[name] = values
+    return pd.DataFrame(columns, index=index)
+
+def concat_frames(frames):
+    # pd.concat for measurement tables: categorical columns keep their codes
+    # under the union of the categories, and columns missing from a frame
+    # are NULL in its rows.
+    names = list(dict.fromkeys(name for frame in frames for name in frame.columns))
+    columns = {}
+    for name in names:
+        parts = [frame[name] if name in frame.columns else None for frame in frames]
+        dtype = next((part.dtype for part in parts
+                      if part is not None and isinstance(part.dtype, pd.CategoricalDtype)), None)
+        if dtype is not None:
+            categoricals = []
+            for part, frame in zip(parts, frames):
+                if part is None:
+                    part = pd.Categorical.from_codes(np.full(len(frame), -1), categories=dtype.categories)
+                elif isinstance(part.dtype, pd.CategoricalDtype):
+                    part = part.array
+                else:
+                    part = pd.Categorical(part)
+                categoricals.append(part)
+            columns[name] = pd.api.types.union_categoricals(categoricals, sort_categories=True)
+        else:
+            columns[name] = pd.concat([pd.Series(np.nan, index=frame.index) if part is None else part
+                                       for part, frame in zip(parts, frames)], ignore_index=True).to_numpy()
+    index = pd.Index(np.concatenate([frame.index.to_numpy() for frame in frames]), name='time')
+    return pd.DataFrame(columns, index=index)
+
+class MeasurementTables:
+    # Measurements of a TimeSeriesStore (vm-storage-lsm.py) as SQL tables
+    # served by SQLLayer, one per measurement. A table is materialized from
+    # the store's chunks the first time it is queried and then kept. Hook
+    # invalidate into the store's on_change: it only records the time range
+    # that was written or deleted, and the next query of the table rescans
+    # just the chunk windows overlapping those ranges and swaps their rows,
+    # so new points and deletes are picked up without decoding the rest of
+    # the table again. Tables are read-only; data is written through the
+    # line protocol.
+    def __init__(self, store):
+        self.store = store
+        self.tables = {}  # measurement -> [SQLLayer or None, pending (low, high) ranges, lock]
+        self.lock = threading.Lock()
+        self.stats = {'materialized': 0, 'refreshes': 0, 'rows_rescanned': 0}
+
+    def invalidate(self, measurement, low, high):
+        # measurement None is a dropped partition, which touches every table.
+        with self.lock:
+            for name, table in self.tables.items():
+                if measurement in (None, name):
+                    table[1].append((low, high))
 
-        return f"Inserted 1 row into {self.table_name}"
+    def execute(self, query):
+        if query.split()[0].upper() != 'SELECT':
+            raise ValueError("Measurement tables are read-only; only SELECT is supported")
+        match = re.search(r'\bFROM\s+(\w+)', query, re.IGNORECASE)
+        if not match:
+            raise ValueError("Invalid SELECT query format")
+        measurement = match.group(1)
+        with self.lock:
+            table = self.tables.get(measurement)
+            if table is None:
+                if not self.store.index.lookup(measurement, None):
+                    raise ValueError(f"Unknown measurement: {measurement}")
+                table = self.tables[measurement] = [None, [], threading.Lock()]
+        with table[2]:
+            self._refresh(measurement, table)
+            return table[0].execute(query)
+
+    def _refresh(self, measurement, table):
+        # Called with the table's lock held. Pending ranges are taken before
+        # the scan takes its snapshot, so a write racing the refresh is
+        # rescanned by the next one.
+        with self.lock:
+            pending, table[1] = table[1], []
+        if table[0] is None:
+            table[0] = SQLLayer(measurement_frame(self.store.scan(measurement)), measurement)
+            self.stats['materialized'] += 1
+            return
+        if not pending:
+            return
+        if any(low is None and high is None for low, high in pending):
+            table[0].df = measurement_frame(self.store.scan(measurement))
+            self.stats['refreshes'] += 1
+            return
+        # Whole chunk windows are rescanned, since a rewritten chunk can
+        # have lost points anywhere in its window.
+        duration = self.store.chunk_duration
+        windows = []
+        spans = [(self.store.chunk_start(low) if low is not None else None,
+                  self.store.chunk_start(high) + duration - 1 if high is not None else None)
+                 for low, high in pending]
+        for low, high in sorted(spans, key=lambda span: -math.inf if span[0] is None else span[0]):
+            if windows and (windows[-1][1] is None or low is None or low <= windows[-1][1] + 1):
+                windows[-1][1] = None if high is None or windows[-1][1] is None else max(high, windows[-1][1])
+            else:
+                windows.append([low, high])
+        frame = table[0].df
+        times = frame.index.to_numpy()
+        keep = np.ones(len(frame), dtype=bool)
+        parts = []
+        for low, high in windows:
+            keep &= ((times < low) if low is not None else False) | ((times > high) if high is not None else False)
+            parts.append(measurement_frame(self.store.scan(measurement, low, high)))
+        rescanned = sum(len(part) for part in parts)
+        table[0].df = concat_frames([frame[keep]] + parts)
+        self.stats['refreshes'] += 1
+        self.stats['rows_rescanned'] += rescanned
+
+    def info(self):
+        with self.lock:
+            tables = {name: 0 if table[0] is None else len(table[0]._df) for name, table in self.tables.items()}
+            return dict(self.stats, tables=tables)
 
 # Performance testing function
 def run_performance_test(sql_layer, num_tests=50):
     def time_execution(query):
-        start_time = time.time()
+        start_time = time.perf_counter()
         result = sql_layer.execute(query)
-        execution_time = time.time() - start_time
+        execution_time = time.perf_counter() - start_time
         return result, execution_time
 
     tests = [
@@ -225,28 +851,32 @@ def run_performance_test(sql_layer, num_tests=50):
 
     return total_time
 
-# Create a large DataFrame for initial testing
-df = pd.DataFrame({
-    'A': range(1, 1000001),
-    'B': np.random.choice(['x', 'y', 'z'], 1000000),
-    'C': np.random.randint(1, 101, 1000000)
-})
+if __name__ == "__main__":
+    # Fixed seed so runs are comparable; benchmark.py has the full suite.
+    np.random.seed(42)
 
-sql_layer = SQLLayer(df, table_name='my_table')  # Use a custom table name
-
-# Run the performance test
-run_performance_test(sql_layer)
-
-# Scalability Test
-print("\nScalability Test:")
-print("="*50)
-for size in [50000000]:
+    # Create a large DataFrame for initial testing
     df = pd.DataFrame({
-        'A': range(1, size+1),
-        'B': np.random.choice(['x', 'y', 'z'], size),
-        'C': np.random.randint(1, 101, size)
+        'A': range(1, 1000001),
+        'B': np.random.choice(['x', 'y', 'z'], 1000000),
+        'C': np.random.randint(1, 101, 1000000)
     })
-    sql_layer = SQLLayer(df, table_name='scalability_test')
-    total_time = run_performance_test(sql_layer, num_tests=1)
-    print(f"\nDataset size: {size}")
-    print(f"Total execution time: {total_time:.4f} seconds")
+
+    sql_layer = SQLLayer(df, table_name='my_table')  # Use a custom table name
+
+    # Run the performance test
+    run_performance_test(sql_layer)
+
+    # Scalability Test
+    print("\nScalability Test:")
+    print("="*50)
+    for size in [50000000]:
+        df = pd.DataFrame({
+            'A': range(1, size+1),
+            'B': np.random.choice(['x', 'y', 'z'], size),
+            'C': np.random.randint(1, 101, size)
+        })
+        sql_layer = SQLLayer(df, table_name='scalability_test')
+        total_time = run_performance_test(sql_layer, num_tests=1)
+        print(f"\nDataset size: {size}")
+        print(f"Total execution time: {total_time:.4f} seconds")
@@ -1,36 +1,340 @@
-import socket
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import requests
+from requests.adapters import HTTPAdapter
+from metrics import Metrics, debug
+
+STORAGE_URL = 'http://localhost:8087'
+# Comma-separated storage node URLs; each series is stored on
+# VM_REPLICATION_FACTOR of them.
+STORAGE_NODES = os.environ.get('VM_STORAGE_NODES', STORAGE_URL).split(',')
+REPLICATION_FACTOR = int(os.environ.get('VM_REPLICATION_FACTOR', '1'))
+
+METRICS = Metrics({
+    'vm_insert_requests_total': 'Write requests, by whether they were queued or pushed back.',
+    'vm_insert_request_seconds': 'Time to parse, route and queue one write request.',
+    'vm_insert_lines_total': 'Lines queued, counted once per storage node they are sent to.',
+    'vm_insert_batches_total': 'Batches sent to a storage node, by outcome.',
+    'vm_insert_lines_sent_total': 'Lines delivered to a storage node.',
+    'vm_insert_retries_total': 'Batch sends retried.',
+    'vm_insert_dropped_lines_total': 'Lines dropped after the last retry failed.',
+    'vm_insert_flush_seconds': 'Time for a storage node to accept one batch.',
+    'vm_insert_queue_depth': 'Lines buffered for a storage node.',
+    'vm_insert_queue_capacity': 'Lines that can be buffered for a storage node.',
+    'vm_insert_storage_available': 'Whether the last batch sent to a storage node got an answer.',
+})
+
+def stamp_lines(body, timestamp):
+    # Lines without a timestamp get the time they were received here, not the
+    # time the storage node sees them after buffering.
+    lines = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if len(line.split()) == 2:
+            line = f"{line} {timestamp}"
+        lines.append(line)
+    return lines
+
+def series_of(line):
+    # Measurement and sorted tag set, so every line of a series is routed the
+    # same way whatever the tag order.
+    parts = line.split(None, 1)[0].split(',')
+    return ','.join([parts[0]] + sorted(parts[1:]))
+
+class HashRing:
+    # Consistent hashing with virtual nodes: adding or removing a storage
+    # node only moves the series that hash next to that node's ring points.
+    def __init__(self, nodes, vnodes=64):
+        self.ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.ring]
+        self.node_count = len(set(nodes))
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def nodes_for(self, key, replicas=1):
+        # The first `replicas` distinct nodes clockwise from the key.
+        replicas = min(replicas, self.node_count)
+        position = bisect.bisect(self.hashes, self._hash(key))
+        nodes = []
+        for i in range(len(self.ring)):
+            node = self.ring[(position + i) % len(self.ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == replicas:
+                    break
+        return nodes
+
+class Forwarder:
+    # Buffers incoming lines in a bounded queue and sends them to storage in
+    # batches of up to batch_lines, or sooner once the oldest buffered line
+    # is max_age seconds old. Each worker thread keeps its own keep-alive
+    # session; storage nodes turn off Nagle's algorithm, so a batch sent on a
+    # reused connection does not wait for the previous response's delayed
+    # ACK. Failed batches are retried with exponential backoff and
+    # dropped after the last retry.
+    def __init__(self, storage_url=STORAGE_URL, max_lines=100000, batch_lines=5000, max_age=0.2,
+                 workers=2, retries=3, backoff=0.1, timeout=10):
+        self.storage_url = storage_url
+        self.max_lines = max_lines
+        self.batch_lines = batch_lines
+        self.max_age = max_age
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lines = deque()
+        self.oldest = None  # monotonic time the oldest buffered line arrived
+        self.cond = threading.Condition()
+        self.closed = False
+        self.available = True  # False while storage keeps failing
+        self.stats_lock = threading.Lock()
+        self.stats = {'received_lines': 0, 'rejected_requests': 0, 'batches_sent': 0, 'lines_sent': 0,
+                      'retries': 0, 'failed_batches': 0, 'dropped_lines': 0}
+        self.latencies = deque(maxlen=1000)  # seconds per successful flush
+        self.workers = [threading.Thread(target=self._worker, name=f'forwarder-{i}', daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def has_room(self, count):
+        with self.cond:
+            return len(self.lines) + count <= self.max_lines
+
+    def submit(self, lines):
+        # Returns False without buffering anything if the lines do not fit.
+        with self.cond:
+            if len(self.lines) + len(lines) > self.max_lines:
+                with self.stats_lock:
+                    self.stats['rejected_requests'] += 1
+                return False
+            if not self.lines:
+                self.oldest = time.monotonic()
+            self.lines.extend(lines)
+            self.cond.notify()
+        with self.stats_lock:
+            self.stats['received_lines'] += len(lines)
+        METRICS.inc('vm_insert_lines_total', len(lines), node=self.storage_url)
+        return True
+
+    def close(self):
+        # Sends what is still buffered, then stops the workers.
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _take_batch(self):
+        with self.cond:
+            while True:
+                if len(self.lines) >= self.batch_lines:
+                    break
+                if self.lines:
+                    remaining = self.max_age - (time.monotonic() - self.oldest)
+                    if remaining <= 0 or self.closed:
+                        break
+                elif self.closed:
+                    return None
+                else:
+                    remaining = None
+                self.cond.wait(remaining)
+            batch = [self.lines.popleft() for _ in range(min(self.batch_lines, len(self.lines)))]
+            if not self.lines:
+                self.oldest = None
+            return batch
+
+    def _worker(self):
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                session.close()
+                return
+            self._send(session, batch)
+
+    def _send(self, session, batch):
+        body = '\n'.join(batch).encode('utf-8')
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self.stats_lock:
+                    self.stats['retries'] += 1
+                METRICS.inc('vm_insert_retries_total', node=self.storage_url)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.monotonic()
+            try:
+                response = session.post(self.storage_url, data=body, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = str(e)
+                continue
+            if response.status_code >= 500 or response.status_code == 429:
+                error = f"HTTP {response.status_code}"
+                continue
+            self.available = True
+            if response.status_code >= 400:
+                # The storage node rejected every line; retrying will not help.
+                print(f"LSM Data Saver rejected batch: {response.text}")
+            latency = time.monotonic() - start
+            with self.stats_lock:
+                self.stats['batches_sent'] += 1
+                self.stats['lines_sent'] += len(batch)
+                self.latencies.append(latency)
+            METRICS.observe('vm_insert_flush_seconds', latency, node=self.storage_url)
+            METRICS.inc('vm_insert_batches_total', node=self.storage_url,
+                        result='rejected' if response.status_code >= 400 else 'sent')
+            METRICS.inc('vm_insert_lines_sent_total', len(batch), node=self.storage_url)
+            return
+        self.available = False
+        print(f"Error sending data to LSM Data Saver, dropping {len(batch)} lines: {error}")
+        with self.stats_lock:
+            self.stats['failed_batches'] += 1
+            self.stats['dropped_lines'] += len(batch)
+        METRICS.inc('vm_insert_batches_total', node=self.storage_url, result='failed')
+        METRICS.inc('vm_insert_dropped_lines_total', len(batch), node=self.storage_url)
+
+    def info(self):
+        with self.cond:
+            depth = len(self.lines)
+        with self.stats_lock:
+            stats = dict(self.stats)
+            latencies = sorted(self.latencies)
+        stats['queue_depth'] = depth
+        stats['queue_capacity'] = self.max_lines
+        stats['storage_available'] = self.available
+        if latencies:
+            stats['flush_latency_seconds'] = {
+                'avg': sum(latencies) / len(latencies),
+                'p50': latencies[len(latencies) // 2],
+                'p99': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+                'max': latencies[-1],
+            }
+        return stats
+
+class Cluster:
+    # Routes each line to the storage nodes owning its series and queues it
+    # in those nodes' Forwarders. A request is only accepted if every node
+    # it touches has room, so it is never half-buffered.
+    MAX_ROUTES = 100000
+
+    def __init__(self, nodes=STORAGE_NODES, replication_factor=REPLICATION_FACTOR, **forwarder_options):
+        self.ring = HashRing(nodes)
+        self.replication_factor = replication_factor
+        self.forwarders = {node: Forwarder(node, **forwarder_options) for node in nodes}
+        self.routes = {}  # series -> nodes
+        self.lock = threading.Lock()
+        self.rejected_requests = 0
+
+    @property
+    def available(self):
+        return all(forwarder.available for forwarder in self.forwarders.values())
+
+    def submit(self, lines):
+        batches = {}
+        for line in lines:
+            series = series_of(line)
+            nodes = self.routes.get(series)
+            if nodes is None:
+                if len(self.routes) >= self.MAX_ROUTES:
+                    self.routes.clear()
+                nodes = self.routes[series] = self.ring.nodes_for(series, self.replication_factor)
+            for node in nodes:
+                batches.setdefault(node, []).append(line)
+        with self.lock:
+            if not all(self.forwarders[node].has_room(len(batch)) for node, batch in batches.items()):
+                self.rejected_requests += 1
+                return False
+            for node, batch in batches.items():
+                self.forwarders[node].submit(batch)
+        return True
+
+    def close(self):
+        for forwarder in self.forwarders.values():
+            forwarder.close()
+
+    def metric_samples(self):
+        samples = []
+        for node, forwarder in self.forwarders.items():
+            with forwarder.cond:
+                depth = len(forwarder.lines)
+            samples.append(('vm_insert_queue_depth', 'gauge', {'node': node}, depth))
+            samples.append(('vm_insert_queue_capacity', 'gauge', {'node': node}, forwarder.max_lines))
+            samples.append(('vm_insert_storage_available', 'gauge', {'node': node}, int(forwarder.available)))
+        return samples
+
+    def info(self):
+        return {
+            'replication_factor': self.replication_factor,
+            'rejected_requests': self.rejected_requests,
+            'nodes': {node: forwarder.info() for node, forwarder in self.forwarders.items()},
+        }
 
 class InfluxDataHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
-        
+
         # Echo the data to the console
-        print(f"Received data: {post_data}")
-        
-        # Forward the data to the LSM Data Saver
-        self.send_to_lsm_saver(post_data)
-        
+        debug(f"Received data: {post_data}")
+
+        # Queue the data for the LSM Data Saver; a full buffer is pushed back
+        # to the client instead of blocking it.
+        with METRICS.timer('vm_insert_request_seconds'):
+            lines = stamp_lines(post_data, time.time_ns())
+            queued = self.server.cluster.submit(lines)
+        if not queued:
+            status = 429 if self.server.cluster.available else 503
+            METRICS.inc('vm_insert_requests_total', result='throttled' if status == 429 else 'unavailable')
+            self.send_response(status)
+            self.send_header('Content-type', 'text/plain')
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            self.wfile.write(b"Write buffer full, retry later")
+            return
+
         # Send a simple acknowledgement back to the client
+        METRICS.inc('vm_insert_requests_total', result='queued')
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
-        self.wfile.write(b"Data received and forwarded")
-    
-    def send_to_lsm_saver(self, data):
-        try:
-            response = requests.post('http://localhost:8087', data=data)
-            print(f"LSM Data Saver response: {response.text}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending data to LSM Data Saver: {e}")
+        self.wfile.write(b"Data received and queued")
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = METRICS.render(self.server.cluster.metric_samples()).encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/stats':
+            body = json.dumps(self.server.cluster.info()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 def run_server(host, port):
     server_address = (host, port)
-    httpd = HTTPServer(server_address, InfluxDataHandler)
-    print(f"Influx Data Listener running on http://{host}:{port}")
-    httpd.serve_forever()
+    httpd = ThreadingHTTPServer(server_address, InfluxDataHandler)
+    httpd.cluster = Cluster()
+    print(f"Influx Data Listener running on http://{host}:{port}, storage nodes: {', '.join(STORAGE_NODES)}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.cluster.close()
 
 if __name__ == "__main__":
     HOST = "0.0.0.0"  # Listen on all available interfaces
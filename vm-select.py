@@ -1,39 +1,344 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import os
 import requests
 from urllib.parse import urlencode, parse_qs, unquote
 import json
+import time
+from metrics import Metrics, QueryProfile, cprofile_call, debug
+
+# Comma-separated storage node URLs. With more than one node every query is
+# sent to all of them and the partial results are merged here.
+STORAGE_NODES = os.environ.get('VM_STORAGE_NODES', 'http://localhost:8087').split(',')
+NODE_TIMEOUT = float(os.environ.get('VM_NODE_TIMEOUT', '10'))  # seconds, per connect and per read
+
+METRICS = Metrics({
+    'vm_select_queries_total': 'Queries received, by whether they went to one node or were merged from several.',
+    'vm_select_query_errors_total': 'Queries that failed on every node or were rejected.',
+    'vm_select_query_seconds': 'Time from receiving a query to sending its last result.',
+    'vm_select_query_stage_seconds': 'Time per stage of a merged query: fanout, merge, encode and send.',
+    'vm_select_node_failures_total': 'Storage nodes that failed or timed out during a query.',
+})
+
+def series_key(tags):
+    return ','.join(f"{key}={tags[key]}" for key in sorted(tags))
+
+def row_key(row):
+    # Storage nodes return rows ordered by series, then time.
+    return series_key(row['tags']), int(row['timestamp'])
+
+def merge_partial(a, b):
+    # [count, numeric count, sum, min, max, first time, first, last time, last]
+    count, valid, total = a[0] + b[0], a[1] + b[1], a[2] + b[2]
+    low = min((value for value in (a[3], b[3]) if value is not None), default=None)
+    high = max((value for value in (a[4], b[4]) if value is not None), default=None)
+    first = min((pair for pair in ((a[5], a[6]), (b[5], b[6])) if pair[0] is not None), default=(None, None))
+    last = max((pair for pair in ((a[7], a[8]), (b[7], b[8])) if pair[0] is not None), default=(None, None))
+    return [count, valid, total, low, high, *first, *last]
+
+EMPTY_PARTIAL = [0, 0, 0.0, None, None, None, None, None, None]
+
+def finish_aggregate(function, partial):
+    count, valid, total, low, high, first_time, first, last_time, last = partial
+    if function == 'COUNT':
+        return count
+    if function == 'SUM':
+        return total if valid else None
+    if function in ('AVG', 'MEAN'):
+        return total / valid if valid else None
+    if function == 'MIN':
+        return low
+    if function == 'MAX':
+        return high
+    if function == 'FIRST':
+        return first
+    if function == 'LAST':
+        return last
+    # RATE: per-second change between the first and last value.
+    if first_time is None or last_time <= first_time:
+        return None
+    return (last - first) / ((last_time - first_time) / 1e9)
 
 class QueryHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so the storage node's chunked response can be relayed as is.
+    # Nagle's algorithm is off so the small writes of a response are not held
+    # back until the client's delayed ACK on a keep-alive connection.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    STREAM_BUFFER_SIZE = 64 * 1024
+
     def do_GET(self):
+        if self.path == '/metrics':
+            self.send_metrics()
+            return
         parsed_path = parse_qs(self.path[2:])  # Remove leading '/?'
         if 'query' not in parsed_path:
             self.send_error(400, "Missing 'query' parameter")
             return
 
         query = unquote(parsed_path['query'][0])  # Decode the URL-encoded query
-        print(f"Received query: {query}")  # Debug print
+        debug(f"Received query: {query}")
+
+        params = {'query': query}
+        if 'format' in parsed_path:
+            params['format'] = parsed_path['format'][0]
+        started = time.perf_counter()
+        mode = 'forward' if len(self.server.storage_nodes) == 1 else 'scatter'
+        METRICS.inc('vm_select_queries_total', mode=mode)
+        if mode == 'forward':
+            self.forward_query(self.server.storage_nodes[0], params)
+        else:
+            self.scatter_gather(params)
+        METRICS.observe('vm_select_query_seconds', time.perf_counter() - started, mode=mode)
+
+    def forward_query(self, storage_url, params):
+        # X-Profile is passed on, so the storage node does the profiling.
+        headers = {}
+        for name in ('Accept', 'X-Profile'):
+            if name in self.headers:
+                headers[name] = self.headers[name]
+        try:
+            response = requests.get(storage_url, params=params, headers=headers, stream=True)
+        except requests.RequestException as e:
+            METRICS.inc('vm_select_node_failures_total', node=storage_url)
+            METRICS.inc('vm_select_query_errors_total')
+            self.send_json(502, {"error": f"Error communicating with storage service: {str(e)}"})
+            return
+
+        # Relay the body chunk by chunk instead of buffering the whole result.
+        with response:
+            self.send_response(response.status_code)
+            self.send_header('Content-type', response.headers.get('Content-Type', 'application/json'))
+            self.send_header('Transfer-Encoding', 'chunked')
+            if 'Server-Timing' in response.headers:
+                self.send_header('Server-Timing', response.headers['Server-Timing'])
+            self.end_headers()
+            try:
+                for chunk in response.iter_content(chunk_size=None):
+                    if chunk:
+                        self.write_chunk(chunk)
+            except requests.RequestException as e:
+                # Leave the response unterminated so the client sees it as truncated.
+                print(f"Error relaying results from storage service: {e}")
+                self.close_connection = True
+                return
+            self.wfile.write(b"0\r\n\r\n")
+
+    def scatter_gather(self, params):
+        # Sends the query to every storage node in parallel and merges their
+        # partial results. Nodes that fail or time out are left out and
+        # listed in X-Failed-Nodes. X-Profile profiles the merge here rather
+        # than the nodes' own work.
+        profile = QueryProfile()
+        profile_mode = self.headers.get('X-Profile', '').lower()
+        nodes = self.server.storage_nodes
+        ndjson = (params.pop('format', '') == 'ndjson'
+                  or 'application/x-ndjson' in self.headers.get('Accept', ''))
+        explain = params['query'].upper().split()[0] == 'EXPLAIN'
+        if not explain:
+            params['partial'] = '1'
+        with profile.stage('fanout'), ThreadPoolExecutor(len(nodes)) as pool:
+            futures = [(node, pool.submit(requests.get, node, params=params, stream=True, timeout=NODE_TIMEOUT))
+                       for node in nodes]
+        responses = {}
+        failed = {}
+        for i, (node, future) in enumerate(futures):
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                failed[node] = str(e)
+                continue
+            if response.status_code == 400:
+                # A bad query is bad on every node; pass the error through
+                # after releasing the other nodes' streams.
+                pending = [later.result() for _, later in futures[i + 1:] if later.exception() is None]
+                for other in list(responses.values()) + pending:
+                    other.close()
+                METRICS.inc('vm_select_query_errors_total')
+                self.send_json(400, {"error": response.text})
+                response.close()
+                return
+            if response.status_code != 200:
+                failed[node] = f"HTTP {response.status_code}"
+                response.close()
+                continue
+            responses[node] = response
+        for node, error in failed.items():
+            print(f"Storage node {node} failed: {error}")
+            METRICS.inc('vm_select_node_failures_total', node=node)
+        if not responses:
+            METRICS.inc('vm_select_query_errors_total')
+            self.send_json(502, {"error": "No storage node answered", "nodes": failed})
+            return
+
+        if explain:
+            plans = {node: response.json() for node, response in responses.items()}
+            plans.update({node: {"error": error} for node, error in failed.items()})
+            self.send_json(200, plans)
+            return
+
+        streams = {node: self.node_records(node, response, failed) for node, response in responses.items()}
+        with profile.stage('fanout'):
+            headers = {node: next(stream, None) for node, stream in streams.items()}
+        header = next((record['partial'] for record in headers.values() if record is not None), None)
+        if header is None:
+            METRICS.inc('vm_select_query_errors_total')
+            self.send_json(502, {"error": "No storage node returned results", "nodes": failed})
+            return
+        with profile.stage('merge'):
+            if header['aggregates']:
+                # Partials are merged in full before anything is sent, so nodes
+                # that fail mid-stream are still reported in the headers.
+                results = self.merge_partials(header, streams)
+            else:
+                results = self.merge_rows(header, streams.values())
+        results = profile.timed('merge', results)
+        if profile_mode == 'cprofile':
+            results, dump = cprofile_call(lambda: list(results))
+            body = f"{len(results)} results, {profile.server_timing()}\n\n{dump}".encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        response_headers = {}
+        if profile_mode == 'stages':
+            results = list(results)
+            response_headers['Server-Timing'] = profile.server_timing()
+        self.send_results(results, ndjson, failed, profile, response_headers)
+        profile.record(METRICS, 'vm_select_query_stage_seconds')
+
+    def node_records(self, node, response, failed):
+        # Records from one node's NDJSON stream; a failure ends the stream
+        # early and marks the node as failed.
+        with response:
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+            except (requests.RequestException, ValueError) as e:
+                print(f"Storage node {node} failed mid-stream: {e}")
+                failed[node] = str(e)
 
-        results = self.forward_query(query)
+    def merge_rows(self, header, streams):
+        # Rows from all nodes merged in (series, time) order; copies of a row
+        # from replicas are dropped. OFFSET and LIMIT apply to the merged
+        # stream.
+        rows = heapq.merge(*streams, key=row_key)
+        rows = (next(copies) for _, copies in itertools.groupby(rows, key=row_key))
+        if header['group_by']:
+            grouped = {}
+            for row in rows:
+                group = tuple(row['tags'].get(tag, '') for tag in header['group_by'])
+                grouped.setdefault(group, []).append(row)
+            rows = [{'group': dict(zip(header['group_by'], group)), 'results': results}
+                    for group, results in grouped.items()]
+        return self.paginate(rows, header)
 
+    def merge_partials(self, header, streams):
+        # Each series is taken from one node only: with replication several
+        # nodes hold it, and the copy with the most points wins.
+        series_partials = {}
+        for node, stream in streams.items():
+            for partial in stream:
+                node_partials = series_partials.setdefault(series_key(partial['tags']), {})
+                node_partials.setdefault(node, []).append(partial)
+
+        groups = {}
+        for node_partials in series_partials.values():
+            partials = max(node_partials.values(),
+                           key=lambda partials: sum(field[0] for partial in partials
+                                                    for field in partial['fields'].values()))
+            for partial in partials:
+                group = (tuple(partial['tags'].get(tag, '') for tag in header['group_tags']), partial['time'])
+                fields = groups.setdefault(group, {})
+                for field, values in partial['fields'].items():
+                    fields[field] = merge_partial(fields.get(field, EMPTY_PARTIAL), values)
+
+        aggregates = header['aggregates']
+        if not header['group_tags'] and header['interval'] is None:
+            fields = groups.get(((), None), {})
+            results = [{column: finish_aggregate(function, fields.get(field, EMPTY_PARTIAL))}
+                       for column, function, field in aggregates]
+        else:
+            results = []
+            for (tags, bucket), fields in sorted(groups.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+                group = dict(zip(header['group_tags'], tags))
+                if header['interval'] is not None:
+                    group['time'] = bucket
+                results.append({
+                    'group': group,
+                    'results': [{column: finish_aggregate(function, fields.get(field, EMPTY_PARTIAL))}
+                                for column, function, field in aggregates]
+                })
+        return self.paginate(results, header)
+
+    def paginate(self, results, header):
+        offset = header['offset'] or 0
+        limit = header['limit']
+        return itertools.islice(results, offset, offset + limit if limit else None)
+
+    def send_results(self, results, ndjson, failed, profile, headers):
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', 'application/x-ndjson' if ndjson else 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if failed:
+            self.send_header('X-Partial-Response', 'true')
+            self.send_header('X-Failed-Nodes', ','.join(failed))
+        for name, value in headers.items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(results, indent=2).encode())
+        buffer = bytearray() if ndjson else bytearray(b'[')
+        count = 0
+        for result in results:
+            started = time.perf_counter()
+            if ndjson:
+                buffer += json.dumps(result).encode() + b'\n'
+            else:
+                buffer += (b',' if count else b'') + json.dumps(result).encode()
+            profile.add('encode', time.perf_counter() - started)
+            count += 1
+            if len(buffer) >= self.STREAM_BUFFER_SIZE:
+                with profile.stage('send'):
+                    self.write_chunk(buffer)
+                buffer = bytearray()
+        if not ndjson:
+            buffer += b']'
+        with profile.stage('send'):
+            self.write_chunk(buffer, last=True)
 
-    def forward_query(self, query):
-        storage_url = "http://localhost:8087"
-        params = {'query': query}
-        try:
-            response = requests.get(storage_url, params=params)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            return {"error": f"Error communicating with storage service: {str(e)}"}
+    def write_chunk(self, data, last=False):
+        # The terminating chunk goes out in the same write as the last data.
+        chunk = f"{len(data):X}\r\n".encode() + bytes(data) + b"\r\n" if data else b""
+        if last:
+            chunk += b"0\r\n\r\n"
+        if chunk:
+            self.wfile.write(chunk)
+
+    def send_metrics(self):
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 def run_server(host, port):
     server_address = (host, port)
-    httpd = HTTPServer(server_address, QueryHandler)
-    print(f"Query Server running on http://{host}:{port}")
+    httpd = ThreadingHTTPServer(server_address, QueryHandler)
+    httpd.storage_nodes = STORAGE_NODES
+    print(f"Query Server running on http://{host}:{port}, storage nodes: {', '.join(STORAGE_NODES)}")
     httpd.serve_forever()
 
 if __name__ == "__main__":
@@ -1,120 +1,2381 @@
+import bisect
+import bz2
+import hashlib
+import heapq
+import itertools
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from collections import OrderedDict
+import lzma
+import math
+import operator
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from array import array
+from collections import OrderedDict, deque
+import threading
 import time
 from urllib.parse import parse_qs, urlparse
 import re
 import os
-import pickle
+import sys
+import mmap
+import shutil
+import struct
+import zlib
 from datetime import datetime, timezone
 
+import numpy as np
+
+from metrics import DEBUG, Metrics, QueryProfile, cprofile_call, debug
+
+try:
+    from sql_layer import MeasurementTables
+except ImportError:  # pandas is only needed for /sql
+    MeasurementTables = None
+
+METRICS = Metrics({
+    'vm_ingest_requests_total': 'Write requests received.',
+    'vm_ingest_points_total': 'Points received, by whether they were stored or were past retention.',
+    'vm_ingest_rejected_lines_total': 'Lines that could not be parsed.',
+    'vm_ingest_seconds': 'Time to parse and store one write request.',
+    'vm_write_stalls_total': 'Writes slowed down or stopped by the compaction backlog.',
+    'vm_memtable_flush_seconds': 'Time to write a frozen memtable to an L0 SSTable.',
+    'vm_memtable_flushed_entries_total': 'Entries written by memtable flushes.',
+    'vm_compaction_seconds': 'Time per compaction, by output level.',
+    'vm_compaction_purged_entries_total': 'Tombstones and deleted entries dropped by compaction.',
+    'vm_compaction_expired_entries_total': 'Entries expired by TTL during compaction.',
+    'vm_sstable_bytes_written_total': 'SSTable bytes written, by flush or compaction.',
+    'vm_sstable_block_read_seconds': 'Time to read and decode one SSTable block from disk, by codec.',
+    'vm_queries_total': 'Queries run, by whether the result came from the query cache.',
+    'vm_query_errors_total': 'Queries rejected or failed while streaming.',
+    'vm_query_seconds': 'Time from receiving a query to sending its last result.',
+    'vm_query_stage_seconds': 'Time per query stage: parse, plan, execute, encode and send.',
+    'vm_query_results_total': 'Result records sent.',
+    'vm_deletes_total': 'DELETE statements run.',
+    'vm_delete_seconds': 'Time per DELETE statement.',
+    'vm_partitions': 'Time partitions on disk.',
+    'vm_open_partitions': 'Time partitions currently open.',
+    'vm_partitions_dropped_total': 'Partitions deleted by retention.',
+    'vm_series': 'Series in the index, by measurement.',
+    'vm_memtable_entries': 'Entries in the active memtables of the open trees.',
+    'vm_sstables': 'SSTables in the open trees, by level.',
+    'vm_sstable_bytes': 'SSTable bytes in the open trees, by level.',
+    'vm_block_cache_hits_total': 'SSTable block reads served from the block cache.',
+    'vm_block_cache_misses_total': 'SSTable block reads that missed the block cache.',
+    'vm_block_cache_evictions_total': 'Blocks evicted from the block cache.',
+    'vm_block_cache_bytes': 'Bytes held by the block cache.',
+    'vm_query_cache_hits_total': 'Queries answered from the query cache.',
+    'vm_query_cache_misses_total': 'Queries not found in the query cache.',
+    'vm_query_cache_evictions_total': 'Results evicted from the query cache.',
+    'vm_query_cache_bytes': 'Bytes held by the query cache.',
+    'vm_sql_query_seconds': 'Time to answer /sql queries, including refreshing the measurement table.',
+    'vm_sql_queries_total': 'Queries received on /sql, by status.',
+})
+
+# Keys are order-preserving bytes: measurement, series (sorted tag set) and
+# the timestamp as a big-endian unsigned integer with the sign bit flipped, so
+# byte order is numeric time order within a series. Writes append fragments,
+# the chunk key followed by a big-endian sequence number, which sort right
+# after their chunk in write order and are merged into it at flush.
+KEY_SEPARATOR = b'\x00'
+TIMESTAMP = struct.Struct('>Q')
+FRAGMENT_SEQUENCE = struct.Struct('>Q')
+
+def encode_timestamp(timestamp):
+    return TIMESTAMP.pack(timestamp + (1 << 63))
+
+def series_prefix(measurement, series):
+    return measurement.encode('utf-8') + KEY_SEPARATOR + series.encode('utf-8') + KEY_SEPARATOR
+
+def encode_key(measurement, series, timestamp):
+    return series_prefix(measurement, series) + encode_timestamp(timestamp)
+
+def chunk_key(key):
+    # The chunk a fragment key belongs to; other keys are returned as is.
+    second = key.find(KEY_SEPARATOR, key.find(KEY_SEPARATOR) + 1)
+    if second < 0:
+        return key
+    return key[:second + 1 + TIMESTAMP.size]
+
+def fragment_key(key, sequence):
+    return key + FRAGMENT_SEQUENCE.pack(sequence)
+
+def chunk_end(key):
+    # End of the key range holding a chunk and its fragments.
+    return key + b'\xff' * (FRAGMENT_SEQUENCE.size + 1)
+
+def decode_key(key):
+    key = chunk_key(key)
+    measurement, series, _ = key[:-TIMESTAMP.size].split(KEY_SEPARATOR)
+    timestamp = TIMESTAMP.unpack(key[-TIMESTAMP.size:])[0] - (1 << 63)
+    return measurement.decode('utf-8'), series.decode('utf-8'), timestamp
+
+def key_timestamp(key):
+    # Timestamp of a data key, or None for keys in the reserved key spaces
+    # (which start with a control byte rather than a measurement name).
+    if len(key) < TIMESTAMP.size or key[:1] < b'\x20':
+        return None
+    key = chunk_key(key)
+    return TIMESTAMP.unpack(key[-TIMESTAMP.size:])[0] - (1 << 63)
+
+def series_key(tags):
+    return ','.join(f"{key}={tags[key]}" for key in sorted(tags))
+
+# Deletes are written like any other entry. A tombstone takes the place of a
+# key's value, and a range tombstone is an entry in its own key space mapping
+# a start key to an end key; it hides every key in [start, end) held by an
+# older source (the keys of its own memtable are tombstoned when it is
+# written). Both are kept by compaction until nothing older remains below.
+TOMBSTONE = object()
+TOMBSTONE_LENGTH = 0xFFFFFFFF  # Value length recorded for a tombstone
+RANGE_TOMBSTONE = b'\x03'
+ENTRY_HEADER = struct.Struct('>II')
+
+def encode_entry(key, value):
+    if value is TOMBSTONE:
+        return ENTRY_HEADER.pack(len(key), TOMBSTONE_LENGTH) + key
+    return ENTRY_HEADER.pack(len(key), len(value)) + key + value
+
+def range_tombstone(start, end):
+    return RANGE_TOMBSTONE + start, end
+
+def covered(ranges, key):
+    return any(start <= key < end for start, end in ranges)
+
+def merge_ranges(ranges):
+    # Union of (start, end) ranges as a sorted list of disjoint ranges.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def merge_sorted(sources, shadows=None):
+    # k-way merge of sorted (key, value) iterators, newest source first. When
+    # several sources hold the same key only the newest value is yielded.
+    # shadows optionally gives, per source, the range tombstones of the
+    # sources newer than it; its keys inside them are skipped.
+    heap = []
+    for priority, source in enumerate(sources):
+        iterator = iter(source)
+        for key, value in iterator:
+            heap.append((key, priority, value, iterator))
+            break
+    heapq.heapify(heap)
+    last_key = None
+    while heap:
+        key, priority, value, iterator = heap[0]
+        if key != last_key:
+            if not (shadows and shadows[priority] and covered(shadows[priority], key)):
+                yield key, value
+            last_key = key
+        entry = next(iterator, None)
+        if entry is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (entry[0], priority, entry[1], iterator))
+
 class MemTable:
     def __init__(self, max_size=1000):
-        self.data = OrderedDict()
+        self.data = {}
+        self.keys = []  # Sorted, for range scans
+        self.range_tombstones = []
         self.max_size = max_size
 
     def put(self, key, value):
+        if key.startswith(RANGE_TOMBSTONE):
+            start = key[len(RANGE_TOMBSTONE):]
+            for existing, _ in list(self.items(start, value)):
+                self.data[existing] = TOMBSTONE
+            self.range_tombstones.append((start, value))
+            value = max(value, self.data.get(key, value))
+        if key not in self.data:
+            bisect.insort(self.keys, key)
         self.data[key] = value
-        if len(self.data) > self.max_size:
-            return self.flush()
-        return None
 
     def get(self, key):
         return self.data.get(key)
 
-    def flush(self):
-        flushed_data = list(self.data.items())
-        self.data.clear()
-        return flushed_data
+    def items(self, start=None, end=None):
+        first = 0 if start is None else bisect.bisect_left(self.keys, start)
+        last = len(self.keys) if end is None else bisect.bisect_left(self.keys, end)
+        for key in self.keys[first:last]:
+            yield key, self.data[key]
+
+    def copy(self):
+        memtable = MemTable(self.max_size)
+        memtable.data = dict(self.data)
+        memtable.keys = list(self.keys)
+        memtable.range_tombstones = list(self.range_tombstones)
+        return memtable
+
+    def is_full(self):
+        return len(self.data) >= self.max_size
+
+class BloomFilter:
+    HEADER = struct.Struct('>IB')
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, keys, bits_per_key):
+        # k = bits_per_key * ln(2) minimises the false-positive rate.
+        num_hashes = min(max(int(bits_per_key * 0.69), 1), 30)
+        bloom = cls(len(keys) * bits_per_key, num_hashes)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, key):
+        # Double hashing: derive all k probes from one 64-bit digest.
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], 'little')
+        h2 = int.from_bytes(digest[4:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_bits, num_hashes = cls.HEADER.unpack_from(data)
+        return cls(num_bits, num_hashes, bytes(data[cls.HEADER.size:]))
+
+# Block codecs by name: (id recorded in each block header, compress,
+# decompress).
+BLOCK_CODECS = {
+    'none': (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'lzma': (2, lzma.compress, lzma.decompress),
+    'bz2': (3, bz2.compress, bz2.decompress),
+}
+CODEC_NAMES = {codec_id: name for name, (codec_id, _, _) in BLOCK_CODECS.items()}
+
+class BlockStats:
+    # Blocks decoded per codec, with their uncompressed bytes and the time
+    # spent decompressing them. Shared by the tables of one tree.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codecs = {}
+
+    def record(self, codec, raw_bytes, seconds):
+        with self.lock:
+            stats = self.codecs.setdefault(codec, {'blocks': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['blocks'] += 1
+            stats['bytes'] += raw_bytes
+            stats['seconds'] += seconds
+
+    def info(self):
+        with self.lock:
+            return {codec: dict(stats, mb_per_second=stats['bytes'] / 1e6 / stats['seconds'] if stats['seconds'] else None)
+                    for codec, stats in self.codecs.items()}
+
+class BlockCache:
+    # LRU cache of decoded SSTable blocks within a byte budget, shared by the
+    # tables of every tree in the process. A scan that has read scan_blocks
+    # blocks of one table stops adding that table's blocks, so one large
+    # scan cannot push out the hot blocks of point reads and short queries.
+    ENTRY_OVERHEAD = 120  # Approximate bytes per decoded entry beyond its key and value
+
+    def __init__(self, max_bytes=64 << 20, scan_blocks=64):
+        self.max_bytes = max_bytes
+        self.scan_blocks = scan_blocks
+        self.blocks = OrderedDict()  # (table id, block) -> (entries, size)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypassed': 0}
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.stats['misses'] += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.stats['hits'] += 1
+            return block[0]
+
+    def put(self, key, entries, size):
+        size += len(entries) * self.ENTRY_OVERHEAD
+        with self.lock:
+            if size > self.max_bytes or key in self.blocks:
+                return
+            self.blocks[key] = (entries, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.blocks.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def bypass(self):
+        with self.lock:
+            self.stats['bypassed'] += 1
+
+    def info(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, hit_rate=self.stats['hits'] / lookups if lookups else None,
+                        blocks=len(self.blocks), bytes=self.bytes, max_bytes=self.max_bytes)
 
 class SSTable:
-    def __init__(self, level, index):
-        self.filename = f"level_{level}_sstable_{index}.db"
-        self.data = OrderedDict()
+    # File layout: sorted key/value blocks, a sparse index with the first key
+    # of every block, a Bloom filter over all keys, a footer with the min/max
+    # key and min/max data key timestamp, then a fixed trailer. Each block
+    # starts with its codec and uncompressed length, so tables written with
+    # different codecs can be read alike; a block that does not shrink is
+    # stored uncompressed.
+    BLOCK_SIZE = 4096
+    ENTRY_HEADER = ENTRY_HEADER
+    BLOCK_HEADER = struct.Struct('>BI')
+    TIME_RANGE = struct.Struct('>?qq')
+    INDEX_ENTRY = struct.Struct('>QII')
+    TRAILER = struct.Struct('>QQIIQI8s')
+    MAGIC = b'PYLSMSS2'
+    ids = itertools.count()  # Block cache keys; a file name can be reused
+
+    def __init__(self, level, index, bloom_bits_per_key=10, directory='.', codec='none', block_stats=None,
+                 block_cache=None):
+        self.index = index
+        self.filename = os.path.join(directory, f"level_{level}_sstable_{index}.sst")
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self.codec = codec
+        self.block_stats = block_stats
+        self.block_cache = block_cache
+        self.cache_id = None
+        self.raw_bytes = 0  # Uncompressed size of the blocks
+        self.block_bytes = 0  # Stored size of the blocks
+        self.data = OrderedDict()  # Write buffer, emptied by save()
+        self.bloom = None
+        self.mmap = None
+        self.index_keys = []
+        self.index_blocks = []
+        self.min_key = None
+        self.max_key = None
+        self.min_time = None
+        self.max_time = None
+        self.entry_count = 0
+        self.range_tombstones = []
+
+    def __len__(self):
+        return self.entry_count if self.mmap is not None else len(self.data)
+
+    @property
+    def size_bytes(self):
+        return len(self.mmap) if self.mmap is not None else 0
 
     def put(self, key, value):
         self.data[key] = value
 
+    def might_contain(self, key):
+        if self.bloom is None:
+            return True
+        return self.bloom.might_contain(key)
+
+    def overlaps(self, start=None, end=None):
+        if self.mmap is None:
+            return True
+        return (start is None or self.max_key >= start) and (end is None or self.min_key < end)
+
     def get(self, key):
-        return self.data.get(key)
+        if self.mmap is None:
+            return self.data.get(key)
+        if key < self.min_key or key > self.max_key:
+            return None
+        block = bisect.bisect_right(self.index_keys, key) - 1
+        for entry_key, value in self._block(block):
+            if entry_key == key:
+                return value
+            if entry_key > key:
+                break
+        return None
+
+    def items(self, start=None, end=None, fill_cache=True):
+        # Yields entries in key order with start <= key < end, reading only
+        # the blocks that overlap the range. With fill_cache=False (and past
+        # the cache's scan_blocks) blocks read from disk are not cached.
+        if self.mmap is None:
+            for key, value in sorted(self.data.items()):
+                if (start is None or key >= start) and (end is None or key < end):
+                    yield key, value
+            return
+        first = 0
+        if start is not None:
+            first = max(bisect.bisect_right(self.index_keys, start) - 1, 0)
+        for block in range(first, len(self.index_blocks)):
+            if end is not None and self.index_keys[block] >= end:
+                return
+            if self.block_cache is not None and block - first >= self.block_cache.scan_blocks:
+                fill_cache = False
+            for key, value in self._block(block, fill_cache):
+                if start is not None and key < start:
+                    continue
+                if end is not None and key >= end:
+                    return
+                yield key, value
+
+    def _block(self, block, fill_cache=True):
+        if self.block_cache is None:
+            return self._read_block(block)
+        entries = self.block_cache.get((self.cache_id, block))
+        if entries is None:
+            entries = self._read_block(block)
+            if fill_cache:
+                raw_length = self.BLOCK_HEADER.unpack_from(self.mmap, self.index_blocks[block][0])[1]
+                self.block_cache.put((self.cache_id, block), entries, raw_length)
+            else:
+                self.block_cache.bypass()
+        return entries
+
+    def _read_block(self, block):
+        offset, length = self.index_blocks[block]
+        codec_id, raw_length = self.BLOCK_HEADER.unpack_from(self.mmap, offset)
+        data = self.mmap
+        pos = offset + self.BLOCK_HEADER.size
+        end = offset + length
+        started = time.perf_counter()
+        if codec_id:
+            data = BLOCK_CODECS[CODEC_NAMES[codec_id]][2](self.mmap[pos:end])
+            if self.block_stats is not None:
+                self.block_stats.record(CODEC_NAMES[codec_id], raw_length, time.perf_counter() - started)
+            pos, end = 0, raw_length
+        entries = []
+        while pos < end:
+            key_len, value_len = self.ENTRY_HEADER.unpack_from(data, pos)
+            pos += self.ENTRY_HEADER.size
+            key = data[pos:pos + key_len]
+            pos += key_len
+            if value_len == TOMBSTONE_LENGTH:
+                entries.append((key, TOMBSTONE))
+                continue
+            value = data[pos:pos + value_len]
+            pos += value_len
+            entries.append((key, value))
+        METRICS.observe('vm_sstable_block_read_seconds', time.perf_counter() - started, codec=CODEC_NAMES[codec_id])
+        return entries
+
+    def _encode_block(self, block):
+        codec_id, compress, _ = BLOCK_CODECS[self.codec]
+        if compress is not None:
+            compressed = compress(bytes(block))
+            if len(compressed) < len(block):
+                return self.BLOCK_HEADER.pack(codec_id, len(block)) + compressed
+        return self.BLOCK_HEADER.pack(0, len(block)) + block
 
     def save(self):
-        with open(self.filename, 'wb') as f:
-            pickle.dump(self.data, f)
+        items = sorted(self.data.items())
+        index = []
+        offset = 0
+        raw_bytes = 0
+        # Write to a temp file and rename so readers that still have the old
+        # file mapped keep a valid view.
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            block = bytearray()
+            first_key = None
+            for key, value in items:
+                if first_key is None:
+                    first_key = key
+                block += encode_entry(key, value)
+                if len(block) >= self.BLOCK_SIZE:
+                    encoded = self._encode_block(block)
+                    f.write(encoded)
+                    index.append((first_key, offset, len(encoded)))
+                    offset += len(encoded)
+                    raw_bytes += len(block)
+                    block = bytearray()
+                    first_key = None
+            if block:
+                encoded = self._encode_block(block)
+                f.write(encoded)
+                index.append((first_key, offset, len(encoded)))
+                offset += len(encoded)
+                raw_bytes += len(block)
+
+            index_bytes = b''.join(
+                self.INDEX_ENTRY.pack(block_offset, block_length, len(key)) + key
+                for key, block_offset, block_length in index
+            )
+            f.write(index_bytes)
+            bloom_bytes = BloomFilter.for_keys([key for key, _ in items], self.bloom_bits_per_key).to_bytes()
+            f.write(bloom_bytes)
+            min_key = items[0][0]
+            max_key = items[-1][0]
+            timestamps = [key_timestamp(key) for key, _ in items]
+            timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+            footer = (self.ENTRY_HEADER.pack(len(min_key), len(max_key)) + min_key + max_key
+                      + self.TIME_RANGE.pack(bool(timestamps), min(timestamps, default=0), max(timestamps, default=0)))
+            f.write(footer)
+            f.write(self.TRAILER.pack(offset, raw_bytes, len(index_bytes), len(bloom_bytes), len(items),
+                                      len(footer), self.MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        self.data = OrderedDict()
+        self.load()
 
     def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache_id = next(self.ids)
+        (index_offset, raw_bytes, index_length, bloom_length, entry_count, footer_length,
+         magic) = self.TRAILER.unpack_from(self.mmap, len(self.mmap) - self.TRAILER.size)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.filename} is not an SSTable")
+        self.raw_bytes = raw_bytes
+        self.block_bytes = index_offset
+
+        self.entry_count = entry_count
+        self.index_keys = []
+        self.index_blocks = []
+        pos = index_offset
+        while pos < index_offset + index_length:
+            block_offset, block_length, key_len = self.INDEX_ENTRY.unpack_from(self.mmap, pos)
+            pos += self.INDEX_ENTRY.size
+            self.index_keys.append(self.mmap[pos:pos + key_len])
+            self.index_blocks.append((block_offset, block_length))
+            pos += key_len
+
+        pos = index_offset + index_length
+        self.bloom = BloomFilter.from_bytes(self.mmap[pos:pos + bloom_length])
+        pos += bloom_length
+        min_len, max_len = self.ENTRY_HEADER.unpack_from(self.mmap, pos)
+        pos += self.ENTRY_HEADER.size
+        self.min_key = self.mmap[pos:pos + min_len]
+        pos += min_len
+        self.max_key = self.mmap[pos:pos + max_len]
+        pos += max_len
+        has_time, min_time, max_time = self.TIME_RANGE.unpack_from(self.mmap, pos)
+        if has_time:
+            self.min_time, self.max_time = min_time, max_time
+        self.range_tombstones = [(key[len(RANGE_TOMBSTONE):], value)
+                                 for key, value in self.items(RANGE_TOMBSTONE, b'\x04', fill_cache=False)]
+
+    def remove(self):
+        # Open mappings stay valid after unlink, so snapshots still reading
+        # this table are unaffected.
         if os.path.exists(self.filename):
-            with open(self.filename, 'rb') as f:
-                self.data = pickle.load(f)
+            os.remove(self.filename)
+
+class WriteAheadLog:
+    # Each record is one write batch: crc32 and length of the body, then the
+    # body as (key length, value length, key, value) entries. A batch is
+    # replayed completely or not at all.
+    # The log is split into segments; each memtable is backed by the segments
+    # written while it was active and they are removed once it is flushed.
+    HEADER = struct.Struct('>II')
+    ENTRY_HEADER = ENTRY_HEADER
+
+    def __init__(self, prefix='wal', commit_interval=0.002, commit_bytes=1 << 20, directory='.'):
+        self.prefix = prefix
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.cond = threading.Condition()
+        self.written_seq = 0
+        self.synced_seq = 0
+        self.pending_bytes = 0
+        self.syncing = False
+        pattern = re.compile(rf'{re.escape(prefix)}_(\d+)\.log')
+        existing = sorted(int(match.group(1)) for match in map(pattern.fullmatch, os.listdir(directory)) if match)
+        self.replay_segments = [self._segment_name(number) for number in existing]
+        self.next_segment = existing[-1] + 1 if existing else 0
+        self._open_segment()
+
+    def _segment_name(self, number):
+        return os.path.join(self.directory, f"{self.prefix}_{number:06d}.log")
+
+    def _open_segment(self):
+        self.filename = self._segment_name(self.next_segment)
+        self.next_segment += 1
+        self.file = open(self.filename, 'ab')
+
+    def replay(self):
+        for filename in self.replay_segments:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + self.HEADER.size <= len(data):
+                crc, body_len = self.HEADER.unpack_from(data, offset)
+                start = offset + self.HEADER.size
+                end = start + body_len
+                body = data[start:end]
+                if len(body) != body_len or zlib.crc32(body) != crc:
+                    break  # Torn write from a crash; everything after it was never acked
+                pos = 0
+                while pos < body_len:
+                    key_len, value_len = self.ENTRY_HEADER.unpack_from(body, pos)
+                    pos += self.ENTRY_HEADER.size
+                    if value_len == TOMBSTONE_LENGTH:
+                        yield body[pos:pos + key_len], TOMBSTONE
+                        pos += key_len
+                        continue
+                    yield body[pos:pos + key_len], body[pos + key_len:pos + key_len + value_len]
+                    pos += key_len + value_len
+                offset = end
+            if offset < len(data):
+                os.truncate(filename, offset)
+
+    def append(self, items):
+        body = b''.join(encode_entry(key, value) for key, value in items)
+        record = self.HEADER.pack(zlib.crc32(body), len(body)) + body
+        with self.cond:
+            self.file.write(record)
+            self.written_seq += 1
+            self.pending_bytes += len(record)
+            if self.pending_bytes >= self.commit_bytes:
+                self.cond.notify_all()
+            return self.written_seq
+
+    def sync(self, seq):
+        # Group commit: the first waiter becomes the leader, holds the window
+        # open for commit_interval (or until commit_bytes are pending) so other
+        # writers can pile on, then issues a single fsync for all of them.
+        with self.cond:
+            while self.synced_seq < seq:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                deadline = time.monotonic() + self.commit_interval
+                while self.pending_bytes < self.commit_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                target = self.written_seq
+                self.file.flush()
+                self.pending_bytes = 0
+                self.cond.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.synced_seq = max(self.synced_seq, target)
+
+    def rotate(self):
+        # Seal the current segment and start a new one. Returns the sealed
+        # segment's filename.
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            sealed = self.filename
+            self.pending_bytes = 0
+            self.synced_seq = self.written_seq
+            self._open_segment()
+            self.cond.notify_all()
+            return sealed
+
+    def remove(self, filenames):
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def close(self):
+        # Makes everything written durable, so late sync() calls return.
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced_seq = self.written_seq
+            self.cond.notify_all()
+
+class LeveledCompaction:
+    # L0 tables overlap and are merged into L1 once there are l0_trigger of
+    # them. Every level below that is a single sorted run allowed to grow to
+    # base_level_bytes * size_ratio ** (level - 1) before being merged down.
+    # The last level has no limit, so nothing is ever dropped.
+    def __init__(self, l0_trigger=4, base_level_bytes=4 << 20, size_ratio=10):
+        self.l0_trigger = l0_trigger
+        self.base_level_bytes = base_level_bytes
+        self.size_ratio = size_ratio
+
+    def level_capacity(self, level):
+        return self.base_level_bytes * self.size_ratio ** (level - 1)
+
+    def pick(self, levels):
+        last_level = len(levels) - 1
+        if len(levels[0]) >= self.l0_trigger:
+            return 0, list(levels[0]), min(1, last_level)
+        for level in range(1, last_level):
+            if sum(sstable.size_bytes for sstable in levels[level]) > self.level_capacity(level):
+                return level, list(levels[level]), level + 1
+        return None
+
+    def backlog(self, levels):
+        return len(levels[0])
+
+class SizeTieredCompaction:
+    # All tables live in L0, oldest first. A run of at least min_threshold
+    # adjacent tables of similar size (within bucket_low..bucket_high of the
+    # run's average) is merged into one table in place. Only adjacent tables
+    # are merged so that newer data always sits after older data.
+    def __init__(self, min_threshold=4, max_threshold=32, bucket_low=0.5, bucket_high=1.5):
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.bucket_low = bucket_low
+        self.bucket_high = bucket_high
+
+    def _runs(self, sstables):
+        run = []
+        total = 0
+        for sstable in sstables:
+            size = sstable.size_bytes
+            if run and not (self.bucket_low * total / len(run) <= size <= self.bucket_high * total / len(run)):
+                yield run
+                run = []
+                total = 0
+            run.append(sstable)
+            total += size
+        if run:
+            yield run
+
+    def pick(self, levels):
+        for run in self._runs(levels[0]):
+            if len(run) >= self.min_threshold:
+                return 0, run[:self.max_threshold], 0
+        return None
+
+    def backlog(self, levels):
+        return max((len(run) for run in self._runs(levels[0])), default=0)
+
+COMPACTION_POLICIES = {
+    'leveled': LeveledCompaction,
+    'size-tiered': SizeTieredCompaction,
+}
+
+class Snapshot:
+    # Point-in-time view of the tree. SSTables and frozen memtables are never
+    # modified, so copying the active memtable and the level lists is enough
+    # for readers to see a consistent state while the writer keeps going.
+    # memtables are ordered oldest to newest, as are the tables in each level;
+    # lower levels are newer than higher ones. Scans of a snapshot taken
+    # with fill_cache=False leave the block cache as it is.
+    def __init__(self, memtables, levels, fill_cache=True):
+        self.memtables = memtables
+        self.levels = levels
+        self.fill_cache = fill_cache
+
+    @property
+    def memtable_data(self):
+        return self.memtables[-1].data
+
+    def filter(self, predicate):
+        # Returns a snapshot without the SSTables rejected by predicate, and
+        # the list of rejected tables.
+        levels = []
+        rejected = []
+        # Tables with range tombstones are always kept: they can hide data
+        # anywhere in the tables below them.
+        for level in self.levels:
+            levels.append([sstable for sstable in level if sstable.range_tombstones or predicate(sstable)])
+            rejected.extend(sstable for sstable in level if not sstable.range_tombstones and not predicate(sstable))
+        return Snapshot(self.memtables, levels, self.fill_cache), rejected
+
+    def scan(self, start=None, end=None):
+        # Sorted (key, value) pairs with start <= key < end, newest version of
+        # each key only, without deleted keys. Tables whose key range misses
+        # the slice are skipped, but their range tombstones still apply.
+        sources = []
+        shadows = []
+        ranges = []
+        for source in list(reversed(self.memtables)) + [sstable for level in self.levels for sstable in reversed(level)]:
+            if isinstance(source, MemTable):
+                sources.append(source.items(start, end))
+                shadows.append(ranges)
+            elif source.overlaps(start, end):
+                sources.append(source.items(start, end, self.fill_cache))
+                shadows.append(ranges)
+            ranges = ranges + [(low, high) for low, high in source.range_tombstones
+                               if (end is None or low < end) and (start is None or high > start)]
+        return ((key, value) for key, value in merge_sorted(sources, shadows)
+                if value is not TOMBSTONE and not key.startswith(RANGE_TOMBSTONE))
 
 class LSMTree:
-    def __init__(self, max_levels=4):
-        self.memtable = MemTable()
+    MANIFEST = 'MANIFEST'
+
+    def __init__(self, max_levels=4, memtable_size=1000, compaction_policy='leveled',
+                 l0_slowdown_trigger=8, l0_stop_trigger=12, max_immutable_memtables=4,
+                 wal_commit_interval=0.002, wal_commit_bytes=1 << 20, bloom_bits_per_key=10, directory='.',
+                 ttl=None, block_codecs=('none', 'zlib', 'zlib', 'lzma'), block_cache=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.manifest = os.path.join(directory, self.MANIFEST)
+        self.memtable = MemTable(memtable_size)
+        self.immutable_memtables = []  # (memtable, wal segments), oldest first
         self.levels = [[] for _ in range(max_levels)]
         self.max_levels = max_levels
+        if isinstance(compaction_policy, str):
+            compaction_policy = COMPACTION_POLICIES[compaction_policy]()
+        self.compaction_policy = compaction_policy
+        self.l0_slowdown_trigger = l0_slowdown_trigger
+        self.l0_stop_trigger = l0_stop_trigger
+        self.max_immutable_memtables = max_immutable_memtables
+        self.bloom_bits_per_key = bloom_bits_per_key
+        # Block codec per level; levels past the end use the last one. Fresh
+        # L0 tables are rewritten soon, so they favour speed, and the bottom
+        # level holds most of the data, so it favours size.
+        for codec in block_codecs:
+            if codec not in BLOCK_CODECS:
+                raise ValueError(f"Unknown block codec {codec!r}; expected one of {', '.join(BLOCK_CODECS)}")
+        self.block_codecs = block_codecs
+        self.block_stats = BlockStats()
+        self.block_cache = block_cache  # Shared BlockCache, or None to read blocks every time
+        # Entries whose key timestamp is more than ttl nanoseconds old are
+        # purged by compaction.
+        self.ttl = ttl
+        self.next_file_id = 0
+        self.stats_lock = threading.Lock()
+        self.bloom_stats = {'negatives': 0, 'positives': 0, 'false_positives': 0}
+        self.compaction_stats = {'flushes': 0, 'compactions': 0, 'slowdowns': 0, 'stops': 0,
+                                 'purged_entries': 0, 'expired_entries': 0}
+        # Optional callable that adds derived entries (such as rollups) to a
+        # table's entries before it is written, at flush and at compaction.
+        self.derive = None
+        # Optional callable(entries, get) that rewrites a memtable's entries
+        # before they are flushed (and before derive); get(key) returns the
+        # value the key had before that memtable.
+        self.fold = None
+        # Single writer: put() holds this lock. Readers only hold it long
+        # enough to take a snapshot; the compaction thread holds it only to
+        # install finished tables.
+        self.write_lock = threading.RLock()
+        self.work_cond = threading.Condition(self.write_lock)
+        self.closed = False
         self.load_existing_sstables()
+        self.wal = WriteAheadLog(commit_interval=wal_commit_interval, commit_bytes=wal_commit_bytes,
+                                 directory=directory)
+        for key, value in self.wal.replay():
+            self.memtable.put(key, value)
+        self.memtable_segments = self.wal.replay_segments + [self.wal.filename]
+        self.compaction_thread = threading.Thread(target=self._background_loop, name='lsm-compaction', daemon=True)
+        self.compaction_thread.start()
 
     def load_existing_sstables(self):
-        for level in range(self.max_levels):
-            i = 0
-            while True:
-                sstable = SSTable(level, i)
-                if os.path.exists(sstable.filename):
-                    sstable.load()
-                    self.levels[level].append(sstable)
-                    i += 1
-                else:
-                    break
+        # The manifest is the source of truth for which tables are live and in
+        # what order; anything else on disk is left over from an interrupted
+        # flush or compaction.
+        if not os.path.exists(self.manifest):
+            return
+        with open(self.manifest) as f:
+            manifest = json.load(f)
+        self.next_file_id = manifest['next_file_id']
+        live = set()
+        for level, file_ids in enumerate(manifest['levels'][:self.max_levels]):
+            for file_id in file_ids:
+                sstable = SSTable(level, file_id, self.bloom_bits_per_key, self.directory,
+                                  self.codec_for(level), self.block_stats, self.block_cache)
+                sstable.load()
+                self.levels[level].append(sstable)
+                live.add(sstable.filename)
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if re.fullmatch(r'level_\d+_sstable_\d+\.sst(\.tmp)?', filename) and path not in live:
+                os.remove(path)
+
+    def _save_manifest(self):
+        manifest = {
+            'next_file_id': self.next_file_id,
+            'levels': [[sstable.index for sstable in level] for level in self.levels],
+        }
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.manifest + '.tmp', self.manifest)
+
+    def codec_for(self, level):
+        return self.block_codecs[min(level, len(self.block_codecs) - 1)]
+
+    def _new_sstable(self, level):
+        with self.write_lock:
+            sstable = SSTable(level, self.next_file_id, self.bloom_bits_per_key, self.directory,
+                              self.codec_for(level), self.block_stats, self.block_cache)
+            self.next_file_id += 1
+            return sstable
 
     def put(self, key, value):
-        flushed_data = self.memtable.put(key, value)
-        if flushed_data:
-            self._compact(flushed_data, 0)
+        self.write_batch([(key, value)])
+
+    def delete(self, key):
+        self.write_batch([(key, TOMBSTONE)])
+
+    def delete_range(self, start, end):
+        # Deletes every key in [start, end).
+        self.write_batch([range_tombstone(start, end)])
+
+    def write_batch(self, items, wait=True):
+        # The batch is logged as a single WAL record and applied to the
+        # memtable under the write lock, so it is recovered and becomes
+        # visible to snapshots all at once. With wait=False the caller gets
+        # the WAL sequence number back and must call sync() before acking.
+        if not items:
+            return 0
+        with self.write_lock:
+            self._throttle()
+            seq = self.wal.append(items)
+            for key, value in items:
+                self.memtable.put(key, value)
+            if self.memtable.is_full():
+                self._freeze_memtable()
+        # Wait for durability outside the write lock so concurrent writers
+        # share one fsync.
+        if wait:
+            self.wal.sync(seq)
+        return seq
+
+    def sync(self, seq):
+        self.wal.sync(seq)
+
+    def _throttle(self):
+        # Called with write_lock held. Slow writers down a little once the
+        # compaction backlog grows and stop them entirely when it is too large,
+        # rather than letting L0 (and read amplification) grow without bound.
+        backlog = self.compaction_policy.backlog(self.levels)
+        if self.l0_slowdown_trigger <= backlog < self.l0_stop_trigger:
+            with self.stats_lock:
+                self.compaction_stats['slowdowns'] += 1
+            METRICS.inc('vm_write_stalls_total', kind='slowdown')
+            self.work_cond.wait(0.001)
+        while (len(self.immutable_memtables) >= self.max_immutable_memtables
+               or (self.compaction_policy.backlog(self.levels) >= self.l0_stop_trigger
+                   and self.compaction_policy.pick(self.levels) is not None)):
+            with self.stats_lock:
+                self.compaction_stats['stops'] += 1
+            METRICS.inc('vm_write_stalls_total', kind='stop')
+            self.work_cond.wait()
+
+    def _freeze_memtable(self):
+        # Hand the full memtable to the compaction thread and start a new one
+        # backed by a fresh WAL segment.
+        self.wal.rotate()
+        self.immutable_memtables.append((self.memtable, self.memtable_segments))
+        self.memtable = MemTable(self.memtable.max_size)
+        self.memtable_segments = [self.wal.filename]
+        self.work_cond.notify_all()
+
+    def flush(self):
+        # Flush the active memtable and wait until every frozen memtable is
+        # on disk.
+        with self.work_cond:
+            if self.memtable.data:
+                self._freeze_memtable()
+            while self.immutable_memtables:
+                self.work_cond.wait()
+
+    def snapshot(self, fill_cache=True):
+        with self.write_lock:
+            memtables = [memtable for memtable, _ in self.immutable_memtables]
+            memtables.append(self.memtable.copy())
+            return Snapshot(memtables, [list(level) for level in self.levels], fill_cache)
+
+    def scan(self, start=None, end=None):
+        return self.snapshot().scan(start, end)
 
     def get(self, key):
-        value = self.memtable.get(key)
-        if value:
-            return value
+        # Memtables are checked under the lock rather than copied into a
+        # full snapshot; only the level lists need to be captured. A source's
+        # own entry for the key is newer than its range tombstones.
+        with self.write_lock:
+            for memtable in [self.memtable] + [memtable for memtable, _ in reversed(self.immutable_memtables)]:
+                value = memtable.get(key)
+                if value is not None:
+                    return value if value is not TOMBSTONE else None
+                if covered(memtable.range_tombstones, key):
+                    return None
+            levels = [list(level) for level in self.levels]
+        return self._get_from(levels, key)
 
-        for level in range(self.max_levels):
-            for sstable in self.levels[level]:
-                value = sstable.get(key)
-                if value:
-                    return value
+    def _get_from(self, levels, key):
+        negatives = positives = false_positives = 0
+        try:
+            for level in levels:
+                for sstable in reversed(level):
+                    if not sstable.might_contain(key):
+                        negatives += 1
+                    else:
+                        positives += 1
+                        value = sstable.get(key)
+                        if value is not None:
+                            return value if value is not TOMBSTONE else None
+                        false_positives += 1
+                    if covered(sstable.range_tombstones, key):
+                        return None
+            return None
+        finally:
+            with self.stats_lock:
+                self.bloom_stats['negatives'] += negatives
+                self.bloom_stats['positives'] += positives
+                self.bloom_stats['false_positives'] += false_positives
 
-        return None
+    def stats(self):
+        snapshot = self.snapshot()
+        with self.stats_lock:
+            bloom = dict(self.bloom_stats)
+            compaction = dict(self.compaction_stats)
+        bloom['bits_per_key'] = self.bloom_bits_per_key
+        bloom['bytes'] = sum(len(sstable.bloom.bits) for level in snapshot.levels
+                             for sstable in level if sstable.bloom is not None)
+        absent = bloom['false_positives'] + bloom['negatives']
+        bloom['false_positive_rate'] = bloom['false_positives'] / absent if absent else 0.0
+        compaction['policy'] = type(self.compaction_policy).__name__
+        compaction['immutable_memtables'] = len(snapshot.memtables) - 1
+        compression = {'levels': [], 'decode': self.block_stats.info()}
+        for level, sstables in enumerate(snapshot.levels):
+            raw_bytes = sum(sstable.raw_bytes for sstable in sstables)
+            block_bytes = sum(sstable.block_bytes for sstable in sstables)
+            compression['levels'].append({
+                'codec': self.codec_for(level),
+                'raw_bytes': raw_bytes,
+                'block_bytes': block_bytes,
+                'ratio': raw_bytes / block_bytes if block_bytes else None,
+            })
+        return {
+            'memtable_entries': len(snapshot.memtable_data),
+            'sstables': [len(level) for level in snapshot.levels],
+            'level_bytes': [sum(sstable.size_bytes for sstable in level) for level in snapshot.levels],
+            'bloom_filter': bloom,
+            'compaction': compaction,
+            'compression': compression,
+        }
+
+    def close(self):
+        with self.work_cond:
+            self.closed = True
+            self.work_cond.notify_all()
+        self.compaction_thread.join()
+        self.wal.close()
+
+    def _background_loop(self):
+        while True:
+            with self.work_cond:
+                job = None
+                while not self.immutable_memtables:
+                    if self.closed:
+                        return
+                    job = self.compaction_policy.pick(self.levels)
+                    if job is not None:
+                        break
+                    self.work_cond.wait()
+                if self.immutable_memtables:
+                    memtable, segments = self.immutable_memtables[0]
+            try:
+                if job is None:
+                    self._flush_memtable(memtable, segments)
+                else:
+                    self._compact(*job)
+            except Exception as e:
+                print(f"Background compaction failed: {e}")
+                time.sleep(1)
+
+    def _flush_memtable(self, memtable, segments):
+        started = time.perf_counter()
+        sstable = self._new_sstable(0)
+        for key, value in memtable.data.items():
+            sstable.put(key, value)
+        if self.fold is not None:
+            # Older memtables are already flushed and only this thread
+            # changes the levels.
+            levels = [list(level) for level in self.levels]
+            self.fold(sstable.data, lambda key: None if covered(memtable.range_tombstones, key)
+                      else self._get_from(levels, key))
+        if self.derive is not None:
+            self.derive(sstable.data)
+        sstable.save()
+        with self.work_cond:
+            self.levels[0].append(sstable)
+            self.immutable_memtables.pop(0)
+            self._save_manifest()
+            self.work_cond.notify_all()
+        self.wal.remove(segments)
+        with self.stats_lock:
+            self.compaction_stats['flushes'] += 1
+        METRICS.observe('vm_memtable_flush_seconds', time.perf_counter() - started)
+        METRICS.inc('vm_memtable_flushed_entries_total', len(memtable.data))
+        METRICS.inc('vm_sstable_bytes_written_total', sstable.size_bytes, reason='flush')
+
+    def _compact(self, level, sstables, output_level):
+        # Only this thread changes the levels, so the inputs can be read
+        # without holding the write lock. Sources are merged oldest first.
+        # Data hidden by newer tombstones is dropped; the tombstones
+        # themselves are only dropped when no older table remains below the
+        # output, and until then expired entries become tombstones too.
+        started = time.perf_counter()
+        sources = list(self.levels[output_level]) if output_level != level else []
+        sources += sstables
+        if output_level == level:
+            bottom = self.levels[level][0] is sstables[0] and not any(self.levels[level + 1:])
+        else:
+            bottom = not any(self.levels[output_level + 1:])
+        cutoff = time.time_ns() - self.ttl if self.ttl is not None else None
+        output = self._new_sstable(output_level)
+        shadows = []
+        ranges = []
+        for sstable in reversed(sources):
+            shadows.append(ranges)
+            ranges = ranges + sstable.range_tombstones
+        purged = expired = 0
+        # Compaction reads every block once; caching them would only evict
+        # the blocks queries use.
+        for key, value in merge_sorted([sstable.items(fill_cache=False) for sstable in reversed(sources)], shadows):
+            if key.startswith(RANGE_TOMBSTONE):
+                continue
+            if cutoff is not None and value is not TOMBSTONE:
+                timestamp = key_timestamp(key)
+                if timestamp is not None and timestamp < cutoff:
+                    expired += 1
+                    value = TOMBSTONE
+            if value is TOMBSTONE and bottom:
+                purged += 1
+                continue
+            output.put(key, value)
+        if not bottom:
+            for start, end in merge_ranges(ranges):
+                output.put(*range_tombstone(start, end))
+        if self.derive is not None:
+            self.derive(output.data)
+        # Everything may have been deleted, leaving no table to write.
+        outputs = [output] if output.data else []
+        for output in outputs:
+            output.save()
+
+        with self.work_cond:
+            if output_level == level:
+                position = next(i for i, sstable in enumerate(self.levels[level]) if sstable is sstables[0])
+                self.levels[level][position:position + len(sstables)] = outputs
+            else:
+                self.levels[level] = [sstable for sstable in self.levels[level]
+                                      if not any(sstable is merged for merged in sstables)]
+                self.levels[output_level] = outputs
+            self._save_manifest()
+            self.work_cond.notify_all()
+        for sstable in sources:
+            sstable.remove()
+        with self.stats_lock:
+            self.compaction_stats['compactions'] += 1
+            self.compaction_stats['purged_entries'] += purged
+            self.compaction_stats['expired_entries'] += expired
+        METRICS.observe('vm_compaction_seconds', time.perf_counter() - started, level=output_level)
+        METRICS.inc('vm_compaction_purged_entries_total', purged)
+        METRICS.inc('vm_compaction_expired_entries_total', expired)
+        METRICS.inc('vm_sstable_bytes_written_total', sum(output.size_bytes for output in outputs), reason='compaction')
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+
+    def write(self, value, bits):
+        self.acc = (self.acc << bits) | value
+        self.acc_bits += bits
+        while self.acc_bits >= 8:
+            self.acc_bits -= 8
+            self.buffer.append((self.acc >> self.acc_bits) & 0xff)
+        self.acc &= (1 << self.acc_bits) - 1
+
+    def getvalue(self):
+        if self.acc_bits:
+            return bytes(self.buffer) + bytes([(self.acc << (8 - self.acc_bits)) & 0xff])
+        return bytes(self.buffer)
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, bits):
+        if bits == 0:
+            return 0
+        start = self.pos >> 3
+        end = (self.pos + bits + 7) >> 3
+        window = int.from_bytes(self.data[start:end], 'big')
+        shift = (end << 3) - self.pos - bits
+        self.pos += bits
+        return (window >> shift) & ((1 << bits) - 1)
+
+def zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def unzigzag(z):
+    return z >> 1 if not z & 1 else -((z + 1) >> 1)
+
+# Delta-of-delta buckets as (prefix, prefix bits, payload bits). A zero
+# delta-of-delta (perfectly regular scrape interval) costs a single bit; the
+# wider buckets cover nanosecond jitter.
+DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 14), (0b1110, 4, 28), (0b11110, 5, 40), (0b11111, 5, 64))
+FLOAT = struct.Struct('>d')
+UINT64 = struct.Struct('>Q')
+
+def encode_timestamps(timestamps):
+    writer = BitWriter()
+    prev = timestamps[0]
+    prev_delta = 0
+    for timestamp in timestamps[1:]:
+        delta = timestamp - prev
+        dod = zigzag(delta - prev_delta)
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for prefix, prefix_bits, bits in DOD_BUCKETS:
+                if dod < (1 << bits):
+                    writer.write(prefix, prefix_bits)
+                    writer.write(dod, bits)
+                    break
+        prev, prev_delta = timestamp, delta
+    return writer.getvalue()
+
+def decode_timestamps(first, count, data):
+    reader = BitReader(data)
+    timestamps = array('q', [first])
+    prev = first
+    prev_delta = 0
+    for _ in range(count - 1):
+        if reader.read(1) == 0:
+            dod = 0
+        else:
+            prefix_bits = 1
+            while prefix_bits < 5 and reader.read(1) == 1:
+                prefix_bits += 1
+            dod = unzigzag(reader.read(DOD_BUCKETS[prefix_bits - 1][2]))
+        prev_delta += dod
+        prev += prev_delta
+        timestamps.append(prev)
+    return timestamps
+
+def encode_floats(values):
+    # Gorilla XOR encoding: each value is XORed with the previous one and only
+    # the meaningful bits are stored, reusing the previous leading/trailing
+    # zero window when the new XOR fits inside it.
+    writer = BitWriter()
+    prev = UINT64.unpack(FLOAT.pack(values[0]))[0]
+    writer.write(prev, 64)
+    prev_leading = prev_trailing = None
+    for value in values[1:]:
+        bits = UINT64.unpack(FLOAT.pack(value))[0]
+        xor = bits ^ prev
+        if xor == 0:
+            writer.write(0, 1)
+        else:
+            leading = min(64 - xor.bit_length(), 31)
+            trailing = (xor & -xor).bit_length() - 1
+            if prev_leading is not None and leading >= prev_leading and trailing >= prev_trailing:
+                writer.write(0b10, 2)
+                writer.write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+            else:
+                meaningful = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(meaningful & 63, 6)  # 64 is stored as 0
+                writer.write(xor >> trailing, meaningful)
+                prev_leading, prev_trailing = leading, trailing
+        prev = bits
+    return writer.getvalue()
+
+def decode_floats(count, data):
+    reader = BitReader(data)
+    prev = reader.read(64)
+    values = array('d', FLOAT.unpack(UINT64.pack(prev)))
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            prev ^= reader.read(64 - leading - trailing) << trailing
+        values.append(FLOAT.unpack(UINT64.pack(prev))[0])
+    return values
+
+def encode_integers(values):
+    # Deltas between consecutive values, zigzag-encoded as LEB128 varints;
+    # exact over the whole int64 range.
+    output = bytearray()
+    prev = 0
+    for value in values:
+        z = zigzag(value - prev)
+        prev = value
+        while z >= 0x80:
+            output.append((z & 0x7f) | 0x80)
+            z >>= 7
+        output.append(z)
+    return bytes(output)
+
+def decode_integers(count, data):
+    values = array('q')
+    prev = 0
+    pos = 0
+    for _ in range(count):
+        z = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            z |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        prev += unzigzag(z)
+        values.append(prev)
+    return values
+
+def field_kind(value):
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, int):
+        return 'i'
+    if isinstance(value, float):
+        return 'f'
+    return 's'
+
+def is_present(kind, value):
+    if kind == 'f':
+        return not math.isnan(value)
+    return value is not None
+
+class Chunk:
+    # Columnar block of one series' points, stored as a single LSM value.
+    # timestamps is a sorted array('q'); fields maps a field name to
+    # (kind, values) with one slot per timestamp. Floats ('f') decode to
+    # array('d') with NaN marking an absent value. Integers ('i') decode to
+    # array('q') when every point has the field and to a list with None
+    # otherwise, like strings ('s') and booleans ('b'). Integer columns are
+    # stored as kind 'I' (zigzag delta varints); kind 'i' columns written
+    # before that hold Gorilla-encoded floats and are still read.
+    HEADER = struct.Struct('>qIIH')
+    COLUMN_HEADER = struct.Struct('>HcII')
+
+    def __init__(self, timestamps, fields):
+        self.timestamps = timestamps
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows maps timestamp -> {field: value}.
+        timestamps = array('q', sorted(rows))
+        kinds = {}
+        for fields in rows.values():
+            for name, value in fields.items():
+                kind = field_kind(value)
+                previous = kinds.setdefault(name, kind)
+                if previous != kind:
+                    # Ints widen to floats; any other conflict is kept as text.
+                    kinds[name] = 'f' if {previous, kind} == {'f', 'i'} else 's'
+
+        columns = {}
+        for name, kind in kinds.items():
+            if kind == 'f':
+                values = array('d', (float(rows[ts].get(name, math.nan)) for ts in timestamps))
+            elif kind == 'i':
+                values = [rows[ts].get(name) for ts in timestamps]
+                if None not in values:
+                    values = array('q', values)
+            elif kind == 's':
+                values = [None if rows[ts].get(name) is None else str(rows[ts][name]) for ts in timestamps]
+            else:
+                values = [rows[ts].get(name) for ts in timestamps]
+            columns[name] = (kind, values)
+        return cls(timestamps, columns)
+
+    def rows(self):
+        for i, timestamp in enumerate(self.timestamps):
+            fields = {}
+            for name, (kind, values) in self.fields.items():
+                value = values[i]
+                if is_present(kind, value):
+                    fields[name] = int(value) if kind == 'i' else value
+            yield timestamp, fields
+
+    def slice(self, start_time=None, end_time=None):
+        first = 0 if start_time is None else bisect.bisect_left(self.timestamps, start_time)
+        last = len(self.timestamps) if end_time is None else bisect.bisect_right(self.timestamps, end_time)
+        if first == 0 and last == len(self.timestamps):
+            return self
+        return Chunk(self.timestamps[first:last],
+                     {name: (kind, values[first:last]) for name, (kind, values) in self.fields.items()})
+
+    def encode(self):
+        timestamp_bytes = encode_timestamps(self.timestamps)
+        columns = []
+        for name, (kind, values) in sorted(self.fields.items()):
+            present = [is_present(kind, value) for value in values]
+            if not any(present):
+                continue
+            bitmap = b''
+            if not all(present):
+                bitmap = bytearray((len(values) + 7) // 8)
+                for i, flag in enumerate(present):
+                    if flag:
+                        bitmap[i >> 3] |= 0x80 >> (i & 7)
+            present_values = [value for value, flag in zip(values, present) if flag]
+            if kind == 'f':
+                payload = encode_floats(present_values)
+            elif kind == 'i':
+                payload = encode_integers(present_values)
+                kind = 'I'
+            elif kind == 's':
+                payload = b''.join(struct.pack('>I', len(value.encode('utf-8'))) + value.encode('utf-8')
+                                   for value in present_values)
+            else:
+                writer = BitWriter()
+                for value in present_values:
+                    writer.write(int(value), 1)
+                payload = writer.getvalue()
+            name = name.encode('utf-8')
+            columns.append(self.COLUMN_HEADER.pack(len(name), kind.encode(), len(bitmap), len(payload))
+                           + name + bytes(bitmap) + payload)
+        header = self.HEADER.pack(self.timestamps[0], len(self.timestamps), len(timestamp_bytes), len(columns))
+        return header + timestamp_bytes + b''.join(columns)
+
+    @classmethod
+    def decode(cls, data):
+        first, count, timestamp_length, column_count = cls.HEADER.unpack_from(data)
+        pos = cls.HEADER.size
+        timestamps = decode_timestamps(first, count, data[pos:pos + timestamp_length])
+        pos += timestamp_length
+        fields = {}
+        for _ in range(column_count):
+            name_length, kind, bitmap_length, payload_length = cls.COLUMN_HEADER.unpack_from(data, pos)
+            pos += cls.COLUMN_HEADER.size
+            name = bytes(data[pos:pos + name_length]).decode('utf-8')
+            pos += name_length
+            bitmap = data[pos:pos + bitmap_length]
+            pos += bitmap_length
+            payload = data[pos:pos + payload_length]
+            pos += payload_length
+
+            kind = kind.decode()
+            if bitmap_length:
+                present = [bool(bitmap[i >> 3] & (0x80 >> (i & 7))) for i in range(count)]
+            else:
+                present = [True] * count
+            present_count = sum(present)
+            if kind == 'f':
+                decoded = decode_floats(present_count, payload)
+            elif kind == 'I':
+                decoded = decode_integers(present_count, payload)
+                kind = 'i'
+            elif kind == 'i':
+                decoded = array('q', (int(value) for value in decode_floats(present_count, payload)))
+            elif kind == 's':
+                decoded = []
+                offset = 0
+                for _ in range(present_count):
+                    length = struct.unpack_from('>I', payload, offset)[0]
+                    decoded.append(bytes(payload[offset + 4:offset + 4 + length]).decode('utf-8'))
+                    offset += 4 + length
+            else:
+                reader = BitReader(payload)
+                decoded = [bool(reader.read(1)) for _ in range(present_count)]
+
+            if present_count == count:
+                values = decoded
+            else:
+                missing = math.nan if kind == 'f' else None
+                it = iter(decoded)
+                values = [next(it) if flag else missing for flag in present]
+                if kind == 'f':
+                    values = array('d', values)
+            fields[name] = (kind, values)
+        return cls(timestamps, fields)
+
+def merge_chunks(values):
+    # Merges encoded chunks of one window, oldest first. Field values from
+    # newer chunks win for timestamps present in several. Chunks that follow
+    # each other in time with matching field kinds are concatenated column
+    # by column; anything else goes through rows.
+    chunks = [Chunk.decode(value) for value in values]
+    if len(chunks) == 1:
+        return chunks[0]
+    kinds = {}
+    ordered = all(older.timestamps[-1] < newer.timestamps[0] for older, newer in zip(chunks, chunks[1:]))
+    for chunk in chunks:
+        for name, (kind, _) in chunk.fields.items():
+            ordered = ordered and kinds.setdefault(name, kind) == kind
+    if not ordered:
+        rows = {}
+        for chunk in chunks:
+            for timestamp, fields in chunk.rows():
+                rows.setdefault(timestamp, {}).update(fields)
+        return Chunk.from_rows(rows)
+
+    timestamps = array('q')
+    for chunk in chunks:
+        timestamps.extend(chunk.timestamps)
+    fields = {}
+    for name, kind in kinds.items():
+        columns = [chunk.fields.get(name, (kind, None))[1] for chunk in chunks]
+        if kind == 'f':
+            values = array('d')
+            for chunk, column in zip(chunks, columns):
+                values.extend(column if column is not None else array('d', [math.nan]) * len(chunk))
+        elif kind == 'i' and all(isinstance(column, array) for column in columns):
+            values = array('q')
+            for column in columns:
+                values.extend(column)
+        else:
+            values = []
+            for chunk, column in zip(chunks, columns):
+                values.extend(column if column is not None else [None] * len(chunk))
+        fields[name] = (kind, values)
+    return Chunk(timestamps, fields)
+
+def fold_fragments(entries, get):
+    # LSMTree.fold for time series trees: merges the fragments in a memtable
+    # into their chunks, so tables only ever hold whole chunks. Fragments are
+    # newer than any stored version of their chunk.
+    groups = {}
+    for key in entries:
+        if key_timestamp(key) is not None:
+            base = chunk_key(key)
+            if base != key:
+                groups.setdefault(base, []).append(key)
+    for base, keys in groups.items():
+        values = [value for value in (entries.pop(key) for key in sorted(keys)) if value is not TOMBSTONE]
+        existing = entries[base] if base in entries else get(base)
+        if existing is not None and existing is not TOMBSTONE:
+            values.insert(0, existing)
+        if values:
+            entries[base] = merge_chunks(values).encode()
+
+def column_arrays(kind, values):
+    # A chunk column as (present mask, float64 values) for vectorized use.
+    # Integers and booleans (as 0/1) become floats; strings are present but
+    # have no numeric value.
+    if kind == 'f':
+        numeric = np.frombuffer(values, dtype=np.float64) if isinstance(values, array) else np.array(values)
+        return ~np.isnan(numeric), numeric
+    if kind == 'i' and isinstance(values, array):
+        return np.ones(len(values), dtype=bool), np.frombuffer(values, dtype=np.int64).astype(np.float64)
+    present = np.array([value is not None for value in values], dtype=bool)
+    if kind in ('i', 'b'):
+        return present, np.array([float(value) if value is not None else np.nan for value in values])
+    return present, np.full(len(values), np.nan)
+
+class Rollups:
+    # Per-series, per-field partial aggregates (count, numeric count, sum, min,
+    # max) over fixed time buckets, one entry per rule and chunk in their own
+    # key space. Entries are derived from the chunks of a table when it is
+    # flushed, so a chunk and its rollups always live in the same table and
+    # resolve to the same version. Compaction reuses entries whose source
+    # chunk is unchanged (by crc32) and computes missing ones, and each table
+    # carries a marker key per rule so readers know it is fully covered.
+    # Deleted chunks get tombstones for their rollups the same way.
+    PREFIX = b'\x02'
+    HEADER = struct.Struct('>IIH')
+    NAME = struct.Struct('>H')
+
+    def __init__(self, rules=('1m', '1h', '1d')):
+        self.rules = {name: parse_duration(name) for name in rules}
+
+    def marker_key(self, name):
+        return self.PREFIX + name.encode('utf-8')
+
+    def entry_key(self, name, chunk_key):
+        return self.marker_key(name) + KEY_SEPARATOR + chunk_key
+
+    def covers(self, sstable, name):
+        return sstable.get(self.marker_key(name)) is not None
+
+    def derive(self, entries):
+        previous = {key: entries.pop(key) for key in [key for key in entries if key.startswith(self.PREFIX)]}
+        for key, value in list(entries.items()):
+            if key_timestamp(key) is None:
+                continue
+            if value is TOMBSTONE:
+                # Hide the deleted chunk's rollups in older tables too.
+                for name in self.rules:
+                    entries[self.entry_key(name, key)] = TOMBSTONE
+                continue
+            crc = zlib.crc32(value)
+            chunk = None
+            for name, interval in self.rules.items():
+                rollup_key = self.entry_key(name, key)
+                old = previous.get(rollup_key)
+                if old is not None and old is not TOMBSTONE and self.HEADER.unpack_from(old)[0] == crc:
+                    entries[rollup_key] = old
+                    continue
+                if chunk is None:
+                    chunk = Chunk.decode(value)
+                entries[rollup_key] = self.encode(crc, *self.summarize(chunk, interval))
+        for name in self.rules:
+            entries[self.marker_key(name)] = b''
+
+    @staticmethod
+    def summarize(chunk, interval):
+        # (bucket start times, {field: (count, numeric count, sum, min, max)})
+        timestamps = np.frombuffer(chunk.timestamps, dtype=np.int64)
+        buckets = np.floor_divide(timestamps, interval)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        columns = {}
+        for name, (kind, values) in chunk.fields.items():
+            present, numeric = column_arrays(kind, values)
+            valid = present & ~np.isnan(numeric)
+            columns[name] = (
+                np.add.reduceat(present.astype(np.int64), starts),
+                np.add.reduceat(valid.astype(np.int64), starts),
+                np.add.reduceat(np.where(valid, numeric, 0.0), starts),
+                np.fmin.reduceat(np.where(valid, numeric, np.nan), starts),
+                np.fmax.reduceat(np.where(valid, numeric, np.nan), starts),
+            )
+        return buckets[starts] * interval, columns
+
+    def encode(self, crc, times, columns):
+        parts = [self.HEADER.pack(crc, len(times), len(columns)), times.astype('<i8').tobytes()]
+        for name, (count, valid, sums, mins, maxs) in sorted(columns.items()):
+            name = name.encode('utf-8')
+            parts.append(self.NAME.pack(len(name)) + name)
+            parts += [count.astype('<i8').tobytes(), valid.astype('<i8').tobytes(),
+                      sums.astype('<f8').tobytes(), mins.astype('<f8').tobytes(), maxs.astype('<f8').tobytes()]
+        return b''.join(parts)
+
+    def decode(self, data, fields=None):
+        _, bucket_count, column_count = self.HEADER.unpack_from(data)
+        pos = self.HEADER.size
+        times = np.frombuffer(data, dtype='<i8', count=bucket_count, offset=pos)
+        pos += 8 * bucket_count
+        columns = {}
+        for _ in range(column_count):
+            name_length = self.NAME.unpack_from(data, pos)[0]
+            pos += self.NAME.size
+            name = bytes(data[pos:pos + name_length]).decode('utf-8')
+            pos += name_length
+            if fields is None or name in fields:
+                columns[name] = tuple(np.frombuffer(data, dtype=dtype, count=bucket_count, offset=pos + 8 * bucket_count * i)
+                                      for i, dtype in enumerate(('<i8', '<i8', '<f8', '<f8', '<f8')))
+            pos += 5 * 8 * bucket_count
+        return times, columns
+
+def parse_series_key(series):
+    return dict(tag.split('=', 1) for tag in series.split(',') if '=' in tag)
+
+class SeriesIndex:
+    # Inverted index: measurement -> tag key -> tag value -> set of series.
+    # Each series is persisted once as an entry in its own key space of the
+    # LSM tree (written in the same batch as its first chunk); the postings
+    # are rebuilt from those entries at startup since a series key already
+    # carries its tags.
+    PREFIX = b'\x01'
+
+    def __init__(self, lsm_tree):
+        self.series = {}  # measurement -> set of series
+        self.postings = {}
+        self.lock = threading.Lock()
+        for key, _ in lsm_tree.scan(self.PREFIX, b'\x02'):
+            measurement, series = key[len(self.PREFIX):].split(KEY_SEPARATOR)
+            self.add(measurement.decode('utf-8'), series.decode('utf-8'))
+
+    def entry_key(self, measurement, series):
+        return self.PREFIX + measurement.encode('utf-8') + KEY_SEPARATOR + series.encode('utf-8')
+
+    def contains(self, measurement, series):
+        return series in self.series.get(measurement, ())
+
+    def add(self, measurement, series):
+        with self.lock:
+            self.series.setdefault(measurement, set()).add(series)
+            tag_postings = self.postings.setdefault(measurement, {})
+            for tag_key, tag_value in parse_series_key(series).items():
+                tag_postings.setdefault(tag_key, {}).setdefault(tag_value, set()).add(series)
+
+    def remove(self, measurement, series):
+        with self.lock:
+            self.series.get(measurement, set()).discard(series)
+            tag_postings = self.postings.get(measurement, {})
+            for tag_key, tag_value in parse_series_key(series).items():
+                tag_postings.get(tag_key, {}).get(tag_value, set()).discard(series)
+
+    def tag_keys(self, measurement):
+        with self.lock:
+            return set(self.postings.get(measurement, {}))
+
+    def lookup(self, measurement, tag_filters):
+        # Series of the measurement matching every tag_key=tag_value filter,
+        # intersecting the smallest postings lists first.
+        with self.lock:
+            if not tag_filters:
+                return set(self.series.get(measurement, ()))
+            tag_postings = self.postings.get(measurement, {})
+            postings = sorted((tag_postings.get(tag_key, {}).get(tag_value, set())
+                               for tag_key, tag_value in tag_filters.items()), key=len)
+            result = set(postings[0])
+            for series in postings[1:]:
+                result &= series
+                if not result:
+                    break
+            return result
+
+    def cardinality(self):
+        with self.lock:
+            return {measurement: len(series) for measurement, series in self.series.items()}
 
-    def _compact(self, data, level):
-        if level >= self.max_levels:
+class PartitionedSnapshot:
+    # Snapshots of several partitions read as one. Partitions hold disjoint
+    # time windows, so their keys never collide.
+    def __init__(self, partitions):
+        self.partitions = partitions  # name -> Snapshot, oldest first
+
+    @property
+    def names(self):
+        return list(self.partitions)
+
+    @property
+    def memtables(self):
+        return [memtable for snapshot in self.partitions.values() for memtable in snapshot.memtables]
+
+    @property
+    def levels(self):
+        levels = []
+        for snapshot in self.partitions.values():
+            for level, sstables in enumerate(snapshot.levels):
+                if level == len(levels):
+                    levels.append([])
+                levels[level].extend(sstables)
+        return levels
+
+    def filter(self, predicate):
+        partitions = {}
+        rejected = []
+        for name, snapshot in self.partitions.items():
+            partitions[name], partition_rejected = snapshot.filter(predicate)
+            rejected.extend(partition_rejected)
+        return PartitionedSnapshot(partitions), rejected
+
+    def scan(self, start=None, end=None):
+        return merge_sorted([snapshot.scan(start, end) for snapshot in self.partitions.values()])
+
+class TimeSeriesStore:
+    # Stores points grouped by series into Chunks covering aligned
+    # chunk_duration windows, keyed by the series and the window start.
+    # Chunks are spread over time partitions of partition_duration, each its
+    # own LSM tree under partitions/, so queries only open the partitions
+    # their time range overlaps and retention deletes whole directories
+    # instead of compacting expired data away. Partitions not used for
+    # idle_timeout seconds are flushed and closed. The series index lives in
+    # a separate tree under index/ and is kept when partitions expire.
+    PARTITION_NAME = '%Y%m%dT%H%M%SZ'
+
+    def __init__(self, directory='.', chunk_duration=600 * 10**9, partition_duration=86400 * 10**9,
+                 retention=None, idle_timeout=600, maintenance_interval=60, rollups=('1m', '1h', '1d'),
+                 **tree_options):
+        if partition_duration % chunk_duration or partition_duration % 10**9:
+            raise ValueError("partition_duration must be a whole number of seconds and of chunk_duration")
+        self.chunk_duration = chunk_duration
+        self.partition_duration = partition_duration
+        self.retention = retention
+        self.idle_timeout = idle_timeout
+        self.partitions_directory = os.path.join(directory, 'partitions')
+        os.makedirs(self.partitions_directory, exist_ok=True)
+        self.tree_options = tree_options
+        self.rollups = Rollups(rollups)
+        self.index_tree = LSMTree(directory=os.path.join(directory, 'index'), **tree_options)
+        self.index = SeriesIndex(self.index_tree)
+        # Called as on_change(measurement, start, end) once written points are
+        # visible, and with measurement None when a partition is dropped.
+        self.on_change = None
+        # partition start -> LSMTree, or None while it is closed.
+        self.partitions = {self.partition_start(self._parse_name(name)): None
+                           for name in os.listdir(self.partitions_directory)}
+        self.last_used = {}
+        self.partition_stats = {'expired_points': 0, 'dropped': 0, 'closed': 0}
+        self.partitions_lock = threading.Lock()
+        # Serializes writes and deletes: fragment sequence numbers must grow
+        # in write order, and deletes rewrite the chunks at their edges.
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.stopped = threading.Event()
+        self.maintenance_interval = maintenance_interval
+        self.maintenance_thread = threading.Thread(target=self._maintenance_loop, name='partition-maintenance',
+                                                   daemon=True)
+        self.maintenance_thread.start()
+
+    def chunk_start(self, timestamp):
+        return timestamp - timestamp % self.chunk_duration
+
+    def partition_start(self, timestamp):
+        return timestamp - timestamp % self.partition_duration
+
+    def _name(self, start):
+        return datetime.fromtimestamp(start // 10**9, timezone.utc).strftime(self.PARTITION_NAME)
+
+    def _parse_name(self, name):
+        moment = datetime.strptime(name, self.PARTITION_NAME).replace(tzinfo=timezone.utc)
+        return int(moment.timestamp()) * 10**9
+
+    def _partition(self, start):
+        # Called with partitions_lock held. Opens (or creates) the partition.
+        # Chunks are purged by compaction once their whole window is past
+        # the retention period.
+        tree = self.partitions.get(start)
+        if tree is None:
+            ttl = self.retention + self.chunk_duration if self.retention is not None else None
+            tree = LSMTree(directory=os.path.join(self.partitions_directory, self._name(start)), ttl=ttl,
+                           **self.tree_options)
+            tree.fold = fold_fragments
+            tree.derive = self.rollups.derive
+            self.partitions[start] = tree
+        self.last_used[start] = time.monotonic()
+        return tree
+
+    def retention_cutoff(self):
+        if self.retention is None:
+            return None
+        return time.time_ns() - self.retention
+
+    def write(self, points):
+        # Returns the number of points stored; points older than the
+        # retention period are skipped.
+        cutoff = self.retention_cutoff()
+        groups = {}  # partition start -> chunk key -> rows
+        batch_series = set()
+        spans = {}
+        expired = 0
+        for point in points:
+            timestamp = int(point['timestamp'])
+            if cutoff is not None and timestamp < cutoff:
+                expired += 1
+                continue
+            series = series_key(point['tags'])
+            batch_series.add((point['measurement'], series))
+            low, high = spans.get(point['measurement'], (timestamp, timestamp))
+            spans[point['measurement']] = (min(low, timestamp), max(high, timestamp))
+            key = encode_key(point['measurement'], series, self.chunk_start(timestamp))
+            partition = groups.setdefault(self.partition_start(timestamp), {})
+            partition.setdefault(key, {}).setdefault(timestamp, {}).update(point['fields'])
+
+        pending = []
+        with self.lock:
+            if expired:
+                self.partition_stats['expired_points'] += expired
+            # Index entries go first so no chunk is ever stored without one.
+            new_series = [(measurement, series) for measurement, series in batch_series
+                          if not self.index.contains(measurement, series)]
+            if new_series:
+                self.index_tree.write_batch([(self.index.entry_key(measurement, series), b'1')
+                                             for measurement, series in new_series])
+            for start, chunks in groups.items():
+                with self.partitions_lock:
+                    tree = self._partition(start)
+                # Each batch appends a fragment per chunk instead of
+                # rewriting the chunk. Sequence numbers start from the clock
+                # so they keep growing across restarts.
+                self.sequence = max(self.sequence + 1, time.time_ns())
+                items = [(fragment_key(key, self.sequence), Chunk.from_rows(rows).encode())
+                         for key, rows in chunks.items()]
+                pending.append((tree, tree.write_batch(items, wait=False)))
+            for measurement, series in new_series:
+                self.index.add(measurement, series)
+        for tree, seq in pending:
+            tree.sync(seq)
+        if self.on_change is not None:
+            for measurement, (low, high) in spans.items():
+                self.on_change(measurement, low, high)
+        return len(points) - expired
+
+    def _overlapping(self, start_time, end_time):
+        return sorted(start for start in self.partitions
+                      if (end_time is None or start <= end_time)
+                      and (start_time is None or start + self.partition_duration > start_time))
+
+    def snapshot(self, start_time=None, end_time=None, fill_cache=True):
+        # Snapshot of the partitions overlapping [start_time, end_time],
+        # opening the ones that are closed.
+        with self.partitions_lock:
+            return PartitionedSnapshot({self._name(start): self._partition(start).snapshot(fill_cache)
+                                        for start in self._overlapping(start_time, end_time)})
+
+    def delete(self, measurement, series, start_time=None, end_time=None):
+        # Deletes the points of the given series in [start_time, end_time]
+        # (all of them by default). Chunks entirely inside the range, and
+        # their rollups, are removed with one range tombstone per series and
+        # partition; the chunks at either edge are merged with their
+        # fragments and rewritten without the deleted points. Series deleted
+        # without a time range also leave the index.
+        with self.lock:
+            with self.partitions_lock:
+                trees = [self._partition(start) for start in self._overlapping(start_time, end_time)]
+            first = None if start_time is None else self.chunk_start(start_time + self.chunk_duration - 1)
+            last = None if end_time is None else self.chunk_start(end_time + 1)
+            edges = {self.chunk_start(timestamp) for timestamp in (start_time, end_time) if timestamp is not None}
+            pending = []
+            for tree in trees:
+                items = []
+                for one in sorted(series):
+                    prefix = series_prefix(measurement, one)
+                    start = prefix + encode_timestamp(first) if first is not None else prefix
+                    end = prefix + encode_timestamp(last) if last is not None else prefix[:-1] + b'\x01'
+                    if start < end:
+                        items.append(range_tombstone(start, end))
+                        items += [range_tombstone(self.rollups.entry_key(name, start), self.rollups.entry_key(name, end))
+                                  for name in self.rollups.rules]
+                    for chunk_start in edges:
+                        if (first is None or chunk_start >= first) and (last is None or chunk_start < last):
+                            continue  # Covered by the range tombstone
+                        key = prefix + encode_timestamp(chunk_start)
+                        existing = list(tree.scan(key, chunk_end(key)))
+                        if not existing:
+                            continue
+                        rows = {timestamp: fields
+                                for timestamp, fields in merge_chunks([value for _, value in existing]).rows()
+                                if (start_time is not None and timestamp < start_time)
+                                or (end_time is not None and timestamp > end_time)}
+                        items.append((key, Chunk.from_rows(rows).encode() if rows else TOMBSTONE))
+                        # Fragments are only ever held by memtables.
+                        items += [(fragment, TOMBSTONE) for fragment, _ in existing if fragment != key]
+                pending.append((tree, tree.write_batch(items, wait=False)))
+            if start_time is None and end_time is None:
+                self.index_tree.write_batch([(self.index.entry_key(measurement, one), TOMBSTONE) for one in series])
+                for one in series:
+                    self.index.remove(measurement, one)
+        for tree, seq in pending:
+            tree.sync(seq)
+        if self.on_change is not None:
+            self.on_change(measurement, start_time, end_time)
+
+    def partition_names(self):
+        with self.partitions_lock:
+            return [self._name(start) for start in sorted(self.partitions)]
+
+    def open_partitions(self):
+        with self.partitions_lock:
+            return {self._name(start): tree for start, tree in sorted(self.partitions.items()) if tree is not None}
+
+    def scan(self, measurement, start_time=None, end_time=None, series=None, snapshot=None):
+        # Yields (series, chunk) for the given series of the measurement (all
+        # of them by default), with chunks trimmed to [start_time, end_time].
+        # Only those series' key ranges are read. Chunks are merged with the
+        # fragments not yet folded into them.
+        if snapshot is None:
+            snapshot = self.snapshot(start_time, end_time)
+        if series is None:
+            series = self.index.lookup(measurement, None)
+        aligned_start = self.chunk_start(start_time) if start_time is not None else None
+        for series in sorted(series):
+            prefix = series_prefix(measurement, series)
+            start = prefix + encode_timestamp(aligned_start) if aligned_start is not None else prefix
+            end = prefix + encode_timestamp(end_time + 1) if end_time is not None else prefix[:-1] + b'\x01'
+            for _, entries in itertools.groupby(snapshot.scan(start, end), key=lambda entry: chunk_key(entry[0])):
+                chunk = merge_chunks([value for _, value in entries]).slice(start_time, end_time)
+                if len(chunk):
+                    yield series, chunk
+
+    def maintain(self):
+        # Drops partitions that lie entirely before the retention cutoff and
+        # closes the ones idle for longer than idle_timeout.
+        cutoff = self.retention_cutoff()
+        with self.partitions_lock:
+            expired = [start for start in self.partitions
+                       if cutoff is not None and start + self.partition_duration <= cutoff]
+            idle = [start for start, tree in self.partitions.items()
+                    if tree is not None and start not in expired
+                    and time.monotonic() - self.last_used[start] > self.idle_timeout]
+        for start in expired:
+            with self.lock, self.partitions_lock:
+                tree = self.partitions.pop(start)
+                self.last_used.pop(start, None)
+                if tree is not None:
+                    tree.close()
+                shutil.rmtree(os.path.join(self.partitions_directory, self._name(start)))
+                self.partition_stats['dropped'] += 1
+            print(f"Dropped expired partition {self._name(start)}")
+            if self.on_change is not None:
+                self.on_change(None, start, start + self.partition_duration - 1)
+        for start in idle:
+            # Flushed first so reopening does not replay the WAL.
+            with self.lock, self.partitions_lock:
+                tree = self.partitions.get(start)
+                if tree is None or time.monotonic() - self.last_used[start] <= self.idle_timeout:
+                    continue
+                tree.flush()
+                tree.close()
+                self.partitions[start] = None
+                self.partition_stats['closed'] += 1
+
+    def _maintenance_loop(self):
+        while not self.stopped.wait(self.maintenance_interval):
+            try:
+                self.maintain()
+            except Exception as e:
+                print(f"Partition maintenance failed: {e}")
+
+    def stats(self):
+        partitions = self.open_partitions()
+        with self.partitions_lock:
+            stats = dict(self.partition_stats, partitions=len(self.partitions))
+        stats['open_partitions'] = {name: tree.stats() for name, tree in partitions.items()}
+        stats['index'] = self.index_tree.stats()
+        stats['partition_duration'] = self.partition_duration
+        stats['retention'] = self.retention
+        return stats
+
+    def close(self):
+        self.stopped.set()
+        self.maintenance_thread.join()
+        with self.lock, self.partitions_lock:
+            for start, tree in self.partitions.items():
+                if tree is not None:
+                    tree.close()
+                    self.partitions[start] = None
+            self.index_tree.close()
+
+def print_db_contents(store):
+    for name, tree in store.open_partitions().items():
+        snapshot = tree.snapshot()
+        print(f"Partition {name} memtable contents:")
+        for key, value in snapshot.memtable_data.items():
+            if key_timestamp(key) is not None and value is not TOMBSTONE:
+                print(f"Key: {decode_key(key)}, Points: {len(Chunk.decode(value))}")
+        print(f"Partition {name} SSTable contents:")
+        for level, sstables in enumerate(snapshot.levels):
+            for sstable in sstables:
+                for key, value in sstable.items():
+                    if key_timestamp(key) is not None and value is not TOMBSTONE:
+                        print(f"Level {level}, Key: {decode_key(key)}, Points: {len(Chunk.decode(value))}")
+
+def parse_field_value(value):
+    if value.startswith('"') and value.endswith('"') and len(value) >= 2:
+        return value[1:-1]
+    if value in ('t', 'T', 'true', 'True', 'TRUE'):
+        return True
+    if value in ('f', 'F', 'false', 'False', 'FALSE'):
+        return False
+    try:
+        if value.endswith('i'):
+            integer = int(value[:-1])
+            if not -2**63 <= integer < 2**63:
+                raise ValueError
+            return integer
+        return float(value)
+    except ValueError:
+        raise ValueError(f"invalid field value {value!r}")
+
+def parse_line_protocol(body, default_timestamp):
+    # Parses a newline-separated Line Protocol body in one pass. Returns the
+    # parsed points and a list of (line number, reason) for rejected lines.
+    points = []
+    errors = []
+    for line_number, line in enumerate(body.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) < 2 or len(parts) > 3:
+            errors.append((line_number, "expected 'measurement[,tags] fields [timestamp]'"))
+            continue
+
+        measurement_tags = parts[0].split(',')
+        measurement = measurement_tags[0]
+        tags = dict(tag.split('=', 1) for tag in measurement_tags[1:] if '=' in tag)
+        try:
+            fields = {name: parse_field_value(value)
+                      for name, value in (field.split('=', 1) for field in parts[1].split(',') if '=' in field)}
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+            continue
+        if not measurement or not fields:
+            errors.append((line_number, "missing measurement or fields"))
+            continue
+        if len(parts) > 2:
+            try:
+                timestamp = int(parts[2])
+            except ValueError:
+                errors.append((line_number, f"invalid timestamp {parts[2]!r}"))
+                continue
+        else:
+            timestamp = default_timestamp
+
+        points.append({
+            "measurement": measurement,
+            "tags": tags,
+            "fields": fields,
+            "timestamp": str(timestamp)
+        })
+    return points, errors
+
+DURATION_UNITS = {'ns': 1, 'us': 10**3, 'ms': 10**6, 's': 10**9, 'm': 60 * 10**9, 'h': 3600 * 10**9,
+                  'd': 86400 * 10**9, 'w': 7 * 86400 * 10**9}
+
+def parse_duration(text):
+    match = re.fullmatch(r'(\d+)(ns|us|ms|s|m|h|d|w)', text.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {text!r}")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+def split_columns(text):
+    # Splits a SELECT list on commas that are not inside parentheses.
+    columns = []
+    depth = 0
+    current = ''
+    for char in text:
+        if char == ',' and depth == 0:
+            columns.append(current.strip())
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    if current.strip():
+        columns.append(current.strip())
+    return columns
+
+class Aggregator:
+    # Vectorized aggregation over the column batches produced by
+    # QueryPlan.batches(). Rows are concatenated into NumPy arrays, sorted by
+    # (group, time bucket, timestamp), and every aggregate is computed for all
+    # groups at once with ufunc.reduceat over the segment boundaries. A value
+    # missing from a row is absent: it is not counted and never becomes zero.
+    FUNCTIONS = ('COUNT', 'SUM', 'AVG', 'MEAN', 'MIN', 'MAX', 'PERCENTILE', 'MEDIAN', 'FIRST', 'LAST', 'RATE')
+    MERGEABLE = ('COUNT', 'SUM', 'AVG', 'MEAN', 'MIN', 'MAX')
+    PATTERN = re.compile(r'^(\w+)\(\s*([\w.-]+)\s*(?:,\s*([\d.]+)\s*)?\)$')
+
+    def __init__(self, select, group_by):
+        self.aggregates = []
+        for column in select:
+            match = self.PATTERN.match(column)
+            if not match or match.group(1).upper() not in self.FUNCTIONS:
+                continue
+            function, field, argument = match.group(1).upper(), match.group(2), match.group(3)
+            if function == 'PERCENTILE' and argument is None:
+                raise ValueError(f"PERCENTILE needs a percentile argument: {column}")
+            if function == 'MEDIAN':
+                function, argument = 'PERCENTILE', '50'
+            self.aggregates.append((column, function, field, float(argument) if argument else None))
+
+        self.interval = None
+        self.group_tags = []
+        for item in group_by:
+            match = re.fullmatch(r'time\((\w+)\)', item, re.IGNORECASE)
+            if match:
+                self.interval = parse_duration(match.group(1))
+            else:
+                self.group_tags.append(item)
+
+    @classmethod
+    def for_query(cls, parsed_query):
+        aggregator = cls(parsed_query['select'], parsed_query['group_by'])
+        return aggregator if aggregator.aggregates else None
+
+    @property
+    def fields(self):
+        return sorted({field for _, _, field, _ in self.aggregates})
+
+    @property
+    def mergeable(self):
+        return all(function in self.MERGEABLE for _, function, _, _ in self.aggregates)
+
+    def run(self, batches):
+        return self._run(batches, self._aggregate, self._missing_rows)
+
+    def run_summaries(self, summaries):
+        # Like run(), over partial aggregates per time bucket as produced by
+        # Rollups.summarize: (tags, bucket times, {field: (count, numeric
+        # count, sum, min, max)}). Only mergeable aggregates can be answered.
+        return self._run(summaries, self._merge, self._missing_summary)
+
+    def partials(self, batches, summaries=False):
+        # Per-series partial aggregates that another process can merge, for
+        # scatter-gather across storage nodes. Yields one dict per series and
+        # time bucket with [count, numeric count, sum, min, max, first time,
+        # first, last time, last] per field; the first/last entries are None
+        # when built from rollup summaries.
+        missing = self._missing_summary if summaries else self._missing_rows
+        segments = self._segments(batches, missing, lambda tags: tuple(sorted(tags.items())))
+        if segments is None:
             return
+        group_names, timestamps, groups, buckets, starts, columns = segments
+        fields = {}
+        for field, arrays in columns.items():
+            if summaries:
+                count, valid, sums, mins, maxs = (np.add.reduceat(arrays[0], starts), np.add.reduceat(arrays[1], starts),
+                                                  np.add.reduceat(arrays[2], starts), np.fmin.reduceat(arrays[3], starts),
+                                                  np.fmax.reduceat(arrays[4], starts))
+                fields[field] = [count, valid, sums, mins, maxs] + [None] * 4
+                continue
+            present, values = arrays
+            valid = present & ~np.isnan(values)
+            count = np.add.reduceat(present.astype(np.int64), starts)
+            valid_counts = np.add.reduceat(valid.astype(np.int64), starts)
+            positions = np.arange(len(values))
+            has_value = valid_counts > 0
+            first = np.where(has_value, np.minimum.reduceat(np.where(valid, positions, len(values)), starts), 0)
+            last = np.where(has_value, np.maximum.reduceat(np.where(valid, positions, -1), starts), 0)
+            fields[field] = [
+                count, valid_counts,
+                np.add.reduceat(np.where(valid, values, 0.0), starts),
+                np.fmin.reduceat(np.where(valid, values, np.nan), starts),
+                np.fmax.reduceat(np.where(valid, values, np.nan), starts),
+                timestamps[first], values[first], timestamps[last], values[last],
+            ]
+        for segment, start in enumerate(starts):
+            yield {
+                'tags': dict(group_names[groups[start]]),
+                'time': int(buckets[start]) * self.interval if self.interval is not None else None,
+                'fields': {field: self._partial_json(arrays, segment) for field, arrays in fields.items()},
+            }
+
+    def _partial_json(self, arrays, segment):
+        values = [None if array is None else self._to_json(array[segment]) for array in arrays]
+        if not values[1]:
+            values[5:] = [None] * 4  # No numeric value, so no first/last
+        return values
+
+    @property
+    def partial(self):
+        return all(function in self.MERGEABLE + ('FIRST', 'LAST', 'RATE') for _, function, _, _ in self.aggregates)
 
-        new_sstable = SSTable(level, len(self.levels[level]))
-        for key, value in data:
-            new_sstable.put(key, value)
+    @staticmethod
+    def _missing_rows(n):
+        return np.zeros(n, dtype=bool), np.full(n, np.nan)
 
-        new_sstable.save()
-        self.levels[level].append(new_sstable)
+    @staticmethod
+    def _missing_summary(n):
+        return (np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64), np.zeros(n),
+                np.full(n, np.nan), np.full(n, np.nan))
 
-        if len(self.levels[level]) > 2:  # Simple compaction strategy
-            self._merge_and_compact(level)
+    def _segments(self, batches, missing, group_key):
+        # Concatenates the batches and sorts them by (group, time bucket,
+        # time). Returns None for no rows, else (group names, timestamps,
+        # group ids, buckets, segment starts, {field: sorted column arrays}).
+        group_keys = {}
+        timestamp_parts, group_parts = [], []
+        column_parts = {field: [] for field in self.fields}
+        for tags, timestamps, columns in batches:
+            if not len(timestamps):
+                continue
+            group_id = group_keys.setdefault(group_key(tags), len(group_keys))
+            timestamp_parts.append(timestamps)
+            group_parts.append(np.full(len(timestamps), group_id, dtype=np.int64))
+            for field in self.fields:
+                column = columns.get(field)
+                column_parts[field].append(column if column is not None else missing(len(timestamps)))
+        if not timestamp_parts:
+            return None
 
-    def _merge_and_compact(self, level):
-        merged_data = OrderedDict()
-        for sstable in self.levels[level]:
-            merged_data.update(sstable.data)
+        timestamps = np.concatenate(timestamp_parts)
+        groups = np.concatenate(group_parts)
+        buckets = (np.floor_divide(timestamps, self.interval) if self.interval is not None
+                   else np.zeros(len(timestamps), dtype=np.int64))
+        order = np.lexsort((timestamps, buckets, groups))
+        timestamps, groups, buckets = timestamps[order], groups[order], buckets[order]
+        boundaries = np.flatnonzero((np.diff(groups) != 0) | (np.diff(buckets) != 0)) + 1
+        starts = np.concatenate(([0], boundaries))
+        columns = {field: [np.concatenate(parts)[order] for parts in zip(*column_parts[field])]
+                   for field in self.fields}
+        group_names = {group_id: key for key, group_id in group_keys.items()}
+        return group_names, timestamps, groups, buckets, starts, columns
 
-        self.levels[level] = []  # Clear current level
-        self._compact(merged_data.items(), level + 1)  # Compact to next level
+    def _run(self, batches, aggregate, missing):
+        segments = self._segments(batches, missing, lambda tags: tuple(tags.get(tag, '') for tag in self.group_tags))
+        grouped = bool(self.group_tags) or self.interval is not None
+        if segments is None:
+            if grouped:
+                return []
+            return [{column: 0 if function == 'COUNT' else None} for column, function, _, _ in self.aggregates]
 
-def print_db_contents(lsm_tree):
-    print("Current memtable contents:")
-    for key, value in lsm_tree.memtable.data.items():
-        print(f"Key: {key}, Value: {value}")
-    print("Current SSTable contents:")
-    for level in range(lsm_tree.max_levels):
-        for sstable in lsm_tree.levels[level]:
-            for key, value in sstable.data.items():
-                print(f"Level {level}, Key: {key}, Value: {value}")
+        group_names, timestamps, groups, buckets, starts, columns = segments
+        results = {}
+        for column, function, field, argument in self.aggregates:
+            results[column] = aggregate(function, argument, timestamps, columns[field], starts)
+
+        if not grouped:
+            return [{column: self._to_json(results[column][0])} for column, _, _, _ in self.aggregates]
+        output = []
+        for segment, start in enumerate(starts):
+            group = dict(zip(self.group_tags, group_names[groups[start]]))
+            if self.interval is not None:
+                group['time'] = int(buckets[start]) * self.interval
+            output.append({
+                'group': group,
+                'results': [{column: self._to_json(results[column][segment])} for column, _, _, _ in self.aggregates]
+            })
+        return output
+
+    def _merge(self, function, argument, timestamps, arrays, starts):
+        count, valid, sums, mins, maxs = arrays
+        valid_counts = np.add.reduceat(valid, starts)
+        if function == 'COUNT':
+            return np.add.reduceat(count, starts)
+        if function == 'SUM':
+            return np.where(valid_counts > 0, np.add.reduceat(sums, starts), np.nan)
+        if function in ('AVG', 'MEAN'):
+            return np.divide(np.add.reduceat(sums, starts), valid_counts,
+                             out=np.full(len(starts), np.nan), where=valid_counts > 0)
+        if function == 'MIN':
+            return np.fmin.reduceat(mins, starts)
+        return np.fmax.reduceat(maxs, starts)
+
+    def _aggregate(self, function, argument, timestamps, arrays, starts):
+        present, values = arrays
+        valid = present & ~np.isnan(values)
+        counts = np.add.reduceat(valid.astype(np.int64), starts)
+        if function == 'COUNT':
+            return np.add.reduceat(present.astype(np.int64), starts)
+        if function == 'SUM':
+            return np.where(counts > 0, np.add.reduceat(np.where(valid, values, 0.0), starts), np.nan)
+        if function in ('AVG', 'MEAN'):
+            sums = np.add.reduceat(np.where(valid, values, 0.0), starts)
+            return np.divide(sums, counts, out=np.full(len(starts), np.nan), where=counts > 0)
+        if function == 'MIN':
+            return np.fmin.reduceat(np.where(valid, values, np.nan), starts)
+        if function == 'MAX':
+            return np.fmax.reduceat(np.where(valid, values, np.nan), starts)
+        if function == 'PERCENTILE':
+            return self._percentile(argument, values, valid, starts, counts)
+
+        positions = np.arange(len(values))
+        first = np.minimum.reduceat(np.where(valid, positions, len(values)), starts)
+        last = np.maximum.reduceat(np.where(valid, positions, -1), starts)
+        has_value = counts > 0
+        first = np.where(has_value, first, 0)
+        last = np.where(has_value, last, 0)
+        if function == 'FIRST':
+            return np.where(has_value, values[first], np.nan)
+        if function == 'LAST':
+            return np.where(has_value, values[last], np.nan)
+        # RATE: per-second change between the first and last value.
+        elapsed = (timestamps[last] - timestamps[first]) / 1e9
+        change = values[last] - values[first]
+        return np.divide(change, elapsed, out=np.full(len(starts), np.nan), where=has_value & (elapsed > 0))
+
+    def _percentile(self, percentile, values, valid, starts, counts):
+        # Sort values within each segment (absent values last) and linearly
+        # interpolate at rank (count - 1) * p / 100, for all segments at once.
+        segment_ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(values))))
+        order = np.lexsort((np.where(valid, values, np.inf), segment_ids))
+        ordered = values[order]
+        rank = (np.maximum(counts, 1) - 1) * percentile / 100.0
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.ceil(rank).astype(np.int64)
+        low_values = ordered[starts + lower]
+        high_values = ordered[starts + upper]
+        result = low_values + (high_values - low_values) * (rank - lower)
+        return np.where(counts > 0, result, np.nan)
+
+    def _to_json(self, value):
+        if isinstance(value, (np.integer, int)):
+            return int(value)
+        value = float(value)
+        return None if math.isnan(value) else value
 
 class QueryParser:
     def __init__(self, query_string):
@@ -130,192 +2391,775 @@ class QueryParser:
         }
         self.parse()
 
+    @staticmethod
+    def token(parts, i, after):
+        # The word at i, or ValueError when the query ends before it.
+        if i >= len(parts):
+            raise ValueError(f"Incomplete query: expected more after {after}")
+        return parts[i]
+
     def parse(self):
         parts = self.query_string.split()
         i = 0
         while i < len(parts):
             if parts[i].upper() == 'SELECT':
                 i += 1
+                columns = []
                 while i < len(parts) and parts[i].upper() != 'FROM':
-                    self.parsed_query['select'].append(parts[i].strip(','))
+                    columns.append(parts[i])
                     i += 1
+                self.parsed_query['select'] = split_columns(' '.join(columns))
+                continue
             elif parts[i].upper() == 'FROM':
                 i += 1
-                self.parsed_query['from'] = parts[i]
+                self.parsed_query['from'] = self.token(parts, i, 'FROM')
             elif parts[i].upper() == 'WHERE':
                 i += 1
                 while i < len(parts) and parts[i].upper() not in ['GROUP', 'TIME', 'LIMIT', 'OFFSET']:
                     self.parsed_query['where'].append(parts[i])
                     i += 1
-            elif parts[i].upper() == 'GROUP' and parts[i+1].upper() == 'BY':
+                continue
+            elif parts[i].upper() == 'GROUP' and self.token(parts, i + 1, 'GROUP').upper() == 'BY':
                 i += 2
                 while i < len(parts) and parts[i].upper() not in ['TIME', 'LIMIT', 'OFFSET']:
                     self.parsed_query['group_by'].append(parts[i].strip(','))
                     i += 1
-            elif parts[i].upper() == 'TIME' and parts[i+1].upper() == 'RANGE':
+                continue
+            elif parts[i].upper() == 'TIME' and self.token(parts, i + 1, 'TIME').upper() == 'RANGE':
                 i += 2
-                self.parsed_query['time_range']['start'] = parts[i]
+                self.parsed_query['time_range']['start'] = self.token(parts, i, 'TIME RANGE')
                 i += 2  # Skip 'TO'
-                self.parsed_query['time_range']['end'] = parts[i]
+                self.parsed_query['time_range']['end'] = self.token(parts, i, 'TO')
             elif parts[i].upper() == 'LIMIT':
                 i += 1
-                self.parsed_query['limit'] = int(parts[i])
+                self.parsed_query['limit'] = int(self.token(parts, i, 'LIMIT'))
             elif parts[i].upper() == 'OFFSET':
                 i += 1
-                self.parsed_query['offset'] = int(parts[i])
+                self.parsed_query['offset'] = int(self.token(parts, i, 'OFFSET'))
             i += 1
 
     def get_parsed_query(self):
         return self.parsed_query
 
+def parse_time(time_str):
+    # Parse ISO 8601 format to timestamp
+    dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+    return int(dt.timestamp() * 1e9)  # Convert to nanoseconds
+
+def parse_literal(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in ('"', "'"):
+        return text[1:-1]
+    if text.lower() in ('true', 'false'):
+        return text.lower() == 'true'
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+class Predicate:
+    OPERATORS = {
+        '=': operator.eq,
+        '!=': operator.ne,
+        '>': operator.gt,
+        '<': operator.lt,
+        '>=': operator.ge,
+        '<=': operator.le,
+    }
+    PATTERN = re.compile(r'^\s*([\w.-]+)\s*(>=|<=|!=|=|>|<)\s*(.+?)\s*$')
+
+    def __init__(self, key, op, text):
+        self.key = key
+        self.op = op
+        self.text = text.strip().strip('\'"')  # Tag values are always strings
+        self.literal = parse_literal(text)
+        self.compare = self.OPERATORS[op]
+
+    @classmethod
+    def parse(cls, condition):
+        match = cls.PATTERN.match(condition)
+        if not match:
+            raise ValueError(f"Invalid WHERE condition: {condition!r}")
+        return cls(*match.groups())
+
+    def matches_tag(self, value):
+        return value is not None and self.compare(value, self.text)
+
+    def matches_field(self, value):
+        # Numbers compare numerically (bools count as numbers, as in Python);
+        # anything else compares as text, and mismatched types only satisfy !=.
+        if value is None:
+            return False
+        literal = self.literal
+        if isinstance(literal, bool) or isinstance(value, bool):
+            if isinstance(literal, bool) and isinstance(value, bool):
+                return self.compare(value, literal)
+        elif isinstance(literal, float) and isinstance(value, (int, float)):
+            return self.compare(value, literal)
+        if isinstance(value, str):
+            return self.compare(value, self.text)
+        return self.op == '!='
+
+    def mask(self, kind, values):
+        # Vectorized matches_field over one chunk column.
+        if kind in ('f', 'i') and isinstance(self.literal, float):
+            present, numeric = column_arrays(kind, values)
+            return self.compare(numeric, self.literal) & present
+        return np.fromiter((self.matches_field(value if is_present(kind, value) else None) for value in values),
+                           dtype=bool, count=len(values))
+
+    def __repr__(self):
+        return f"{self.key} {self.op} {self.text}"
+
+class QueryPlan:
+    # A parsed query compiled once into typed predicates, split by where they
+    # can be evaluated: tag equalities go to the series index, other tag
+    # predicates are evaluated once per series, the time range bounds the key
+    # ranges and prunes whole SSTables, and only field predicates are checked
+    # per row.
+    def __init__(self, parsed_query, store):
+        self.parsed_query = parsed_query
+        self.store = store
+        self.measurement = parsed_query['from']
+        self.start_time = self.end_time = None
+        if parsed_query['time_range']:
+            self.start_time = parse_time(parsed_query['time_range']['start'])
+            self.end_time = parse_time(parsed_query['time_range']['end'])
+
+        conditions = [condition for condition in re.split(r'\s+AND\s+', ' '.join(parsed_query['where']), flags=re.IGNORECASE)
+                      if condition.strip()]
+        if any(re.search(r'\bOR\b', condition, re.IGNORECASE) for condition in conditions):
+            raise ValueError("OR is not supported in WHERE; conditions are combined with AND")
+        self.predicates = [Predicate.parse(condition) for condition in conditions]
+        tag_keys = store.index.tag_keys(self.measurement)
+        self.tag_filters = {}
+        self.tag_predicates = []
+        self.field_predicates = []
+        for predicate in self.predicates:
+            if predicate.key in tag_keys:
+                if predicate.op == '=' and predicate.key not in self.tag_filters:
+                    self.tag_filters[predicate.key] = predicate.text
+                else:
+                    self.tag_predicates.append(predicate)
+            else:
+                self.field_predicates.append(predicate)
+
+    def cache_key(self, partial=False):
+        # Normalized form of the query: the same SELECT with different
+        # spacing, condition order or timestamp notation maps to one key.
+        return json.dumps([
+            partial,
+            self.measurement,
+            self.parsed_query['select'],
+            sorted(repr(predicate) for predicate in self.predicates),
+            self.start_time,
+            self.end_time,
+            self.parsed_query['group_by'],
+            self.parsed_query['limit'],
+            self.parsed_query['offset'],
+        ])
+
+    def series(self):
+        matched = self.store.index.lookup(self.measurement, self.tag_filters)
+        if self.tag_predicates:
+            matched = {series for series in matched
+                       if all(predicate.matches_tag(parse_series_key(series).get(predicate.key))
+                              for predicate in self.tag_predicates)}
+        return matched
+
+    def overlaps(self, sstable):
+        # Chunk keys carry the window start, so a table's data extends up to
+        # chunk_duration past its max_time.
+        if sstable.min_time is None:
+            return True
+        if self.end_time is not None and sstable.min_time > self.end_time:
+            return False
+        if self.start_time is not None and sstable.max_time + self.store.chunk_duration <= self.start_time:
+            return False
+        return True
+
+    def snapshot(self):
+        # Queries over all time are treated as large scans and do not fill
+        # the block cache.
+        return self.store.snapshot(self.start_time, self.end_time, fill_cache=self.start_time is not None)
+
+    def prune(self, snapshot):
+        return snapshot.filter(self.overlaps)
+
+    def matches(self, fields):
+        return all(predicate.matches_field(fields.get(predicate.key)) for predicate in self.field_predicates)
+
+    def rows(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        snapshot, _ = self.prune(snapshot)
+        for series, chunk in self.store.scan(self.measurement, self.start_time, self.end_time,
+                                             series=self.series(), snapshot=snapshot):
+            tags = parse_series_key(series)
+            for timestamp, fields in chunk.rows():
+                if self.matches(fields):
+                    yield {
+                        "measurement": self.measurement,
+                        "tags": tags,
+                        "fields": fields,
+                        "timestamp": str(timestamp)
+                    }
+
+    def batches(self, fields, snapshot=None):
+        # Column batches for vectorized aggregation: one per chunk, as
+        # (tags, int64 timestamps, {field: (present mask, float64 values)})
+        # with the row predicates already applied as a mask.
+        if snapshot is None:
+            snapshot = self.snapshot()
+        snapshot, _ = self.prune(snapshot)
+        for series, chunk in self.store.scan(self.measurement, self.start_time, self.end_time,
+                                             series=self.series(), snapshot=snapshot):
+            timestamps = np.frombuffer(chunk.timestamps, dtype=np.int64)
+            mask = np.ones(len(timestamps), dtype=bool)
+            for predicate in self.field_predicates:
+                if predicate.key in chunk.fields:
+                    mask &= predicate.mask(*chunk.fields[predicate.key])
+                else:
+                    mask[:] = False
+            if not mask.any():
+                continue
+            columns = {}
+            for field in fields:
+                if field not in chunk.fields:
+                    continue
+                present, numeric = column_arrays(*chunk.fields[field])
+                columns[field] = (present[mask], numeric[mask])
+            yield parse_series_key(series), timestamps[mask], columns
+
+    def rollup(self, aggregator, snapshot):
+        # Coarsest rollup rule that can answer the aggregation: mergeable
+        # aggregates only, no per-row predicates, a GROUP BY time() interval
+        # that is a multiple of the rule's, and every table to be read
+        # written with that rule.
+        if aggregator is None or not aggregator.mergeable or self.field_predicates:
+            return None
+        snapshot, _ = self.prune(snapshot)
+        sstables = [sstable for level in snapshot.levels for sstable in level]
+        rules = sorted(((interval, name) for name, interval in self.store.rollups.rules.items()
+                        if aggregator.interval is None or aggregator.interval % interval == 0), reverse=True)
+        for _, name in rules:
+            if all(self.store.rollups.covers(sstable, name) for sstable in sstables):
+                return name
+        return None
+
+    def summaries(self, fields, rule, snapshot=None):
+        # Summary batches for Aggregator.run_summaries. Whole rule buckets
+        # inside the time range come from rollup entries; the partial buckets
+        # at the edges, and chunks rewritten since the last flush (whose
+        # rollups are not computed yet), are summarized from raw points.
+        if snapshot is None:
+            snapshot = self.snapshot()
+        snapshot, _ = self.prune(snapshot)
+        rollups = self.store.rollups
+        interval = rollups.rules[rule]
+        covered_start = covered_end = None
+        if self.start_time is not None:
+            covered_start = -(-self.start_time // interval) * interval
+        if self.end_time is not None:
+            covered_end = (self.end_time + 1) // interval * interval
+        if covered_start is not None and covered_end is not None and covered_start >= covered_end:
+            # The range is shorter than one rule bucket.
+            for series in sorted(self.series()):
+                yield from self._summarize_raw(series, [(self.start_time, self.end_time)], interval, snapshot)
+            return
+
+        first_chunk = self.store.chunk_start(covered_start) if covered_start is not None else None
+        rule_prefix = rollups.entry_key(rule, b'')
+        for series in sorted(self.series()):
+            prefix = series_prefix(self.measurement, series)
+            start = prefix + encode_timestamp(first_chunk) if first_chunk is not None else prefix
+            end = prefix + encode_timestamp(covered_end) if covered_end is not None else prefix[:-1] + b'\x01'
+            fresh = {key_timestamp(key) for memtable in snapshot.memtables for key, _ in memtable.items(start, end)}
+
+            raw_ranges = []
+            if covered_start is not None and self.start_time < covered_start:
+                raw_ranges.append((self.start_time, covered_start - 1))
+            if covered_end is not None and covered_end <= self.end_time:
+                raw_ranges.append((covered_end, self.end_time))
+            for chunk_start in sorted(fresh):
+                low, high = chunk_start, chunk_start + self.store.chunk_duration - 1
+                if covered_start is not None:
+                    low = max(low, covered_start)
+                if covered_end is not None:
+                    high = min(high, covered_end - 1)
+                if low <= high:
+                    raw_ranges.append((low, high))
+            yield from self._summarize_raw(series, raw_ranges, interval, snapshot)
+
+            tags = parse_series_key(series)
+            for key, value in snapshot.scan(rollups.entry_key(rule, start), rollups.entry_key(rule, end)):
+                if key_timestamp(key[len(rule_prefix):]) in fresh:
+                    continue
+                times, columns = rollups.decode(value, fields)
+                mask = np.ones(len(times), dtype=bool)
+                if covered_start is not None:
+                    mask &= times >= covered_start
+                if covered_end is not None:
+                    mask &= times < covered_end
+                yield tags, times[mask], {field: tuple(array[mask] for array in column)
+                                          for field, column in columns.items()}
+
+    def _summarize_raw(self, series, ranges, interval, snapshot):
+        tags = parse_series_key(series)
+        for low, high in ranges:
+            for _, chunk in self.store.scan(self.measurement, low, high, series=[series], snapshot=snapshot):
+                yield (tags, *Rollups.summarize(chunk, interval))
+
+    def explain(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        _, pruned = self.prune(snapshot)
+        pruned_files = {sstable.filename for sstable in pruned}
+        all_files = [sstable.filename for level in snapshot.levels for sstable in level]
+        partitions = snapshot.names
+        return {
+            'measurement': self.measurement,
+            'time_range': [self.start_time, self.end_time],
+            'index_filters': self.tag_filters,
+            'series_predicates': [repr(predicate) for predicate in self.tag_predicates],
+            'row_predicates': [repr(predicate) for predicate in self.field_predicates],
+            'series': len(self.series()),
+            'sstables_scanned': [filename for filename in all_files if filename not in pruned_files],
+            'sstables_pruned': sorted(pruned_files),
+            'partitions_scanned': partitions,
+            'partitions_pruned': [name for name in self.store.partition_names() if name not in partitions],
+            'rollup': self.rollup(Aggregator.for_query(self.parsed_query), snapshot),
+        }
+
+class QueryCache:
+    # LRU cache of encoded query results within a byte budget. Each entry
+    # remembers the measurement and time range it was computed over; a write
+    # bumps the generation and drops only the entries whose range covers the
+    # written span (every measurement's, for a dropped partition). Results
+    # computed from a snapshot older than an
+    # overlapping write are not stored, so a query racing a write cannot
+    # cache stale rows.
+    def __init__(self, max_bytes=64 << 20, max_entry_bytes=None, write_history=1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        self.entries = OrderedDict()  # key -> (measurement, start, end, results, size)
+        self.bytes = 0
+        self.generation = 0
+        self.writes = deque(maxlen=write_history)  # (generation, measurement, start, end)
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _overlaps(start, end, low, high):
+        # None on either side is an open end.
+        return ((start is None or high is None or high >= start)
+                and (end is None or low is None or low <= end))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[3]
+
+    def invalidate(self, measurement, low, high):
+        with self.lock:
+            self.generation += 1
+            self.writes.append((self.generation, measurement, low, high))
+            for key, (entry_measurement, start, end, _, size) in list(self.entries.items()):
+                if measurement in (None, entry_measurement) and self._overlaps(start, end, low, high):
+                    del self.entries[key]
+                    self.bytes -= size
+                    self.stats['invalidations'] += 1
+
+    def collect(self, key, generation, measurement, start, end, results):
+        # Passes encoded results through and caches them once the query has
+        # run to completion. generation must be read before the query takes
+        # its snapshot.
+        cached = []
+        size = 0
+        for result in results:
+            if cached is not None:
+                cached.append(result)
+                size += len(result)
+                if size > self.max_entry_bytes:
+                    cached = None
+            yield result
+        if cached is not None:
+            self._put(key, generation, measurement, start, end, cached, size)
+
+    def _put(self, key, generation, measurement, start, end, results, size):
+        with self.lock:
+            if self.writes and self.writes[0][0] > generation + 1:
+                return  # Writes since the snapshot are no longer all known
+            if any(write_generation > generation and write_measurement in (None, measurement)
+                   and self._overlaps(start, end, low, high)
+                   for write_generation, write_measurement, low, high in self.writes):
+                return
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[4]
+            self.entries[key] = (measurement, start, end, results, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, _, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes,
+                        max_bytes=self.max_bytes, generation=self.generation)
+
 class LSMDataHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.lsm_tree = LSMTree()
-        super().__init__(*args, **kwargs)
+    # HTTP/1.1 so query results can be sent with chunked transfer encoding.
+    # Responses go out in several small writes (headers, then body), so
+    # Nagle's algorithm would hold each one back until the client's delayed
+    # ACK on a keep-alive connection.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    STREAM_BUFFER_SIZE = 64 * 1024
+
+    @property
+    def store(self):
+        # One store per process, opened in run_server and shared by all
+        # handler threads.
+        return self.server.store
+
+    @property
+    def query_cache(self):
+        return self.server.query_cache
 
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
         
-        self.save_data(post_data)
+        with METRICS.timer('vm_ingest_seconds'):
+            accepted, expired, errors = self.save_data(post_data)
         
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"Data received and saved")
+        self.send_json(400 if errors and not accepted and not expired else 200, {
+            'accepted': accepted,
+            'expired': expired,
+            'rejected': len(errors),
+            'errors': [f"line {line_number}: {reason}" for line_number, reason in errors[:10]]
+        })
         
-        print_db_contents(self.lsm_tree)  # Print database contents after each insert
+        if DEBUG:
+            print_db_contents(self.store)  # Print database contents after each insert
   
     def do_GET(self):
         parsed_url = urlparse(self.path)
         query_params = parse_qs(parsed_url.query)
 
-        print(f"Parsed URL: {parsed_url}")
-        print(f"Query params: {query_params}")
+        if parsed_url.path == '/stats':
+            stats = self.store.stats()
+            stats['series_cardinality'] = self.store.index.cardinality()
+            stats['query_cache'] = self.query_cache.info()
+            stats['block_cache'] = self.server.block_cache.info()
+            if self.server.sql_tables is not None:
+                stats['sql_tables'] = self.server.sql_tables.info()
+            self.send_json(200, stats)
+            return
+
+        if parsed_url.path == '/sql':
+            self.send_sql(query_params.get('query', [''])[0])
+            return
+
+        if parsed_url.path == '/metrics':
+            self.send_text(200, METRICS.render(self.metric_samples()), 'text/plain; version=0.0.4')
+            return
+
+        debug(f"Parsed URL: {parsed_url}")
+        debug(f"Query params: {query_params}")
 
         if 'query' not in query_params:
             self.send_error(400, "Missing 'query' parameter")
             return
 
         query = query_params['query'][0]
-        print(f"Raw received query: {query}")
+        debug(f"Raw received query: {query}")
 
-        # Extract the actual query by finding the last occurrence of 'SELECT'
-        actual_query = query[query.upper().rindex('SELECT'):]
-        print(f"Processed query: {actual_query}")
+        partial = query_params.get('partial', [''])[0] == '1'
+        # X-Profile: stages runs the query to completion before answering and
+        # reports the time per stage in a Server-Timing header; X-Profile:
+        # cprofile answers with the cProfile statistics instead of results.
+        profile_mode = self.headers.get('X-Profile', '').lower()
+        profile = QueryProfile()
+        headers = {}
+        try:
+            # Extract the actual query by finding the last occurrence of 'SELECT'
+            select_index = query.upper().rfind('SELECT')
+            if select_index < 0:
+                raise ValueError("Query must contain SELECT")
+            actual_query = query[select_index:]
+            explain = 'EXPLAIN' in query[:select_index].upper().split()
+            debug(f"Processed query: {actual_query}")
+            with profile.stage('parse'):
+                parsed_query = QueryParser(actual_query).get_parsed_query()
+            with profile.stage('plan'):
+                plan = QueryPlan(parsed_query, self.store)
+            if explain:
+                self.send_json(200, plan.explain())
+                return
+            results = self.query_results(plan, partial, profile)
+            if profile_mode == 'cprofile':
+                results, dump = cprofile_call(lambda: list(results))
+                self.send_text(200, f"{len(results)} results, {profile.server_timing()}\n\n{dump}")
+                return
+            if profile_mode == 'stages':
+                results = list(results)
+                headers['Server-Timing'] = profile.server_timing()
+        except ValueError as e:
+            METRICS.inc('vm_query_errors_total')
+            self.send_error(400, str(e))
+            return
 
-        results = self.process_query(actual_query)
-        print(f"Query results: {results}")
+        ndjson = (partial or query_params.get('format', [''])[0] == 'ndjson'
+                  or 'application/x-ndjson' in self.headers.get('Accept', ''))
+        count = self.stream_results(results, ndjson, profile, headers)
+        profile.record(METRICS, 'vm_query_stage_seconds')
+        METRICS.observe('vm_query_seconds', profile.elapsed())
+        METRICS.inc('vm_query_results_total', count)
+        debug(f"Query returned {count} results")
 
-        self.send_response(200)
+    def query_results(self, plan, partial, profile):
+        # Encoded results, from the query cache or from a lazily run query
+        # that is cached once it completes.
+        cache_key = plan.cache_key(partial)
+        results = self.query_cache.get(cache_key)
+        if results is not None:
+            METRICS.inc('vm_queries_total', cache='hit')
+            return results
+        METRICS.inc('vm_queries_total', cache='miss')
+        generation = self.query_cache.generation
+        with profile.stage('execute'):
+            results = self.process_query(plan, partial)
+        results = self.encode_results(profile.timed('execute', results), profile)
+        return self.query_cache.collect(cache_key, generation, plan.measurement,
+                                        plan.start_time, plan.end_time, results)
+
+    def encode_results(self, results, profile):
+        for result in results:
+            started = time.perf_counter()
+            encoded = json.dumps(result).encode()
+            profile.add('encode', time.perf_counter() - started)
+            yield encoded
+
+    def send_sql(self, query):
+        # SELECT over a measurement as a table: tags, fields and time as
+        # columns, answered as a JSON array of rows.
+        if self.server.sql_tables is None:
+            self.send_error(501, "/sql needs pandas")
+            return
+        if not query.strip():
+            self.send_error(400, "Missing 'query' parameter")
+            return
+        debug(f"Received SQL query: {query}")
+        try:
+            with METRICS.timer('vm_sql_query_seconds'):
+                result = self.server.sql_tables.execute(query)
+        except (ValueError, KeyError) as e:
+            METRICS.inc('vm_sql_queries_total', status='error')
+            self.send_error(400, f"Invalid SQL query: {e}")
+            return
+        METRICS.inc('vm_sql_queries_total', status='ok')
+        self.send_text(200, result.to_json(orient='records'), 'application/json')
+
+    def metric_samples(self):
+        # Gauges and counters kept by the store and the caches, read at
+        # scrape time.
+        samples = []
+        partitions = self.store.open_partitions()
+        with self.store.partitions_lock:
+            samples.append(('vm_partitions', 'gauge', {}, len(self.store.partitions)))
+            samples.append(('vm_partitions_dropped_total', 'counter', {}, self.store.partition_stats['dropped']))
+        samples.append(('vm_open_partitions', 'gauge', {}, len(partitions)))
+        for measurement, count in self.store.index.cardinality().items():
+            samples.append(('vm_series', 'gauge', {'measurement': measurement}, count))
+        memtable_entries = 0
+        level_tables = {}
+        level_bytes = {}
+        for tree in list(partitions.values()) + [self.store.index_tree]:
+            snapshot = tree.snapshot()
+            memtable_entries += len(snapshot.memtable_data)
+            for level, sstables in enumerate(snapshot.levels):
+                level_tables[level] = level_tables.get(level, 0) + len(sstables)
+                level_bytes[level] = level_bytes.get(level, 0) + sum(sstable.size_bytes for sstable in sstables)
+        samples.append(('vm_memtable_entries', 'gauge', {}, memtable_entries))
+        for level in level_tables:
+            samples.append(('vm_sstables', 'gauge', {'level': level}, level_tables[level]))
+            samples.append(('vm_sstable_bytes', 'gauge', {'level': level}, level_bytes[level]))
+        for prefix, info in (('vm_block_cache', self.server.block_cache.info()),
+                             ('vm_query_cache', self.query_cache.info())):
+            for stat in ('hits', 'misses', 'evictions'):
+                samples.append((f"{prefix}_{stat}_total", 'counter', {}, info[stat]))
+            samples.append((f"{prefix}_bytes", 'gauge', {}, info['bytes']))
+        return samples
+
+    def do_DELETE(self):
+        # DELETE FROM measurement [WHERE tag conditions] [TIME RANGE start TO end]
+        query_params = parse_qs(urlparse(self.path).query)
+        if 'query' not in query_params:
+            self.send_error(400, "Missing 'query' parameter")
+            return
+        query = query_params['query'][0]
+        debug(f"Received delete: {query}")
+        if [word.upper() for word in query.split()[:1]] != ['DELETE']:
+            self.send_error(400, "Expected a DELETE statement")
+            return
+
+        try:
+            plan = QueryPlan(QueryParser(query).get_parsed_query(), self.store)
+            if plan.field_predicates:
+                raise ValueError("DELETE only supports conditions on tags")
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        with METRICS.timer('vm_delete_seconds'):
+            series = plan.series()
+            self.store.delete(plan.measurement, series, plan.start_time, plan.end_time)
+        METRICS.inc('vm_deletes_total')
+        debug(f"Deleted from {len(series)} series")
+        self.send_json(200, {'series': len(series)})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(results).encode())
-    
-    def save_data(self, data):
-        parts = data.split()
-        if len(parts) < 2:
-            print(f"Invalid data format: {data}")
-            return
+        self.wfile.write(body)
 
-        measurement_tags = parts[0].split(',')
-        measurement = measurement_tags[0]
-        tags = dict(tag.split('=') for tag in measurement_tags[1:] if '=' in tag)
-        fields = dict(field.split('=') for field in parts[1].split(',') if '=' in field)
-        timestamp = parts[2] if len(parts) > 2 else str(int(time.time() * 1e9))
+    def send_text(self, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        parsed_data = {
-            "measurement": measurement,
-            "tags": tags,
-            "fields": fields,
-            "timestamp": timestamp
-        }
+    def stream_results(self, results, ndjson, profile, headers=None):
+        # JSON-encoded results are pulled from the query pipeline (or the
+        # cache) and written as they are produced, as NDJSON or as one JSON
+        # array, in chunks of about STREAM_BUFFER_SIZE bytes.
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson' if ndjson else 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        buffer = bytearray() if ndjson else bytearray(b'[')
+        count = 0
+        try:
+            for result in results:
+                if ndjson:
+                    buffer += result + b'\n'
+                else:
+                    buffer += (b',' if count else b'') + result
+                count += 1
+                if len(buffer) >= self.STREAM_BUFFER_SIZE:
+                    with profile.stage('send'):
+                        self.write_chunk(buffer)
+                    buffer = bytearray()
+        except Exception as e:
+            # The status line is already sent; drop the connection without the
+            # terminating chunk so the client sees a truncated response.
+            print(f"Query failed while streaming: {e}")
+            METRICS.inc('vm_query_errors_total')
+            self.close_connection = True
+            return count
+        if not ndjson:
+            buffer += b']'
+        with profile.stage('send'):
+            self.write_chunk(buffer, last=True)
+        return count
 
-        key = f"{measurement}:{timestamp}"
-        self.lsm_tree.put(key, json.dumps(parsed_data))
-        print(f"Saved data: {parsed_data}")
+    def write_chunk(self, data, last=False):
+        # The terminating chunk goes out in the same write as the last data.
+        chunk = f"{len(data):X}\r\n".encode() + bytes(data) + b'\r\n' if data else b''
+        if last:
+            chunk += b'0\r\n\r\n'
+        if chunk:
+            self.wfile.write(chunk)
     
-    def process_query(self, query):
-        parser = QueryParser(query)
-        parsed_query = parser.get_parsed_query()
-        
-        results = []
-        for level in range(self.lsm_tree.max_levels):
-            for sstable in self.lsm_tree.levels[level]:
-                for key, value in sstable.data.items():
-                    parsed_data = json.loads(value)
-                    if self.matches_query(parsed_data, parsed_query):
-                        results.append(parsed_data)
-        
-        # Check memtable
-        for key, value in self.lsm_tree.memtable.data.items():
-            parsed_data = json.loads(value)
-            if self.matches_query(parsed_data, parsed_query):
-                results.append(parsed_data)
+    def save_data(self, data):
+        points, errors = parse_line_protocol(data, int(time.time() * 1e9))
+        stored = self.store.write(points)  # Invalidates the cached queries it affects
+        METRICS.inc('vm_ingest_requests_total')
+        METRICS.inc('vm_ingest_points_total', stored, result='stored')
+        METRICS.inc('vm_ingest_points_total', len(points) - stored, result='expired')
+        METRICS.inc('vm_ingest_rejected_lines_total', len(errors))
+        debug(f"Saved {stored} points, skipped {len(points) - stored} past retention, rejected {len(errors)} lines")
+        return stored, len(points) - stored, errors
+    
+    def process_query(self, plan, partial=False):
+        parsed_query = plan.parsed_query
+        if partial:
+            return self.partial_results(plan)
 
-        results = self.apply_aggregations(results, parsed_query)
+        aggregator = Aggregator.for_query(parsed_query)
+        if aggregator is not None:
+            snapshot = plan.snapshot()
+            rule = plan.rollup(aggregator, snapshot)
+            if rule is not None:
+                results = aggregator.run_summaries(plan.summaries(aggregator.fields, rule, snapshot))
+            else:
+                results = aggregator.run(plan.batches(aggregator.fields, snapshot))
+            return self.apply_pagination(results, parsed_query)
+
+        # Each stage is lazy, so LIMIT/OFFSET stop the scan as soon as enough
+        # rows have been produced. Aggregation and grouping still need every
+        # matching row.
+        results = plan.rows()
+        results = self.apply_projection(results, parsed_query)
         results = self.apply_grouping(results, parsed_query)
         results = self.apply_pagination(results, parsed_query)
         
         return results
 
-    def matches_query(self, data, parsed_query):
-        if parsed_query['from'] != data['measurement']:
-            return False
-        
-        for condition in parsed_query['where']:
-            if '=' in condition:
-                key, value = condition.split('=')
-                key = key.strip()
-                value = value.strip().replace("'", "").replace('"', '')
-                if key in data['tags']:
-                    if data['tags'][key] != value:
-                        return False
-                elif key in data['fields']:
-                    if str(data['fields'][key]) != value:
-                        return False
-                else:
-                    return False
-        
-        if parsed_query['time_range']:
-            timestamp = int(data['timestamp'])
-            start_time = self.parse_time(parsed_query['time_range']['start'])
-            end_time = self.parse_time(parsed_query['time_range']['end'])
-            if timestamp < start_time or timestamp > end_time:
-                return False
-        
-        return True
+    def partial_results(self, plan):
+        # Results for vm-select to merge with other storage nodes: a header
+        # record describing how to finish the query, then per-series partial
+        # aggregates or projected rows. Grouping and OFFSET are left to the
+        # merger, so each node returns up to OFFSET + LIMIT rows, or all of
+        # them when the rows are grouped.
+        parsed_query = plan.parsed_query
+        header = {
+            'aggregates': [],
+            'group_tags': [],
+            'interval': None,
+            'group_by': parsed_query['group_by'],
+            'limit': parsed_query['limit'],
+            'offset': parsed_query['offset'],
+        }
+        aggregator = Aggregator.for_query(parsed_query)
+        if aggregator is None:
+            results = self.apply_projection(plan.rows(), parsed_query)
+            if parsed_query['limit'] and not parsed_query['group_by']:
+                results = itertools.islice(results, (parsed_query['offset'] or 0) + parsed_query['limit'])
+            return itertools.chain([{'partial': header}], results)
 
-    def parse_time(self, time_str):
-        # Parse ISO 8601 format to timestamp
-        dt = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
-        return int(dt.timestamp() * 1e9)  # Convert to nanoseconds
+        if not aggregator.partial:
+            raise ValueError("PERCENTILE and MEDIAN cannot be merged across storage nodes")
+        header['aggregates'] = [[column, function, field] for column, function, field, _ in aggregator.aggregates]
+        header['group_tags'] = aggregator.group_tags
+        header['interval'] = aggregator.interval
+        snapshot = plan.snapshot()
+        rule = plan.rollup(aggregator, snapshot)
+        if rule is not None:
+            results = aggregator.partials(plan.summaries(aggregator.fields, rule, snapshot), summaries=True)
+        else:
+            results = aggregator.partials(plan.batches(aggregator.fields, snapshot))
+        return itertools.chain([{'partial': header}], results)
 
-    def apply_aggregations(self, results, parsed_query):
-        if not parsed_query['select'] or parsed_query['select'][0] == '*':
+    def apply_projection(self, results, parsed_query):
+        columns = [column for column in parsed_query['select'] if column != '*' and '(' not in column]
+        if not columns or len(columns) != len(parsed_query['select']):
             return results
-
-        aggregated_results = []
-        for agg_function in parsed_query['select']:
-            if agg_function.upper().startswith(('COUNT', 'SUM', 'AVG', 'MIN', 'MAX')):
-                field = agg_function[agg_function.index('(')+1:agg_function.index(')')]
-                agg_value = self.calculate_aggregation(results, agg_function.split('(')[0].upper(), field)
-                aggregated_results.append({agg_function: agg_value})
-
-        return aggregated_results if aggregated_results else results
-
-    def calculate_aggregation(self, results, function, field):
-        values = [float(result['fields'].get(field, 0)) for result in results]
-        if function == 'COUNT':
-            return len(values)
-        elif function == 'SUM':
-            return sum(values)
-        elif function == 'AVG':
-            return sum(values) / len(values) if values else 0
-        elif function == 'MIN':
-            return min(values) if values else None
-        elif function == 'MAX':
-            return max(values) if values else None
+        return ({**result, 'fields': {name: value for name, value in result['fields'].items() if name in columns}}
+                for result in results)
 
     def apply_grouping(self, results, parsed_query):
         if not parsed_query['group_by']:
@@ -331,7 +3175,7 @@ class LSMDataHandler(BaseHTTPRequestHandler):
         return [
             {
                 'group': dict(zip(parsed_query['group_by'], group)),
-                'results': self.apply_aggregations(group_results, parsed_query)
+                'results': group_results
             }
             for group, group_results in grouped_results.items()
         ]
@@ -340,16 +3184,42 @@ class LSMDataHandler(BaseHTTPRequestHandler):
         offset = parsed_query['offset'] or 0
         limit = parsed_query['limit']
         if limit:
-            return results[offset:offset+limit]
-        return results[offset:]
+            return itertools.islice(results, offset, offset + limit)
+        return itertools.islice(results, offset, None)
 
-def run_server(host, port):
+def run_server(host, port, retention=None, block_codecs=None, block_cache_bytes=64 << 20):
     server_address = (host, port)
-    httpd = HTTPServer(server_address, LSMDataHandler)
+    httpd = ThreadingHTTPServer(server_address, LSMDataHandler)
+    httpd.block_cache = BlockCache(block_cache_bytes)
+    tree_options = {'block_codecs': block_codecs} if block_codecs else {}
+    httpd.store = TimeSeriesStore(retention=retention, block_cache=httpd.block_cache, **tree_options)
+    httpd.query_cache = QueryCache()
+    httpd.sql_tables = MeasurementTables(httpd.store) if MeasurementTables is not None else None
+
+    def on_change(measurement, low, high):
+        httpd.query_cache.invalidate(measurement, low, high)
+        if httpd.sql_tables is not None:
+            httpd.sql_tables.invalidate(measurement, low, high)
+
+    httpd.store.on_change = on_change
     print(f"LSM Data Saver and Query Handler running on http://{host}:{port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.store.close()
 
 if __name__ == "__main__":
+    # Usage: vm-storage-lsm.py [port] [data directory] [retention, e.g. 30d]
     HOST = "localhost"
-    PORT = 8087
-    run_server(HOST, PORT)
+    PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8087
+    RETENTION = parse_duration(sys.argv[3]) if len(sys.argv) > 3 else None
+    # Block codec per LSM level, e.g. VM_BLOCK_CODECS=none,zlib,lzma
+    LEVEL_CODECS = tuple(os.environ['VM_BLOCK_CODECS'].split(',')) if os.environ.get('VM_BLOCK_CODECS') else None
+    BLOCK_CACHE_BYTES = int(os.environ.get('VM_BLOCK_CACHE_MB', '64')) << 20
+    if len(sys.argv) > 2:
+        # Several storage nodes on one host each need their own directory.
+        os.makedirs(sys.argv[2], exist_ok=True)
+        os.chdir(sys.argv[2])
+    run_server(HOST, PORT, RETENTION, LEVEL_CODECS, BLOCK_CACHE_BYTES)
@@ -4,10 +4,20 @@ from lsm import LSM
 import time
 from urllib.parse import parse_qs, urlparse
 import re
+from metrics import DEBUG, Metrics, QueryProfile, cprofile_call, debug
 
 # Initialize LSM database
 db = LSM('influx_data.ldb')
 
+METRICS = Metrics({
+    'vm_ingest_requests_total': 'Write requests received.',
+    'vm_ingest_seconds': 'Time to store one write request.',
+    'vm_queries_total': 'Queries run.',
+    'vm_query_seconds': 'Time to run one query.',
+    'vm_query_stage_seconds': 'Time per query stage: parse, scan, encode and send.',
+    'vm_query_results_total': 'Result records sent.',
+})
+
 def print_db_contents():
     print("Current database contents:")
     with db.cursor() as cursor:
@@ -71,43 +81,88 @@ class LSMDataHandler(BaseHTTPRequestHandler):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
         
-        self.save_data(post_data)
+        with METRICS.timer('vm_ingest_seconds'):
+            self.save_data(post_data)
+        METRICS.inc('vm_ingest_requests_total')
         
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.end_headers()
         self.wfile.write(b"Data received and forwarded")
         
-        print_db_contents()  # Print database contents after each insert
+        if DEBUG:
+            print_db_contents()  # Print database contents after each insert
     
     def do_GET(self):
         parsed_url = urlparse(self.path)
         query_params = parse_qs(parsed_url.query)
         
+        if parsed_url.path == '/metrics':
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        
         if 'query' not in query_params:
             self.send_error(400, "Missing 'query' parameter")
             return
         
         query = query_params['query'][0]
-        print(f"Received query: {query}")  # Debug print
-        print_db_contents()  # Print database contents before processing query
-        
-        results = self.process_query(query)
+        debug(f"Received query: {query}")
+        if DEBUG:
+            print_db_contents()  # Print database contents before processing query
+        
+        # X-Profile: stages reports the time per stage in a Server-Timing
+        # header; X-Profile: cprofile answers with the cProfile statistics
+        # instead of results.
+        profile_mode = self.headers.get('X-Profile', '').lower()
+        profile = QueryProfile()
+        if profile_mode == 'cprofile':
+            results, dump = cprofile_call(lambda: self.process_query(query, profile))
+            body = f"{len(results)} results, {profile.server_timing()}\n\n{dump}".encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        results = self.process_query(query, profile)
+        with profile.stage('encode'):
+            body = json.dumps(results).encode()
         
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
+        if profile_mode == 'stages':
+            self.send_header('Server-Timing', profile.server_timing())
         self.end_headers()
-        self.wfile.write(json.dumps(results).encode())
+        with profile.stage('send'):
+            self.wfile.write(body)
+        METRICS.inc('vm_queries_total')
+        METRICS.inc('vm_query_results_total', len(results))
+        METRICS.observe('vm_query_seconds', profile.elapsed())
+        profile.record(METRICS, 'vm_query_stage_seconds')
     
     def save_data(self, data):
         key = str(int(time.time() * 1000)).encode()
         db[key] = data.encode()
-        print(f"Saved data: {data}")
+        debug(f"Saved data: {data}")
     
-    def process_query(self, query):
-        parser = QueryParser(query)
-        parsed_query = parser.get_parsed_query()
+    def process_query(self, query, profile):
+        with profile.stage('parse'):
+            parser = QueryParser(query)
+            parsed_query = parser.get_parsed_query()
         
+        with profile.stage('scan'):
+            results = self.scan(parsed_query)
+        
+        results = self.apply_aggregations(results, parsed_query)
+        results = self.apply_grouping(results, parsed_query)
+        results = self.apply_pagination(results, parsed_query)
+        
+        return results
+
+    def scan(self, parsed_query):
         results = []
         with db.cursor() as cursor:
             for key, value in cursor:
@@ -116,11 +171,6 @@ class LSMDataHandler(BaseHTTPRequestHandler):
                     parsed_data = self.parse_influx_data(data)
                     if parsed_data:
                         results.append(parsed_data)
-        
-        results = self.apply_aggregations(results, parsed_query)
-        results = self.apply_grouping(results, parsed_query)
-        results = self.apply_pagination(results, parsed_query)
-        
         return results
 
     def matches_query(self, data, parsed_query):